@@ -0,0 +1,203 @@
+"""Download buffer benchmark
+
+このスクリプトの目標。
+
+- Blob を readall で bytes にしてからデコードする従来の方法 (BlobStorageClient.download_bytes) と、
+  使い回すバッファへ readinto で受け取ってデコードする方法
+  (BlobStorageClient.download_into) を比べる。
+- 画像ごとの所要時間、 tracemalloc のピーク、プロセスの最大 RSS を出す。
+- Blob Storage の代わりに、 Range 付きの GET に答える HTTP サーバーを手元で立てる。
+  クライアントは本番と同じ BlobStorageClient と SDK の設定
+  (BLOB_FIRST_GET_BYTES の最初の GET と、続くチャンクの GET) で動かす。
+- 方法ごとに新しいプロセスで測り、最大 RSS が混ざらないようにする。
+  サーバーは親プロセスに置き、その割り当ては測らない。
+
+使い方:
+    python benchmark_buffer_pool.py --images 2000 --size 2000x1500
+
+"""
+
+# Built-in modules.
+import argparse
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# .env がなくても動くよう、必須の環境変数にダミーを入れておきます。
+for keyname in ('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY',
+                'PERSON_GROUP_ID',
+                'MYSQL_HOST',
+                'MYSQL_PASSWORD',
+                'MYSQL_USER',
+                'MYSQL_DATABASE'):
+    os.environ.setdefault(keyname, 'benchmark')
+
+# NOTE: キャッシュに置くと2回目からダウンロードしないため、両方の方法で使いません。
+os.environ['BLOB_CACHE_MEMORY_MAX_BYTES'] = '0'
+os.environ['BLOB_CACHE_DIR'] = ''
+
+# Third-party modules.
+import numpy  # noqa: E402
+import cv2  # noqa: E402
+
+# My modules.
+import blob_storage  # noqa: E402
+import const  # noqa: E402
+import image_decode  # noqa: E402
+
+
+# Azurite (Azure Storage のエミュレーター) の既定のアカウントです。
+ACCOUNT_NAME = 'devstoreaccount1'
+ACCOUNT_KEY = ('Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq'
+               '/K1SZFPTOtr/KBHBeksoGMGw==')
+
+CONTAINER_NAME = 'benchmark'
+
+# 手元の100x100の顔画像を拡大して、大きな写真の代わりにします。
+IMAGE_PATH = './100x100-egc.png'
+
+
+class BlobRangeHandler(BaseHTTPRequestHandler):
+    """Get Blob に、 x-ms-range の範囲で答えます。中身は server.data です。
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+
+        data = self.server.data
+        start, end = 0, len(data) - 1
+        match = re.match(r'bytes=(\d+)-(\d*)',
+                         self.headers.get('x-ms-range', ''))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+        body = data[start:end + 1]
+
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Range',
+                         f'bytes {start}-{end}/{len(data)}')
+        self.send_header('x-ms-blob-type', 'BlockBlob')
+        self.send_header('ETag', '"0x1"')
+        self.send_header('Last-Modified', 'Wed, 01 Jan 2025 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_server(data: bytes) -> ThreadingHTTPServer:
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), BlobRangeHandler)
+    server.data = data
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_connection_string(port: int) -> str:
+
+    return (f'DefaultEndpointsProtocol=http;AccountName={ACCOUNT_NAME};'
+            f'AccountKey={ACCOUNT_KEY};'
+            f'BlobEndpoint=http://127.0.0.1:{port}/{ACCOUNT_NAME};')
+
+
+def run(mode: str, image_count: int) -> dict:
+    """mode の方法で image_count 枚をダウンロード、デコードします。
+    """
+
+    client = blob_storage.BlobStorageClient
+    buffers = client.get_buffer_pool()
+    tile_size = const.MOSAIC_TILE_SIZE
+
+    def fetch_readall(i):
+        downloaded_bytes = client.download_bytes(CONTAINER_NAME, f'{i}.jpg')
+        return image_decode.decode_tile(downloaded_bytes, tile_size)[0]
+
+    def fetch_buffer(i):
+        buffer, size = client.download_into(
+            CONTAINER_NAME, f'{i}.jpg', buffers)
+        try:
+            return image_decode.decode_tile(
+                memoryview(buffer)[:size], tile_size)[0]
+        finally:
+            buffers.release(buffer)
+
+    fetch = fetch_readall if mode == 'readall' else fetch_buffer
+    workers = const.BLOB_DOWNLOAD_MAX_WORKERS
+
+    # NOTE: 接続を張るぶんは測らないよう、1枚ずつ先に流しておきます。
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(fetch, range(workers)))
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for mat in executor.map(fetch, range(image_count)):
+            assert mat is not None
+    seconds = time.perf_counter() - started
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'ms_per_image': seconds / image_count * 1000,
+        'tracemalloc_peak_bytes': peak_bytes,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def create_photo(width: int, height: int) -> bytes:
+
+    mat = cv2.resize(cv2.imread(IMAGE_PATH), (width, height),
+                     interpolation=cv2.INTER_CUBIC)
+    noise = numpy.random.default_rng(0).integers(
+        -8, 8, mat.shape, dtype=numpy.int16)
+    mat = numpy.clip(mat.astype(numpy.int16) + noise, 0, 255).astype(
+        numpy.uint8)
+    return cv2.imencode('.jpg', mat, [cv2.IMWRITE_JPEG_QUALITY, 95])[
+        1].tobytes()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--size', default='2000x1500')
+    parser.add_argument('--mode', choices=('readall', 'buffer'),
+                        help='このモードだけを測り、結果を JSON で出力します。')
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run(args.mode, args.images)))
+        sys.exit()
+
+    width, height = map(int, args.size.split('x'))
+    data = create_photo(width, height)
+    server = start_server(data)
+    env = dict(os.environ, AZURE_STORAGE_CONNECTION_STRING=(
+        get_connection_string(server.server_port)))
+
+    print(f'{args.images} images of {args.size} '
+          f'({len(data) / 1024:.0f} KB each)')
+    print(f'{"mode":<10}{"ms/image":>10}'
+          f'{"traced peak MB":>16}{"max RSS MB":>12}')
+    for mode in ('readall', 'buffer'):
+        completed = subprocess.run(
+            [sys.executable, __file__, '--mode', mode,
+             '--images', str(args.images)],
+            stdout=subprocess.PIPE, env=env, check=True)
+        result = json.loads(completed.stdout)
+        print(f'{mode:<10}{result["ms_per_image"]:10.2f}'
+              f'{result["tracemalloc_peak_bytes"] / 1024 ** 2:16.1f}'
+              f'{result["max_rss_kb"] / 1024:12.1f}')
+    server.shutdown()
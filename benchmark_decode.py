@@ -0,0 +1,112 @@
+"""Reduced decode benchmark
+
+このスクリプトの目標。
+
+- 大きな写真を、全解像度でデコードしてタイルに縮める従来の方法と、
+  縮小しながらデコードする方法 (image_decode.decode_tile) で比べる。
+- 画像1枚ごとに、デコード時間と、デコード後に抱える画素のバイト数の差を出す。
+- BLOB_MAX_BYTES を超えてダウンロードしない画像もわかるようにする。
+
+使い方:
+    python benchmark_decode.py --sizes 800x600 2000x1500 4000x3000
+
+"""
+
+# Built-in modules.
+import argparse
+import os
+import time
+
+# .env がなくても動くよう、必須の環境変数にダミーを入れておきます。
+for keyname in ('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY',
+                'PERSON_GROUP_ID',
+                'MYSQL_HOST',
+                'MYSQL_PASSWORD',
+                'MYSQL_USER',
+                'MYSQL_DATABASE',
+                'AZURE_STORAGE_CONNECTION_STRING'):
+    os.environ.setdefault(keyname, 'benchmark')
+
+# Third-party modules.
+import numpy  # noqa: E402
+import cv2  # noqa: E402
+
+# My modules.
+import const  # noqa: E402
+import image_decode  # noqa: E402
+import mosaic  # noqa: E402
+
+
+# 各画像でデコードを繰り返す回数です。
+NUMBER = 20
+
+# 手元の100x100の顔画像を拡大して、大きな写真の代わりにします。
+IMAGE_PATH = './100x100-egc.png'
+
+
+def create_photo(width: int, height: int, extension: str) -> bytes:
+    """顔画像を拡大し、写真らしく細かい揺らぎを足してエンコードします。
+    """
+
+    mat = cv2.resize(cv2.imread(IMAGE_PATH), (width, height),
+                     interpolation=cv2.INTER_CUBIC)
+    noise = numpy.random.default_rng(0).integers(
+        -8, 8, mat.shape, dtype=numpy.int16)
+    mat = numpy.clip(mat.astype(numpy.int16) + noise, 0, 255).astype(
+        numpy.uint8)
+    return cv2.imencode(extension, mat, [cv2.IMWRITE_JPEG_QUALITY, 90])[
+        1].tobytes()
+
+
+def decode_full(bytes_image: bytes, builder: mosaic.MosaicBuilder) -> tuple:
+
+    mat = cv2.imdecode(numpy.frombuffer(bytes_image, numpy.uint8),
+                       cv2.IMREAD_COLOR)
+    return builder.fit_to_tile(mat), mat.nbytes
+
+
+def measure(func: callable) -> float:
+
+    started = time.perf_counter()
+    for _ in range(NUMBER):
+        func()
+    return (time.perf_counter() - started) / NUMBER * 1000
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+',
+                        default=['400x300', '800x600', '2000x1500',
+                                 '4000x3000'])
+    args = parser.parse_args()
+
+    tile_size = const.MOSAIC_TILE_SIZE
+    builder = mosaic.MosaicBuilder(1, 1, tile_size)
+    max_bytes = const.BLOB_MAX_BYTES
+
+    print(f'{"image":<18}{"blob KB":>9}{"factor":>8}'
+          f'{"full ms":>9}{"reduced ms":>12}{"saved ms":>10}'
+          f'{"full KB":>9}{"saved KB":>10}')
+    for size in args.sizes:
+        width, height = map(int, size.split('x'))
+        for extension in ('.jpg', '.png'):
+            bytes_image = create_photo(width, height, extension)
+            label = f'{size}{extension}'
+            if 0 < max_bytes < len(bytes_image):
+                print(f'{label:<18}{len(bytes_image) / 1024:9.0f}'
+                      f'  skipped: larger than BLOB_MAX_BYTES')
+                continue
+
+            factor = image_decode.get_reduction_factor(
+                width, height, tile_size)
+            _, full_bytes = decode_full(bytes_image, builder)
+            _, saved_bytes = image_decode.decode_tile(bytes_image, tile_size)
+            full_ms = measure(lambda: decode_full(bytes_image, builder))
+            reduced_ms = measure(
+                lambda: image_decode.decode_tile(bytes_image, tile_size))
+
+            print(f'{label:<18}{len(bytes_image) / 1024:9.0f}{factor:8}'
+                  f'{full_ms:9.2f}{reduced_ms:12.2f}'
+                  f'{full_ms - reduced_ms:10.2f}'
+                  f'{full_bytes / 1024:9.0f}{saved_bytes / 1024:10.0f}')
@@ -0,0 +1,131 @@
+"""Detection payload benchmark
+
+このスクリプトの目標。
+
+- Detection API に送る連結画像のエンコード設定を比べる。
+- 設定ごとにエンコード時間、送信バイト数、顔の検出率を出す。
+- 検出は既定では手元の代役 (OpenCV の Haar cascade) で行い、クォータを使わない。
+- --face-api を付けると本物の Detection API にまわす。
+
+"""
+
+# Built-in modules.
+import argparse
+import time
+import uuid
+
+# Third-party modules.
+import numpy
+import cv2
+
+# My modules.
+import mosaic
+from face_api import FaceApiClient, ImageEncoding
+
+
+# 各設定でエンコードを繰り返す回数です。
+NUMBER = 50
+
+# 手元の100x100画像を繰り返して使います。
+IMAGE_PATHS = [
+    './100x100-dog.png',
+    './100x100-egc.png',
+    './100x100-egc2.png',
+    './100x100-kbt.png',
+    './100x100-ymzk.png',
+]
+
+
+def get_encodings() -> list:
+
+    return [
+        ImageEncoding('png'),
+        ImageEncoding('png', png_compression=1),
+        ImageEncoding('png', png_compression=9),
+        ImageEncoding('png', png_compression=1, grayscale=True),
+        ImageEncoding('jpeg', jpeg_quality=95),
+        ImageEncoding('jpeg', jpeg_quality=85),
+        ImageEncoding('jpeg', jpeg_quality=70),
+        ImageEncoding('jpeg', jpeg_quality=50),
+        ImageEncoding('jpeg', jpeg_quality=85, grayscale=True),
+    ]
+
+
+# 代役の Detection で使う分類器です。
+face_cascade = cv2.CascadeClassifier(
+    cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+
+
+def stand_in_detect(bytes_image: bytes) -> list:
+    """Detection API の代役です。受け取った画像から顔を探し、同じ形式で返します。
+
+    Args:
+        bytes_image (bytes): エンコードした画像。
+
+    Returns:
+        list: Detection 結果。
+    """
+
+    mat = cv2.imdecode(numpy.frombuffer(bytes_image, numpy.uint8),
+                       cv2.IMREAD_GRAYSCALE)
+    faces = face_cascade.detectMultiScale(mat, minSize=(30, 30))
+    return [
+        {
+            'faceId': str(uuid.uuid4()),
+            'faceRectangle': {
+                'left': int(left), 'top': int(top),
+                'width': int(width), 'height': int(height),
+            },
+        }
+        for left, top, width, height in faces
+    ]
+
+
+def detected_tile_indexes(detection_result: list,
+                          builder: mosaic.MosaicBuilder) -> set:
+
+    # 顔が見つかったタイルのインデックスです。
+    return {
+        builder.tile_index_at(result['faceRectangle']['left'],
+                              result['faceRectangle']['top'])
+        for result in detection_result
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--face-api', action='store_true',
+                        help='本物の Detection API にまわします。クォータを使います。')
+    args = parser.parse_args()
+
+    if args.face_api:
+        detect = FaceApiClient.detect
+    else:
+        detect = stand_in_detect
+
+    mats = [cv2.imread(path) for path in IMAGE_PATHS]
+    assert all(mat is not None for mat in mats), '画像が読み込めなかったよ。'
+
+    builder = mosaic.MosaicBuilder()
+    concatenated_mat = builder.build(
+        [mats[i % len(mats)] for i in range(builder.capacity)])
+
+    # 可逆の PNG で見つかったタイルを正解とします。
+    encodings = get_encodings()
+    expected = detected_tile_indexes(
+        detect(encodings[0].encode(concatenated_mat)), builder)
+
+    print(f'{"encoding":<56}{"ms":>8}{"bytes":>10}{"hit rate":>10}')
+    for encoding in encodings:
+        started = time.perf_counter()
+        for _ in range(NUMBER):
+            bytes_image = encoding.encode(concatenated_mat)
+        milliseconds = (time.perf_counter() - started) / NUMBER * 1000
+
+        actual = detected_tile_indexes(detect(bytes_image), builder)
+        hit_rate = (len(actual & expected) / len(expected)
+                    if expected else .0)
+
+        print(f'{repr(encoding):<56}{milliseconds:8.2f}'
+              f'{len(bytes_image):10}{hit_rate:10.1%}')
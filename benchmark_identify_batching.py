@@ -0,0 +1,131 @@
+"""Identify batching benchmark
+
+このスクリプトの目標。
+
+- Identification API のトランザクション数を、セットごと (従来)、
+  PersonGroup ごとにまとめてからセットに分ける場合 (packing.pack_by_key)、
+  セットをまたいでまとめる場合 (identify_batch.IdentifyAccumulator) で比べる。
+- PersonGroup の数と偏りを変えて、1回あたりの faceId 数がどれだけ10件に近づくかを見る。
+- Face API は呼ばない。 identify を数えるだけの代役に差し替える。
+
+使い方:
+    python benchmark_identify_batching.py --records 10000 --groups 5 20 100
+
+"""
+
+# Built-in modules.
+import argparse
+import os
+import random
+import uuid
+
+# .env がなくても動くよう、必須の環境変数にダミーを入れておきます。
+for keyname in ('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY',
+                'PERSON_GROUP_ID',
+                'MYSQL_HOST',
+                'MYSQL_PASSWORD',
+                'MYSQL_USER',
+                'MYSQL_DATABASE',
+                'AZURE_STORAGE_CONNECTION_STRING'):
+    os.environ.setdefault(keyname, 'benchmark')
+
+# My modules.
+import face_api  # noqa: E402
+import identify_batch  # noqa: E402
+import image  # noqa: E402
+import packing  # noqa: E402
+import util  # noqa: E402
+
+
+# identify に送られた faceId の数を、呼び出しごとに記録します。
+face_id_counts = []
+
+
+def stand_in_identify(person_group_id: str, face_ids: list) -> list:
+    """Identification API の代役です。呼び出しを数え、候補なしを返します。
+    """
+
+    assert 1 <= len(face_ids) <= 10
+    face_id_counts.append(len(face_ids))
+    return [{'faceId': face_id, 'candidates': []} for face_id in face_ids]
+
+
+def create_face_images(count: int,
+                       group_count: int,
+                       skew: float,
+                       miss_rate: float) -> list:
+    """detection 済みの架空の FaceImage を作ります。
+
+    Args:
+        count (int): 件数。
+        group_count (int): PersonGroup (コンテナ) の数。
+        skew (float): PersonGroup の偏り。 Zipf 分布の指数です。0なら一様です。
+        miss_rate (float): detection で顔が見つからなかった割合 (0-1)。
+
+    Returns:
+        list: FaceImage のリスト。 DB の順序 (作成順) です。
+    """
+
+    weights = [1 / (rank + 1) ** skew for rank in range(group_count)]
+    containers = random.choices(range(group_count), weights, k=count)
+    face_images = []
+    for i, container in enumerate(containers):
+        face_image = image.FaceImage(i, f'/group{container}/{i}.png', 'p')
+        if random.random() >= miss_rate:
+            face_image.detected_face_id = str(uuid.uuid4())
+        face_images.append(face_image)
+    return face_images
+
+
+def count_per_set(face_images_sets: object) -> list:
+
+    face_id_counts.clear()
+    mosaic_builder = image.create_mosaic_builder()
+    for face_images_max64 in face_images_sets:
+        image.FaceImageSet(face_images_max64,
+                           mosaic_builder=mosaic_builder).identify()
+    return list(face_id_counts)
+
+
+def count_accumulated(face_images: list, capacity: int) -> list:
+
+    face_id_counts.clear()
+    accumulator = identify_batch.IdentifyAccumulator(
+        max_wait_seconds=float('inf'), identify=stand_in_identify)
+    for face_images_max64 in util.chunked(face_images, capacity):
+        accumulator.add(face_images_max64)
+    accumulator.flush()
+    return list(face_id_counts)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--groups', type=int, nargs='+',
+                        default=[1, 5, 20, 100])
+    parser.add_argument('--skew', type=float, default=1)
+    parser.add_argument('--miss-rate', type=float, default=.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    face_api.FaceApiClient.identify = staticmethod(stand_in_identify)
+    capacity = image.create_mosaic_builder().capacity
+
+    print(f'{"groups":>8}{"per set":>10}{"packed":>10}{"batched":>10}'
+          f'{"faces/call":>12}{"packed":>10}{"batched":>10}')
+    for group_count in args.groups:
+        face_images = create_face_images(
+            args.records, group_count, args.skew, args.miss_rate)
+        per_set = count_per_set(util.chunked(face_images, capacity))
+        packed = count_per_set(packing.pack_by_key(
+            face_images, capacity, image.FaceImage.get_person_group_id))
+        accumulated = count_accumulated(face_images, capacity)
+        assert sum(per_set) == sum(packed) == sum(accumulated)
+
+        print(f'{group_count:8}{len(per_set):10}{len(packed):10}'
+              f'{len(accumulated):10}'
+              f'{sum(per_set) / len(per_set):12.2f}'
+              f'{sum(packed) / len(packed):10.2f}'
+              f'{sum(accumulated) / len(accumulated):10.2f}')
@@ -0,0 +1,79 @@
+"""Mosaic benchmark
+
+このスクリプトの目標。
+
+- 連結画像の作り方を比べる。
+- 旧方式: convert_list_8x8 で2次元リストにしてから hconcat/vconcat する。
+- 新方式: MosaicBuilder のバッファへ直接コピーする。セットごとに確保する場合と使い回す場合。
+- 結果が同じ画像になることも確認する。
+
+"""
+
+# Built-in modules.
+import timeit
+
+# Third-party modules.
+import numpy
+import cv2
+
+# My modules.
+import util
+import mosaic
+
+
+# ベンチマークの試行回数です。
+NUMBER = 200
+
+# 手元の100x100画像を繰り返して使います。
+IMAGE_PATHS = [
+    './100x100-dog.png',
+    './100x100-egc.png',
+    './100x100-egc2.png',
+    './100x100-kbt.png',
+    './100x100-ymzk.png',
+]
+
+
+def concatenate_legacy(mat_list: list) -> numpy.ndarray:
+
+    # FaceImageSet.__concatenate_mat_8x8 のもともとの実装です。
+    blank_mat = numpy.ones((100, 100, 3), numpy.uint8) * 255
+    list_2d = util.convert_list_8x8(mat_list, blank_mat)
+    return cv2.vconcat([cv2.hconcat(list_1d) for list_1d in list_2d])
+
+
+def concatenate_per_set(mat_list: list) -> numpy.ndarray:
+
+    # セットごとにバッファを確保します。
+    return mosaic.MosaicBuilder().build(mat_list)
+
+
+shared_builder = mosaic.MosaicBuilder()
+
+
+def concatenate_reused(mat_list: list) -> numpy.ndarray:
+
+    # バッファを使い回します。
+    return shared_builder.build(mat_list)
+
+
+if __name__ == '__main__':
+
+    mats = [cv2.imread(path) for path in IMAGE_PATHS]
+    assert all(mat is not None for mat in mats), '画像が読み込めなかったよ。'
+
+    # 満杯のセットと、端数のセットの両方を測ります。
+    for count in (64, 3):
+        mat_list = [mats[i % len(mats)] for i in range(count)]
+
+        expected = concatenate_legacy(mat_list)
+        assert numpy.array_equal(concatenate_per_set(mat_list), expected)
+        assert numpy.array_equal(concatenate_reused(mat_list), expected)
+
+        print(f'{count} images, {NUMBER} runs:')
+        for func in (concatenate_legacy,
+                     concatenate_per_set,
+                     concatenate_reused):
+            seconds = timeit.timeit(lambda: func(mat_list), number=NUMBER)
+            print(f'  {func.__name__:<22}'
+                  f'{seconds / NUMBER * 1000:8.3f} ms/set')
@@ -0,0 +1,251 @@
+"""Face prefilter benchmark
+
+このスクリプトの目標。
+
+- prefilter.FacePrefilter の設定 (ぼけ具合の下限と minNeighbors) ごとに、
+  顔のある画像を誤って除く割合 (false reject) と、顔のない画像を除ける割合を出す。
+- 顔のない画像の割合を決めて、 detection のトランザクションがどれだけ減るかを出す。
+  回数は production_draft と同じく image.iter_image_sets でセットに分けて数える。
+  Blob のダウンロードだけを、手元で作った画像を返す代役に差し替える。
+- 画像は手元の100x100の画像に明るさ、ぼかし、ずれ、縮小などを加えて作る。
+  顔は egc, egc2, kbt, ymzk、顔なしは dog と無地、ノイズ、グラデーション、
+  顔が判別できないほどぼかした画像とする。
+
+使い方:
+    python benchmark_prefilter.py --images 10000 --non-face-ratio .2
+
+"""
+
+# Built-in modules.
+import argparse
+import logging
+import os
+import time
+
+# .env がなくても動くよう、必須の環境変数にダミーを入れておきます。
+for keyname in ('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY',
+                'PERSON_GROUP_ID',
+                'MYSQL_HOST',
+                'MYSQL_PASSWORD',
+                'MYSQL_USER',
+                'MYSQL_DATABASE',
+                'AZURE_STORAGE_CONNECTION_STRING'):
+    os.environ.setdefault(keyname, 'benchmark')
+
+# NOTE: 判定するフィルタはベンチマークで差し替えます。デコードはこのプロセスで行います。
+os.environ['PREFILTER_ENABLED'] = '0'
+os.environ['PROCESS_POOL_ENABLED'] = '0'
+
+# Third-party modules.
+import numpy  # noqa: E402
+import cv2  # noqa: E402
+
+# My modules.
+import blob_storage  # noqa: E402
+import image  # noqa: E402
+import prefilter  # noqa: E402
+import util  # noqa: E402
+
+
+FACE_PATHS = (
+    './100x100-egc.png',
+    './100x100-egc2.png',
+    './100x100-kbt.png',
+    './100x100-ymzk.png',
+)
+NON_FACE_PATHS = (
+    './100x100-dog.png',
+)
+
+BLUR_SCORES = (0, 2, 10, 50)
+MIN_NEIGHBORS = (1, 2, 3, 5)
+
+
+def augment(mat: numpy.ndarray) -> list:
+    """写真によくある程度の揺らぎを加えた画像のリストを取得します。
+    """
+
+    height, width = mat.shape[:2]
+    mats = [mat, cv2.flip(mat, 1)]
+    for beta in (-40, 40):
+        mats.append(cv2.convertScaleAbs(mat, alpha=1, beta=beta))
+    mats.append(cv2.convertScaleAbs(mat, alpha=.7, beta=0))
+    mats.append(cv2.GaussianBlur(mat, (3, 3), 0))
+    for dx, dy in ((6, 0), (0, 6), (-6, -6)):
+        matrix = numpy.float32([[1, 0, dx], [0, 1, dy]])
+        mats.append(cv2.warpAffine(mat, matrix, (width, height),
+                                   borderMode=cv2.BORDER_REPLICATE))
+    for scale in (.85, 1.15):
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), 0, scale)
+        mats.append(cv2.warpAffine(mat, matrix, (width, height),
+                                   borderMode=cv2.BORDER_REPLICATE))
+    for angle in (-10, 10):
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1)
+        mats.append(cv2.warpAffine(mat, matrix, (width, height),
+                                   borderMode=cv2.BORDER_REPLICATE))
+    jpeg = cv2.imencode('.jpg', mat, [cv2.IMWRITE_JPEG_QUALITY, 30])[1]
+    mats.append(cv2.imdecode(jpeg, cv2.IMREAD_COLOR))
+    return mats
+
+
+def create_labeled_mats(tile_size: int) -> tuple:
+    """(顔のある画像のリスト, 顔のない画像のリスト) を取得します。
+    どちらもタイルの大きさに縮めてあります。
+    """
+
+    builder = image.create_mosaic_builder()
+    face_mats = []
+    non_face_mats = []
+    for path in FACE_PATHS:
+        mat = cv2.imread(path)
+        face_mats.extend(augment(mat))
+
+        # 顔が判別できないほどぼかした画像は、使える顔がないとみなします。
+        non_face_mats.append(cv2.GaussianBlur(mat, (0, 0), 8))
+    for path in NON_FACE_PATHS:
+        non_face_mats.extend(augment(cv2.imread(path)))
+
+    rng = numpy.random.default_rng(0)
+    shape = (tile_size, tile_size, 3)
+    non_face_mats.extend([
+        numpy.full(shape, 255, numpy.uint8),
+        numpy.full(shape, 40, numpy.uint8),
+        rng.integers(0, 256, shape, dtype=numpy.uint8),
+        cv2.GaussianBlur(rng.integers(0, 256, shape, dtype=numpy.uint8),
+                         (0, 0), 3),
+        numpy.repeat(numpy.repeat(
+            numpy.linspace(0, 255, tile_size, dtype=numpy.uint8)[
+                numpy.newaxis, :, numpy.newaxis],
+            tile_size, axis=0), 3, axis=2),
+    ])
+
+    fit = builder.fit_to_tile
+    return [fit(_) for _ in face_mats], [fit(_) for _ in non_face_mats]
+
+
+def get_reject_rate(face_prefilter: prefilter.FacePrefilter,
+                    mats: list) -> float:
+
+    return sum(face_prefilter.check(_) is not None for _ in mats) / len(mats)
+
+
+class MemoizedPrefilter(prefilter.FacePrefilter):
+    """同じ画像の判定結果を使い回す FacePrefilter です。
+    画像の種類は少ないため、大量の画像でもセットへの分け方を速く数えられます。
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.results = {}
+
+    def check(self, mat: numpy.ndarray) -> str:
+
+        key = mat.tobytes()
+        if key not in self.results:
+            self.results[key] = super().check(mat)
+        return self.results[key]
+
+
+def install_images(face_mats: list,
+                   non_face_mats: list,
+                   image_count: int,
+                   non_face_ratio: float) -> tuple:
+    """image_count 件の FaceImage を作り、その Blob のダウンロードを代役に差し替えます。
+    顔のない画像は non_face_ratio の割合で、ばらばらの位置に混ぜます。
+
+    Returns:
+        tuple: (FaceImage のリスト, 顔のある画像の id の set)。
+    """
+
+    non_face_count = round(image_count * non_face_ratio)
+    is_face_list = numpy.random.default_rng(0).permutation(
+        [True] * (image_count - non_face_count) + [False] * non_face_count)
+    mats = [face_mats[i % len(face_mats)] if is_face
+            else non_face_mats[i % len(non_face_mats)]
+            for i, is_face in enumerate(is_face_list)]
+
+    def download_mats(cls,
+                      container_and_blob_names: list,
+                      max_workers: int = None) -> list:
+        return [mats[int(blob_name.split('.')[0])]
+                for _, blob_name in container_and_blob_names]
+
+    blob_storage.BlobStorageClient.download_mats = classmethod(download_mats)
+
+    face_images = [image.FaceImage(i, f'/benchmark/{i}.png', 'benchmark')
+                   for i in range(image_count)]
+    face_ids = {i for i, is_face in enumerate(is_face_list) if is_face}
+    return face_images, face_ids
+
+
+def count_detect_calls(face_images: list,
+                       face_prefilter: prefilter.FacePrefilter) -> tuple:
+    """production_draft と同じく、連結画像1枚ぶんずつ分けてからセットにします。
+
+    Returns:
+        tuple: (detection の回数, prefilter で除いた FaceImage のリスト)。
+    """
+
+    builder = image.create_mosaic_builder()
+    prefilter.FacePrefilter._shared = face_prefilter
+    calls = 0
+    rejected_face_images = []
+    for face_image_set in image.iter_image_sets(
+            util.chunked(face_images, builder.capacity), builder):
+        if face_image_set.face_images:
+            calls += 1
+        rejected_face_images.extend(face_image_set.rejected_face_images)
+    return calls, rejected_face_images
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--non-face-ratio', type=float, default=.2)
+    parser.add_argument('--min-face-ratio', type=float, default=.25)
+    args = parser.parse_args()
+
+    # 除いた件数のログはセットごとに出るので抑えます。
+    logging.getLogger().setLevel(logging.ERROR)
+
+    builder = image.create_mosaic_builder()
+    capacity = builder.capacity
+    face_mats, non_face_mats = create_labeled_mats(builder.tile_size)
+    face_images, face_ids = install_images(
+        face_mats, non_face_mats, args.images, args.non_face_ratio)
+
+    # prefilter なしでは、すべての画像がタイルを使います。
+    baseline_calls, _ = count_detect_calls(face_images, None)
+
+    print(f'{len(face_mats)} face images, {len(non_face_mats)} non-face '
+          f'images, min_face_ratio={args.min_face_ratio}')
+    print(f'{args.images} images with {args.non_face_ratio:.0%} non-face, '
+          f'{capacity} tiles per detect call: '
+          f'{baseline_calls} calls without prefilter')
+    print(f'{"blur":>6}{"neighbors":>11}{"false reject":>14}'
+          f'{"non-face reject":>17}{"detect calls":>14}{"saved":>8}'
+          f'{"lost faces":>12}{"ms/image":>10}')
+    for min_blur_score in BLUR_SCORES:
+        for min_neighbors in MIN_NEIGHBORS:
+            face_prefilter = prefilter.FacePrefilter(
+                min_blur_score, min_neighbors, args.min_face_ratio)
+            started = time.perf_counter()
+            false_reject_rate = get_reject_rate(face_prefilter, face_mats)
+            non_face_reject_rate = get_reject_rate(
+                face_prefilter, non_face_mats)
+            ms_per_image = ((time.perf_counter() - started)
+                            / (len(face_mats) + len(non_face_mats)) * 1000)
+
+            # NOTE: 除いた画像はタイルを使わず、 detection にもまわりません。
+            # NOTE: 空いたタイルは後続の画像で埋めます。
+            calls, rejected_face_images = count_detect_calls(
+                face_images,
+                MemoizedPrefilter(min_blur_score,
+                                  min_neighbors,
+                                  args.min_face_ratio))
+            lost_faces = sum(_.id in face_ids for _ in rejected_face_images)
+            print(f'{min_blur_score:6}{min_neighbors:11}'
+                  f'{false_reject_rate:14.1%}{non_face_reject_rate:17.1%}'
+                  f'{calls:14}{baseline_calls - calls:8}'
+                  f'{lost_faces:12}{ms_per_image:10.2f}')
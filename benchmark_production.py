@@ -0,0 +1,334 @@
+"""Production load benchmark
+
+このスクリプトの目標。
+
+- production_draft._main を、本物の DB, Blob Storage, Face API なしで流す。
+- 1k, 10k, 100k 件の架空の HistoryFaceImage レコードで、件数あたりのスループットを出す。
+- 段階 (DB 取得, Blob ダウンロード, 連結, detect, identify, DB 更新) ごとの
+  レイテンシのパーセンタイルを出す。
+- Face API は face_api_stub.py の代役サーバー、 DB と Blob はメモリ上の代役を使う。
+
+使い方:
+    python benchmark_production.py --sizes 1000 10000 --face-api-latency-ms 150
+
+PIPELINE_ENABLED, ASYNC_ENABLED など production_draft の設定は環境変数のまま効きます。
+
+"""
+
+# Built-in modules.
+import argparse
+import functools
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+# .env がなくても動くよう、必須の環境変数にダミーを入れておきます。
+# NOTE: 接続先はすべて以下の代役に差し替えるため、値は使われません。
+for keyname in ('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY',
+                'PERSON_GROUP_ID',
+                'MYSQL_HOST',
+                'MYSQL_PASSWORD',
+                'MYSQL_USER',
+                'MYSQL_DATABASE',
+                'AZURE_STORAGE_CONNECTION_STRING'):
+    os.environ.setdefault(keyname, 'benchmark')
+# 流量制限は代役サーバー側のスロットリングで試すため、既定では外します。
+os.environ.setdefault('FACE_API_TRANSACTIONS_PER_SECOND', '0')
+
+# Third-party modules.
+import numpy  # noqa: E402
+
+# My modules.
+import const  # noqa: E402
+import blob_storage  # noqa: E402
+import db_client  # noqa: E402
+import face_api  # noqa: E402
+import image  # noqa: E402
+import metrics  # noqa: E402
+import production_draft  # noqa: E402
+import tile_pool  # noqa: E402
+from face_api_stub import FaceApiStubServer, StubConfig  # noqa: E402
+
+
+# 架空のレコードの画像に使う、手元の100x100画像です。
+IMAGE_PATHS = [
+    './100x100-dog.png',
+    './100x100-egc.png',
+    './100x100-egc2.png',
+    './100x100-kbt.png',
+    './100x100-ymzk.png',
+]
+
+# 段階ごとのレイテンシ (秒) です。
+stage_latencies = {}
+stage_latencies_lock = threading.Lock()
+
+
+def record_latency(stage: str, seconds: float) -> None:
+
+    with stage_latencies_lock:
+        stage_latencies.setdefault(stage, []).append(seconds)
+
+
+def timed(stage: str, func: callable) -> callable:
+    """func の実行時間を stage のレイテンシとして記録するようにします。
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_latency(stage, time.perf_counter() - started)
+    return wrapper
+
+
+def patch_timed(owner: type, name: str, stage: str) -> None:
+    """owner.name を、実行時間を記録する版に差し替えます。 classmethod にも対応します。
+    """
+
+    attribute = owner.__dict__[name]
+    if isinstance(attribute, classmethod):
+        setattr(owner, name, classmethod(timed(stage, attribute.__func__)))
+    else:
+        setattr(owner, name, timed(stage, attribute))
+
+
+class InMemoryMySqlClient:
+    """db_client.MySqlClient のメモリ上の代役です。
+    """
+
+    # id: レコード の dict です。
+    records = {}
+    lock = threading.Lock()
+    latency_seconds = .0
+
+    @classmethod
+    def reset(cls, records: list) -> None:
+
+        cls.records = {record['id']: record for record in records}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __wait(self) -> None:
+
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+
+    def __select(self, status: int) -> list:
+
+        return [
+            {key: record[key]
+             for key in ('id', 'createdAt', 'imagePath', 'faceApiPersonId')}
+            for record in self.records.values()
+            if record['recognitionStatus'] == status
+        ]
+
+    def find_waiting_images(self,
+                            limit: int = None,
+                            after: tuple = None) -> list:
+
+        self.__wait()
+        with self.lock:
+            records = self.__select(const.WORK_PROGRESS_STATUS['WAITING'])
+        if limit is None:
+            return records
+        records.sort(key=lambda _: (_['createdAt'], _['id']))
+        if after is not None:
+            records = [_ for _ in records
+                       if (_['createdAt'], _['id']) > after]
+        return records[:limit]
+
+    def claim_waiting_images(self, limit: int, after: tuple = None) -> list:
+
+        self.__wait()
+        with self.lock:
+            records = sorted(
+                self.__select(const.WORK_PROGRESS_STATUS['WAITING']),
+                key=lambda _: (_['createdAt'], _['id']))
+            if after is not None:
+                records = [_ for _ in records
+                           if (_['createdAt'], _['id']) > after]
+            records = records[:limit]
+            for record in records:
+                self.records[record['id']]['recognitionStatus'] = (
+                    const.WORK_PROGRESS_STATUS['WORKING'])
+            return records
+
+    def release_expired_claims(self, lease_seconds: int) -> int:
+
+        self.__wait()
+        return 0
+
+    def set_pending_status(self, history_face_image_ids: list) -> None:
+
+        self.__wait()
+        with self.lock:
+            for history_face_image_id in history_face_image_ids:
+                self.records[history_face_image_id]['recognitionStatus'] = (
+                    const.WORK_PROGRESS_STATUS['PENDING'])
+
+    def set_completed_status(self,
+                             matched: bool,
+                             candidate_person_id: str,
+                             candidate_confidence: float,
+                             history_face_image_id: int):
+
+        self.set_completed_statuses([(matched,
+                                      candidate_person_id,
+                                      candidate_confidence,
+                                      history_face_image_id)])
+
+    def set_completed_statuses(self,
+                               results: list,
+                               chunk_size: int = None) -> int:
+
+        chunk_size = chunk_size or const.DB_WRITE_CHUNK_SIZE
+        for i in range(0, len(results), chunk_size):
+            self.__wait()
+        with self.lock:
+            for matched, person_id, confidence, history_face_image_id \
+                    in results:
+                self.records[history_face_image_id].update({
+                    'recognitionStatus':
+                        const.WORK_PROGRESS_STATUS['COMPLETED'],
+                    'matched': matched,
+                    'candidatePersonId': person_id,
+                    'candidateConfidence': confidence,
+                })
+        return len(results)
+
+
+def create_records(count: int) -> list:
+    """架空の HistoryFaceImage レコードを作ります。
+    1% は personId のない無効なレコードにします。
+
+    Args:
+        count (int): 件数。
+
+    Returns:
+        list: レコードのリスト。
+    """
+
+    created_at = datetime(2020, 1, 1)
+    return [
+        {
+            'id': i,
+            'createdAt': created_at + timedelta(seconds=i),
+            'imagePath': f'/group{i % 5}/{i}.png',
+            'faceApiPersonId': None if i % 100 == 99 else f'person-{i % 50}',
+            'recognitionStatus': const.WORK_PROGRESS_STATUS['WAITING'],
+        }
+        for i in range(count)
+    ]
+
+
+def install_stand_ins(blob_latency_seconds: float,
+                      db_latency_seconds: float) -> None:
+    """DB と Blob Storage を代役に差し替え、各段階の計測を仕込みます。
+    """
+
+    # Blob は手元の画像のバイナリを返します。
+    image_bytes = []
+    for path in IMAGE_PATHS:
+        with open(path, 'rb') as f:
+            image_bytes.append(f.read())
+
+    def download_bytes(cls, container_name: str, blob_name: str) -> bytes:
+        if blob_latency_seconds > 0:
+            time.sleep(blob_latency_seconds)
+        number = int(blob_name.split('.')[0])
+        return image_bytes[number % len(image_bytes)]
+
+    blob_storage.BlobStorageClient.download_bytes = classmethod(
+        download_bytes)
+
+    # キャッシュを使わない場合は、借りたバッファに書き込みます。
+    def download_into(cls,
+                      container_name: str,
+                      blob_name: str,
+                      buffers: object) -> tuple:
+        downloaded_bytes = cls.download_bytes(container_name, blob_name)
+        buffer = buffers.acquire(len(downloaded_bytes))
+        buffer[:len(downloaded_bytes)] = downloaded_bytes
+        return buffer, len(downloaded_bytes)
+
+    blob_storage.BlobStorageClient.download_into = classmethod(download_into)
+
+    InMemoryMySqlClient.latency_seconds = db_latency_seconds
+    db_client.MySqlClient = InMemoryMySqlClient
+
+    patch_timed(InMemoryMySqlClient, 'find_waiting_images', 'db_fetch')
+    patch_timed(InMemoryMySqlClient, 'claim_waiting_images', 'db_fetch')
+    patch_timed(InMemoryMySqlClient, 'set_completed_statuses', 'db_update')
+    patch_timed(blob_storage.BlobStorageClient, 'download_bytes',
+                'blob_download')
+    patch_timed(image.FaceImageSet, 'concatenate_mat', 'mosaic')
+    patch_timed(face_api.FaceApiClient, 'detect', 'detect')
+    patch_timed(face_api.FaceApiClient, 'identify', 'identify')
+
+
+def print_report(count: int, wall_seconds: float, counts: dict) -> None:
+
+    print(f'--- {count} records: {wall_seconds:.2f}s, '
+          f'{count / wall_seconds:.1f} records/s')
+    print(f'    Face API: {counts}')
+    print(f'    {"stage":<16}{"calls":>8}'
+          f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for stage, latencies in stage_latencies.items():
+        p50, p95, p99, maximum = numpy.percentile(
+            numpy.array(latencies) * 1000, (50, 95, 99, 100))
+        print(f'    {stage:<16}{len(latencies):8}'
+              f'{p50:10.2f}{p95:10.2f}{p99:10.2f}{maximum:10.2f}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--face-api-latency-ms', type=float, default=100)
+    parser.add_argument('--face-api-latency-jitter-ms', type=float,
+                        default=50)
+    parser.add_argument('--face-api-throttle-tps', type=float, default=0)
+    parser.add_argument('--face-api-error-rate', type=float, default=0)
+    parser.add_argument('--blob-latency-ms', type=float, default=20)
+    parser.add_argument('--db-latency-ms', type=float, default=5)
+    args = parser.parse_args()
+
+    # production_draft のレコードごとのログは多すぎるので抑えます。
+    logging.getLogger().setLevel(logging.ERROR)
+
+    server = FaceApiStubServer(StubConfig(
+        latency_ms=args.face_api_latency_ms,
+        latency_jitter_ms=args.face_api_latency_jitter_ms,
+        throttle_tps=args.face_api_throttle_tps,
+        error_rate=args.face_api_error_rate,
+        tile_size=const.MOSAIC_TILE_SIZE))
+    server.start()
+    face_api.FaceApiClient.FACE_API_BASE_URL = server.base_url
+    install_stand_ins(args.blob_latency_ms / 1000, args.db_latency_ms / 1000)
+
+    try:
+        for count in args.sizes:
+            InMemoryMySqlClient.reset(create_records(count))
+            stage_latencies.clear()
+            metrics.Metrics.reset_shared()
+            for key in server.counts:
+                server.counts[key] = 0
+
+            started = time.perf_counter()
+            production_draft._main()
+            wall_seconds = time.perf_counter() - started
+
+            print_report(count, wall_seconds, dict(server.counts))
+    finally:
+        server.stop()
+        tile_pool.TileProcessPool.close_shared()
@@ -0,0 +1,134 @@
+"""Cold start benchmark
+
+このスクリプトの目標。
+
+- Azure Functions のコールドスタートで、何の読み込みに時間がかかっているかを知る。
+- モジュールごとの import 時間を、毎回新しいプロセスで測る。
+- production_draft の起動から最初の DB 問い合わせまでの時間を、
+  遅延読み込み (いまの production_draft) と一括読み込み (従来の import) で比べる。
+- DB には接続しない。 MySqlClient.__enter__ に来た時点で止める。
+
+使い方:
+    python benchmark_startup.py --repeat 5
+
+"""
+
+# Built-in modules.
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+
+# import 時間を測るモジュールです。
+MODULES = [
+    'const',
+    'util',
+    'metrics',
+    'db_client',
+    'numpy',
+    'cv2',
+    'requests',
+    'azure.storage.blob',
+    'mosaic',
+    'face_api',
+    'blob_storage',
+    'image',
+    'production_draft',
+]
+
+# 子プロセスで、 module の import 時間 (秒) を出力します。
+IMPORT_SCRIPT = '''
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+# 子プロセスで、起動から最初の DB 問い合わせまでの時間 (秒) を出力します。
+# eager なら従来どおり、重いモジュールと設定をすべて先に読み込みます。
+FIRST_QUERY_SCRIPT = '''
+import time
+started = time.perf_counter()
+
+import logging
+if {eager}:
+    import const
+    import blob_storage, detection_cache, face_api, image, tile_pool
+    for name in const._SETTINGS:
+        getattr(const, name)
+import db_client
+import production_draft
+logging.getLogger().setLevel(logging.ERROR)
+
+
+class FirstQuery(Exception):
+    pass
+
+
+def __enter__(self):
+    raise FirstQuery()
+
+
+db_client.MySqlClient.__enter__ = __enter__
+try:
+    production_draft._main()
+except FirstQuery:
+    print(time.perf_counter() - started)
+'''
+
+
+def get_environment() -> dict:
+    """子プロセスの環境変数です。 .env がなくても動くよう、必須の設定にダミーを入れます。
+    """
+
+    environment = dict(os.environ)
+    for keyname in ('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY',
+                    'PERSON_GROUP_ID',
+                    'MYSQL_HOST',
+                    'MYSQL_PASSWORD',
+                    'MYSQL_USER',
+                    'MYSQL_DATABASE',
+                    'AZURE_STORAGE_CONNECTION_STRING'):
+        environment.setdefault(keyname, 'benchmark')
+    return environment
+
+
+def run_seconds(script: str, repeat: int) -> float:
+    """script を新しいプロセスで repeat 回実行し、出力された秒数の中央値を返します。
+    """
+
+    samples = []
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-c', script],
+                                   cwd=os.path.dirname(
+                                       os.path.abspath(__file__)),
+                                   env=get_environment(),
+                                   stdout=subprocess.PIPE,
+                                   check=True)
+        samples.append(float(completed.stdout.decode().strip()))
+    return statistics.median(samples)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f'{"module":<24}{"import ms":>12}')
+    for module in MODULES:
+        seconds = run_seconds(IMPORT_SCRIPT.format(module=module),
+                              args.repeat)
+        print(f'{module:<24}{seconds * 1000:12.1f}')
+
+    eager_seconds = run_seconds(FIRST_QUERY_SCRIPT.format(eager=True),
+                                args.repeat)
+    lazy_seconds = run_seconds(FIRST_QUERY_SCRIPT.format(eager=False),
+                               args.repeat)
+    print()
+    print(f'{"time to first DB query":<24}{"ms":>12}')
+    print(f'{"eager":<24}{eager_seconds * 1000:12.1f}')
+    print(f'{"lazy":<24}{lazy_seconds * 1000:12.1f}')
+    print(f'{"reduction":<24}{(eager_seconds - lazy_seconds) * 1000:12.1f}')
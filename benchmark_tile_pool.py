@@ -0,0 +1,93 @@
+"""Tile process pool benchmark
+
+このスクリプトの目標。
+
+- デコード、連結、エンコードをワーカープロセスで行ったときの、1秒あたりの連結画像数を出す。
+- ワーカープロセス数を 1 からコア数まで変え、コア数に応じて伸びることを確かめる。
+- 比較のため、プロセスプールを使わない (このプロセス内で行う) 場合も出す。
+
+"""
+
+# Built-in modules.
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party modules.
+import numpy
+import cv2
+
+# My modules.
+import mosaic
+import tile_pool
+from face_api import ImageEncoding
+
+
+# 各設定で作る連結画像の数です。
+NUMBER = 40
+
+# 手元の100x100画像を繰り返して使います。
+IMAGE_PATHS = [
+    './100x100-dog.png',
+    './100x100-egc.png',
+    './100x100-egc2.png',
+    './100x100-kbt.png',
+    './100x100-ymzk.png',
+]
+
+
+def run_in_process(bytes_list: list, encoding: ImageEncoding) -> float:
+
+    builder = mosaic.MosaicBuilder()
+    started = time.perf_counter()
+    for _ in range(NUMBER):
+        mat_list = [
+            cv2.imdecode(numpy.frombuffer(_, numpy.uint8), cv2.IMREAD_COLOR)
+            for _ in bytes_list
+        ]
+        encoding.encode(builder.build(mat_list))
+    return NUMBER / (time.perf_counter() - started)
+
+
+def run_in_pool(bytes_list: list,
+                encoding: ImageEncoding,
+                processes: int) -> float:
+
+    pool = tile_pool.TileProcessPool(processes,
+                                     slots=len(bytes_list) * processes,
+                                     tile_size=100)
+
+    def build_one(_) -> bytes:
+        tiles = pool.decode(bytes_list, with_hash=False)
+        try:
+            return pool.build_and_encode(tiles, 8, 8, encoding)
+        finally:
+            pool.release(tiles)
+
+    try:
+        # ワーカーの起動を計測から除くため、1枚作っておきます。
+        build_one(None)
+
+        # NOTE: ワーカープロセスと同じ数のセットを同時に投げます。
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=processes) as executor:
+            list(executor.map(build_one, range(NUMBER)))
+        return NUMBER / (time.perf_counter() - started)
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+
+    image_bytes = []
+    for path in IMAGE_PATHS:
+        with open(path, 'rb') as f:
+            image_bytes.append(f.read())
+    bytes_list = [image_bytes[i % len(image_bytes)] for i in range(64)]
+    encoding = ImageEncoding.from_settings()
+
+    print(f'{"processes":<16}{"mosaics/s":>12}')
+    print(f'{"in process":<16}{run_in_process(bytes_list, encoding):12.1f}')
+    for processes in range(1, os.cpu_count() + 1):
+        mosaics_per_second = run_in_pool(bytes_list, encoding, processes)
+        print(f'{processes:<16}{mosaics_per_second:12.1f}')
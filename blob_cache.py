@@ -0,0 +1,365 @@
+
+# Built-in modules.
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class BlobCache:
+    """Blob のバイナリを (コンテナ名, Blob 名, ETag) をキーにキャッシュします。
+
+    メモリ上の LRU と、任意でディスク上の LRU の2段です。どちらも合計バイト数で上限を設けます。
+    ETag が変われば別のキーになるため、 Blob が上書きされても古い画像は返しません。
+    """
+
+    def __init__(self,
+                 memory_max_bytes: int,
+                 disk_dir: str = None,
+                 disk_max_bytes: int = 0):
+        """
+        Args:
+            memory_max_bytes (int): メモリ上に置くバイト数の上限。
+            disk_dir (str): ディスクキャッシュのディレクトリ。 None ならディスクは使いません。
+            disk_max_bytes (int): ディスク上に置くバイト数の上限。
+        """
+
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+
+        # キー: (コンテナ名, Blob 名, バイナリ) です。末尾ほど最近使ったものです。
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+
+        # (コンテナ名, Blob 名): この実行中に確かめた ETag です。
+        # NOTE: メモリにある Blob のぶんだけを持ち、メモリから追い出すときに消します。
+        self._fresh_etags = {}
+
+        # ファイル名: バイト数 です。末尾ほど最近使ったものです。
+        # NOTE: ETag を残す .etag ファイルも、 .bin と同じく上限に数えて追い出します。
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.__load_disk_index()
+
+        # 集計です。
+        self.counts = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'saved_bytes': 0,
+            'downloaded_bytes': 0,
+            'evictions': 0,
+        }
+
+    @staticmethod
+    def __get_key(container_name: str, blob_name: str, etag: str) -> str:
+
+        # NOTE: ETag は '"0x8D..."' のように引用符つきなので、そのままキーに含めます。
+        source = f'{container_name}/{blob_name}/{etag}'
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    @staticmethod
+    def __get_etag_key(container_name: str, blob_name: str) -> str:
+
+        source = f'{container_name}/{blob_name}'
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def __load_disk_index(self) -> None:
+        """ディスク上の既存のキャッシュを、更新日時の古い順に索引へ載せます。
+        """
+
+        entries = []
+        for file_name in os.listdir(self.disk_dir):
+            if not file_name.endswith(('.bin', '.etag')):
+                continue
+            stat = os.stat(os.path.join(self.disk_dir, file_name))
+            entries.append((stat.st_mtime, file_name, stat.st_size))
+        for _, file_name, size in sorted(entries):
+            self._disk[file_name] = size
+            self._disk_bytes += size
+
+    def get_etag(self, container_name: str, blob_name: str) -> str:
+        """この Blob について、最後にキャッシュした ETag を取得します。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+
+        Returns:
+            str: ETag。知らない Blob なら None です。
+        """
+
+        with self._lock:
+            etag = self._fresh_etags.get((container_name, blob_name))
+        if etag is not None or not self.disk_dir:
+            return etag
+
+        # 前回の実行でディスクに残した ETag を探します。
+        file_name = self.__get_etag_key(container_name, blob_name) + '.etag'
+        data = self.__read_disk_file(file_name)
+        return data.decode('utf-8') if data is not None else None
+
+    def get_fresh(self, container_name: str, blob_name: str) -> bytes:
+        """この実行中に ETag を確かめた Blob を、メモリから取得します。
+        確かめ直さずに使ってよいものだけを返します。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+
+        Returns:
+            bytes: バイナリ。確かめていないか、メモリになければ None です。
+        """
+
+        with self._lock:
+            etag = self._fresh_etags.get((container_name, blob_name))
+        if etag is None:
+            return None
+        return self.get(container_name, blob_name, etag)
+
+    def get(self, container_name: str, blob_name: str, etag: str) -> bytes:
+        """キャッシュからバイナリを取得します。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+            etag (str): ETag。
+
+        Returns:
+            bytes: バイナリ。キャッシュになければ None です。
+        """
+
+        found = self.lookup(container_name, blob_name, etag)
+        if found is None:
+            return None
+        self.record_hit(container_name, blob_name, etag, found)
+        return found[0]
+
+    def lookup(self, container_name: str, blob_name: str, etag: str) -> tuple:
+        """キャッシュからバイナリを探します。 get と違い、ヒットとして集計しません。
+        ETag が変わっていないか確かめてから使う場合に、 record_hit と組み合わせます。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+            etag (str): ETag。
+
+        Returns:
+            tuple: (バイナリ, 'memory' または 'disk')。キャッシュになければ None です。
+        """
+
+        key = self.__get_key(container_name, blob_name, etag)
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key][2], 'memory'
+
+        data = self.__read_disk_file(key + '.bin')
+        if data is None:
+            return None
+        return data, 'disk'
+
+    def record_hit(self,
+                   container_name: str,
+                   blob_name: str,
+                   etag: str,
+                   found: tuple) -> None:
+        """lookup で見つけたバイナリを使ったことを集計します。
+        ETag を確かめたものとして扱い、ディスクにあったものはメモリにも載せます。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+            etag (str): ETag。
+            found (tuple): lookup の戻り値。
+        """
+
+        data, source = found
+        key = self.__get_key(container_name, blob_name, etag)
+        with self._lock:
+            self.counts[f'{source}_hits'] += 1
+            self.counts['saved_bytes'] += len(data)
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._fresh_etags[(container_name, blob_name)] = etag
+            else:
+                self.__put_memory(key, container_name, blob_name, etag, data)
+
+    def put(self,
+            container_name: str,
+            blob_name: str,
+            etag: str,
+            data: bytes) -> None:
+        """バイナリをキャッシュします。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+            etag (str): ETag。
+            data (bytes): バイナリ。
+        """
+
+        key = self.__get_key(container_name, blob_name, etag)
+        with self._lock:
+            self.__put_memory(key, container_name, blob_name, etag, data)
+        if self.disk_dir and len(data) <= self.disk_max_bytes:
+            self.__write_disk_file(key + '.bin', data)
+            self.__write_disk_file(
+                self.__get_etag_key(container_name, blob_name) + '.etag',
+                etag.encode('utf-8'))
+
+    def record_miss(self, downloaded_bytes: int) -> None:
+        """キャッシュが使えずダウンロードしたことを集計します。
+
+        Args:
+            downloaded_bytes (int): ダウンロードしたバイト数。
+        """
+
+        with self._lock:
+            self.counts['misses'] += 1
+            self.counts['downloaded_bytes'] += downloaded_bytes
+
+    def __put_memory(self,
+                     key: str,
+                     container_name: str,
+                     blob_name: str,
+                     etag: str,
+                     data: bytes) -> None:
+        """メモリに載せ、上限を超えたぶんを古い順に追い出します。 self._lock の中で呼びます。
+        載せた Blob は、この実行中に ETag を確かめたものとして扱います。
+        """
+
+        if len(data) > self.memory_max_bytes:
+            return
+        self._fresh_etags[(container_name, blob_name)] = etag
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+
+        self._memory[key] = (container_name, blob_name, data)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_max_bytes:
+            evicted_key, (evicted_container_name, evicted_blob_name,
+                          evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.counts['evictions'] += 1
+
+            # NOTE: 同じ Blob の新しい ETag がメモリにあれば、そちらは残します。
+            names = (evicted_container_name, evicted_blob_name)
+            fresh_etag = self._fresh_etags.get(names)
+            if (fresh_etag is not None
+                    and self.__get_key(*names, fresh_etag) == evicted_key):
+                del self._fresh_etags[names]
+
+    def __read_disk_file(self, file_name: str) -> bytes:
+
+        if not self.disk_dir:
+            return None
+
+        path = os.path.join(self.disk_dir, file_name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # 最近使ったものとして扱います。次回起動時の索引の順序にも反映します。
+        os.utime(path)
+        with self._lock:
+            if file_name in self._disk:
+                self._disk.move_to_end(file_name)
+        return data
+
+    def __write_disk_file(self, file_name: str, data: bytes) -> None:
+
+        path = os.path.join(self.disk_dir, file_name)
+
+        # NOTE: 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換えます。
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+        evicted_file_names = []
+        with self._lock:
+            if file_name in self._disk:
+                self._disk_bytes -= self._disk.pop(file_name)
+            self._disk[file_name] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.disk_max_bytes:
+                evicted_file_name, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted_file_names.append(evicted_file_name)
+                self.counts['evictions'] += 1
+
+        for evicted_file_name in evicted_file_names:
+            try:
+                os.remove(os.path.join(self.disk_dir, evicted_file_name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        """ヒット数などの集計を取得します。
+
+        Returns:
+            dict: 集計。 hit_rate はメモリとディスクを合わせたヒット率です。
+        """
+
+        with self._lock:
+            counts = dict(self.counts)
+            counts['memory_bytes'] = self._memory_bytes
+            counts['disk_bytes'] = self._disk_bytes
+        hits = counts['memory_hits'] + counts['disk_hits']
+        total = hits + counts['misses']
+        counts['hit_rate'] = hits / total if total else .0
+        return counts
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    cache = BlobCache(memory_max_bytes=10)
+    cache.put('c', 'a', '"1"', b'12345')
+    cache.put('c', 'b', '"1"', b'67890')
+    assert cache.get('c', 'a', '"1"') == b'12345'
+    assert cache.get('c', 'a', '"2"') is None
+    assert cache.get_etag('c', 'a') == '"1"'
+
+    # 上限を超えると、最近使っていない b が追い出されます。
+    cache.put('c', 'd', '"1"', b'abc')
+    assert cache.get('c', 'b', '"1"') is None
+    assert cache.get('c', 'd', '"1"') == b'abc'
+    assert cache.stats()['memory_hits'] == 2
+    cache.record_miss(5)
+    assert cache.stats()['hit_rate'] == 2 / 3
+
+    # 確かめた ETag は、メモリから追い出すと消えます。
+    assert cache.get_fresh('c', 'a') == b'12345'
+    assert cache.get_fresh('c', 'b') is None
+    assert set(cache._fresh_etags) == {('c', 'a'), ('c', 'd')}
+
+    # lookup はヒットとして数えず、 record_hit で数えます。
+    hits = cache.stats()['memory_hits']
+    found = cache.lookup('c', 'd', '"1"')
+    assert found == (b'abc', 'memory')
+    assert cache.stats()['memory_hits'] == hits
+    cache.record_hit('c', 'd', '"1"', found)
+    assert cache.stats()['memory_hits'] == hits + 1
+
+    # .etag ファイルもディスクの上限に数え、古い順に追い出します。
+    with tempfile.TemporaryDirectory() as disk_dir:
+        cache = BlobCache(0, disk_dir, disk_max_bytes=30)
+        for name in 'abcde':
+            cache.put('c', name, '"1"', b'0123456789')
+        file_names = os.listdir(disk_dir)
+        assert sum(os.path.getsize(os.path.join(disk_dir, _))
+                   for _ in file_names) <= 30
+        assert cache.stats()['disk_bytes'] <= 30
+        assert cache.get_etag('c', 'e') == '"1"'
+        assert cache.get('c', 'e', '"1"') == b'0123456789'
+        assert cache.get_etag('c', 'a') is None
+        assert len(BlobCache(0, disk_dir, 30)._disk) == len(file_names)
@@ -0,0 +1,405 @@
+
+# Built-in modules.
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party modules.
+import numpy
+import cv2
+import requests
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+
+# My modules.
+import const
+import blob_cache
+import buffer_pool
+import image_decode
+import metrics
+
+
+class BlobTooLargeError(ValueError):
+    """Blob が BLOB_MAX_BYTES を超えているため、ダウンロードしなかったことを表します。
+    """
+
+
+class BlobStorageClient:
+
+    # 実行中ずっと使い回す BlobServiceClient です。
+    # NOTE: 64画像のセットごとに作り直すと、そのたびに接続を張り直すことになるため。
+    _blob_service_client = None
+    _lock = threading.Lock()
+
+    # ダウンロードした Blob のキャッシュです。
+    _cache = None
+    # キャッシュを使わない場合に、 Blob を受け取るバッファのプールです。
+    _buffer_pool = None
+    # 同じ Blob を同時にダウンロードしないためのロックです。
+    # NOTE: Blob ごとに作ると Blob の数だけ増え続けるため、決まった数を Blob 名で振り分けます。
+    _blob_locks = tuple(threading.Lock() for _ in range(64))
+
+    @classmethod
+    def get_blob_service_client(cls) -> BlobServiceClient:
+        """プロセス内で共有する BlobServiceClient を取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            BlobServiceClient: 共有の BlobServiceClient。
+        """
+
+        with cls._lock:
+            if cls._blob_service_client is None:
+                # 並行ダウンロードのワーカー数ぶん接続をプールしておきます。
+                # NOTE: requests の既定のプールサイズは10なので、それ以上のワーカーでは接続が使い捨てになります。
+                pool_size = max(const.BLOB_DOWNLOAD_MAX_WORKERS, 10)
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                # NOTE: 最初の GET は BLOB_FIRST_GET_BYTES だけ受け取ります。
+                # NOTE: その応答の大きさで BLOB_MAX_BYTES を超える Blob を断るため、
+                # NOTE: 大きすぎる Blob でも、本文はこのバイト数しか受け取りません。
+                cls._blob_service_client = (
+                    BlobServiceClient.from_connection_string(
+                        const.AZURE_STORAGE_CONNECTION_STRING,
+                        transport=RequestsTransport(session=session),
+                        max_single_get_size=const.BLOB_FIRST_GET_BYTES))
+            return cls._blob_service_client
+
+    @classmethod
+    def get_cache(cls) -> blob_cache.BlobCache:
+        """プロセス内で共有する Blob のキャッシュを取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            blob_cache.BlobCache: 共有のキャッシュ。無効にしている場合は None です。
+        """
+
+        with cls._lock:
+            if (cls._cache is None
+                    and (const.BLOB_CACHE_MEMORY_MAX_BYTES > 0
+                         or const.BLOB_CACHE_DIR)):
+                cls._cache = blob_cache.BlobCache(
+                    const.BLOB_CACHE_MEMORY_MAX_BYTES,
+                    const.BLOB_CACHE_DIR or None,
+                    const.BLOB_CACHE_DISK_MAX_BYTES)
+            return cls._cache
+
+    @classmethod
+    def get_buffer_pool(cls) -> buffer_pool.BufferPool:
+        """プロセス内で共有する、 Blob を受け取るバッファのプールを取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            buffer_pool.BufferPool: 共有のプール。無効にしている場合は None です。
+        """
+
+        with cls._lock:
+            if cls._buffer_pool is None and const.BLOB_BUFFER_POOL_ENABLED:
+                # NOTE: 同時に借りるのは並行ダウンロードのワーカー数ぶんだけです。
+                cls._buffer_pool = buffer_pool.BufferPool(
+                    const.BLOB_DOWNLOAD_MAX_WORKERS,
+                    const.BLOB_BUFFER_MAX_BYTES)
+            return cls._buffer_pool
+
+    @classmethod
+    def __get_blob_lock(cls,
+                        container_name: str,
+                        blob_name: str) -> threading.Lock:
+
+        index = hash((container_name, blob_name)) % len(cls._blob_locks)
+        return cls._blob_locks[index]
+
+    @classmethod
+    def download_bytes(cls, container_name: str, blob_name: str) -> bytes:
+        """Blob をダウンロードします。
+        キャッシュがあれば、この実行中に一度取得した Blob はダウンロードしません。
+        前回以前の実行でキャッシュした Blob は、 ETag が変わっていなければ本文を受け取りません。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+
+        Raises:
+            BlobTooLargeError: Blob が BLOB_MAX_BYTES を超えている。
+
+        Returns:
+            bytes: Blob の中身。
+        """
+
+        cache = cls.get_cache()
+        if cache is None:
+            return cls.__download(container_name, blob_name)[0]
+
+        # 同じ Blob を複数のスレッドで同時にダウンロードしないようにします。
+        with cls.__get_blob_lock(container_name, blob_name):
+
+            # この実行中に ETag を確かめた Blob は、キャッシュをそのまま使います。
+            cached_bytes = cache.get_fresh(container_name, blob_name)
+            if cached_bytes is not None:
+                return cached_bytes
+
+            # 前回以前の実行でキャッシュしていれば、変わっていないときだけ本文を省きます。
+            # NOTE: ヒットとして数えるのは、 304 で変わっていないとわかってからです。
+            etag = cache.get_etag(container_name, blob_name)
+            found = (cache.lookup(container_name, blob_name, etag)
+                     if etag is not None else None)
+            downloaded_bytes, etag = cls.__download(
+                container_name, blob_name,
+                etag if found is not None else None)
+
+            if downloaded_bytes is None:
+                # 304 Not Modified です。
+                cache.record_hit(container_name, blob_name, etag, found)
+                return found[0]
+            cache.record_miss(len(downloaded_bytes))
+            cache.put(container_name, blob_name, etag, downloaded_bytes)
+            return downloaded_bytes
+
+    @classmethod
+    def __download(cls,
+                   container_name: str,
+                   blob_name: str,
+                   etag: str = None) -> tuple:
+        """Blob をダウンロードします。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+            etag (str): 指定すると、 ETag が変わっていないとき本文を受け取りません。
+
+        Raises:
+            BlobTooLargeError: Blob が BLOB_MAX_BYTES を超えている。
+
+        Returns:
+            tuple: (Blob の中身, ETag)。変わっていなければ中身は None です。
+        """
+
+        blob_client = cls.get_blob_service_client().get_blob_client(
+            container=container_name, blob=blob_name)
+
+        kwargs = {}
+        if etag is not None:
+            kwargs = {
+                'etag': etag,
+                'match_condition': MatchConditions.IfModified,
+            }
+
+        # HACK: azure.core.pipeline.policies.http_logging_policy のログが多すぎてログが見づらい。抑制。  # noqa
+        # NOTE: キャッシュから返したぶんは含めず、通信した時間とバイト数だけを集計します。
+        shared_metrics = metrics.Metrics.get_shared()
+        with shared_metrics.time('blob_download'):
+            # NOTE: SDK は 304 を ResourceNotModifiedError のまま返しません。
+            # NOTE: x-ms-error-code によって HttpResponseError や
+            # NOTE: ResourceModifiedError に包み直すため、状態コードで見ます。
+            try:
+                downloader = blob_client.download_blob(**kwargs)
+            except HttpResponseError as e:
+                if etag is not None and e.status_code == 304:
+                    return None, etag
+                raise
+
+            cls.__check_size(downloader, container_name, blob_name)
+            downloaded_bytes = downloader.readall()
+        shared_metrics.add_bytes('blob_download', len(downloaded_bytes))
+        return downloaded_bytes, downloader.properties.etag
+
+    @staticmethod
+    def __check_size(downloader: object,
+                     container_name: str,
+                     blob_name: str) -> None:
+        """最初の応答 (BLOB_FIRST_GET_BYTES まで) の properties で大きさを確かめ、
+        大きすぎれば残りを受け取りません。
+        使うのは100x100のタイルだけなので、数 MB の写真は帯域とデコードの無駄です。
+
+        Raises:
+            BlobTooLargeError: Blob が BLOB_MAX_BYTES を超えている。
+        """
+
+        blob_size = downloader.properties.size
+        if 0 < const.BLOB_MAX_BYTES < blob_size:
+            metrics.Metrics.get_shared().add_bytes(
+                'blob_download_skipped', blob_size - const.BLOB_MAX_BYTES)
+            raise BlobTooLargeError(
+                f'{container_name}/{blob_name} is {blob_size} bytes, '
+                f'larger than {const.BLOB_MAX_BYTES} bytes.')
+
+    @classmethod
+    def download_into(cls,
+                      container_name: str,
+                      blob_name: str,
+                      buffers: buffer_pool.BufferPool) -> tuple:
+        """Blob を、プールから借りたバッファへチャンクごとにダウンロードします。
+        readall のように、 Blob 全体を BytesIO に集めてから bytes にコピーしません。
+        NOTE: 各チャンクの応答は SDK が bytes にするため、チャンクぶんの確保は残ります。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+            buffers (buffer_pool.BufferPool): バッファを借りるプール。
+
+        Raises:
+            BlobTooLargeError: Blob が BLOB_MAX_BYTES を超えている。
+
+        Returns:
+            tuple: (借りたバッファ, Blob の中身のバイト数)。
+                バッファは使い終わったら buffers.release で返却します。
+        """
+
+        blob_client = cls.get_blob_service_client().get_blob_client(
+            container=container_name, blob=blob_name)
+
+        shared_metrics = metrics.Metrics.get_shared()
+        with shared_metrics.time('blob_download'):
+            downloader = blob_client.download_blob()
+            cls.__check_size(downloader, container_name, blob_name)
+
+            # NOTE: properties の大きさぶんのバッファを借り、最初の GET (BLOB_FIRST_GET_BYTES) の
+            # NOTE: 中身と、続く GET のチャンクを順に書き込みます。
+            buffer = buffers.acquire(downloader.size)
+            try:
+                writer = buffer_pool.BufferWriter(buffer)
+                downloader.readinto(writer)
+            except BaseException:
+                buffers.release(buffer)
+                raise
+        shared_metrics.add_bytes('blob_download', writer.position)
+        return buffer, writer.position
+
+    @classmethod
+    def download_mat(cls,
+                     container_name: str,
+                     blob_name: str) -> numpy.ndarray:
+        """Blob の画像をダウンロードし mat 形式で取得します。
+
+        Args:
+            container_name (str): コンテナ名。
+            blob_name (str): Blob 名。
+
+        Returns:
+            numpy.ndarray: mat 形式の画像。
+                Blob が大きすぎるか、デコードできなければ None です。
+        """
+
+        # キャッシュを使わない場合は、使い回すバッファへ受け取ってそのままデコードします。
+        # NOTE: キャッシュには bytes で置くため、キャッシュを使う場合は従来どおりです。
+        # NOTE: 既定ではメモリキャッシュを使うので、この経路は通りません。
+        buffers = cls.get_buffer_pool()
+        if buffers is not None and cls.get_cache() is None:
+            try:
+                buffer, size = cls.download_into(
+                    container_name, blob_name, buffers)
+            except BlobTooLargeError as e:
+                logging.warning(f'大きすぎる画像なのでスキップしました。 {e}')
+                return None
+            try:
+                return cls.__decode(memoryview(buffer)[:size])
+            finally:
+                buffers.release(buffer)
+
+        downloaded_bytes = cls.__download_bytes_or_none(
+            container_name, blob_name)
+        if downloaded_bytes is None:
+            return None
+        return cls.__decode(downloaded_bytes)
+
+    @staticmethod
+    def __decode(bytes_image: object) -> numpy.ndarray:
+        """画像をデコードします。
+
+        Args:
+            bytes_image (object): 画像のバイナリ。 bytes でも memoryview でも大丈夫です。
+                memoryview ならコピーせずに読みます。
+
+        Returns:
+            numpy.ndarray: mat 形式の画像。デコードできなければ None です。
+        """
+
+        # タイルより十分大きい画像は、縮小しながらデコードします。
+        shared_metrics = metrics.Metrics.get_shared()
+        if const.REDUCED_DECODE_ENABLED:
+            with shared_metrics.time('decode'):
+                mat, saved_bytes = image_decode.decode_tile(
+                    bytes_image, const.MOSAIC_TILE_SIZE)
+            shared_metrics.add_bytes('decode_saved', saved_bytes)
+            return mat
+
+        downloaded_ndarray = numpy.frombuffer(bytes_image, numpy.uint8)
+        with shared_metrics.time('decode'):
+            return cv2.imdecode(downloaded_ndarray, cv2.IMREAD_COLOR)
+
+    @classmethod
+    def __download_bytes_or_none(cls,
+                                 container_name: str,
+                                 blob_name: str) -> bytes:
+        """download_bytes と同じですが、大きすぎる Blob は None にします。
+        """
+
+        try:
+            return cls.download_bytes(container_name, blob_name)
+        except BlobTooLargeError as e:
+            logging.warning(f'大きすぎる画像なのでスキップしました。 {e}')
+            return None
+
+    @classmethod
+    def download_mats(cls,
+                      container_and_blob_names: list,
+                      max_workers: int = None) -> list:
+        """複数の Blob の画像を並行にダウンロードし mat 形式で取得します。
+
+        Args:
+            container_and_blob_names (list): (コンテナ名, Blob 名) のリスト。
+            max_workers (int): 並行ダウンロード数。1なら逐次処理します。
+                省略時は const.BLOB_DOWNLOAD_MAX_WORKERS です。
+
+        Returns:
+            list: mat 形式の画像のリスト。順序は container_and_blob_names と同じです。
+        """
+
+        return cls.__map(cls.download_mat,
+                         container_and_blob_names,
+                         max_workers)
+
+    @classmethod
+    def download_bytes_list(cls,
+                            container_and_blob_names: list,
+                            max_workers: int = None) -> list:
+        """複数の Blob を並行にダウンロードします。デコードは呼び出し側で行います。
+
+        Args:
+            container_and_blob_names (list): (コンテナ名, Blob 名) のリスト。
+            max_workers (int): 並行ダウンロード数。1なら逐次処理します。
+                省略時は const.BLOB_DOWNLOAD_MAX_WORKERS です。
+
+        Returns:
+            list: Blob の中身のリスト。順序は container_and_blob_names と同じです。
+                大きすぎる Blob は None です。
+        """
+
+        return cls.__map(cls.__download_bytes_or_none,
+                         container_and_blob_names,
+                         max_workers)
+
+    @classmethod
+    def __map(cls,
+              func: callable,
+              container_and_blob_names: list,
+              max_workers: int = None) -> list:
+
+        if max_workers is None:
+            max_workers = const.BLOB_DOWNLOAD_MAX_WORKERS
+
+        if max_workers <= 1 or len(container_and_blob_names) <= 1:
+            return [func(container_name, blob_name)
+                    for container_name, blob_name in container_and_blob_names]
+
+        # NOTE: executor.map は完了順ではなく入力順で結果を返します。
+        # NOTE: そのためタイルの並び (8x8 の座標と FaceImage の対応) は崩れません。
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(
+                lambda names: func(*names),
+                container_and_blob_names))
@@ -0,0 +1,142 @@
+
+# Built-in modules.
+import threading
+
+
+class BufferPool:
+    """Blob のダウンロード先にする bytearray を使い回すプールです。
+
+    画像ごとに bytes を作らず、返却されたバッファに次の画像を書き込みます。
+    同時に使われるのは並行ダウンロード数ぶんだけなので、プールも小さく済みます。
+    """
+
+    # 確保するバッファの大きさの刻みです。少しずつ大きい画像で作り直さないためです。
+    GRANULARITY = 64 * 1024
+
+    def __init__(self, max_buffers: int, max_buffer_bytes: int):
+        """
+        Args:
+            max_buffers (int): 返却されたバッファを取っておく数の上限。
+            max_buffer_bytes (int): 取っておくバッファの大きさの上限。
+                これより大きいバッファはその場かぎりで使い、取っておきません。
+        """
+
+        self.max_buffers = max_buffers
+        self.max_buffer_bytes = max_buffer_bytes
+        self._lock = threading.Lock()
+
+        # 返却されたバッファです。小さい順に並べます。
+        self._free_buffers = []
+
+        self.counts = {
+            'allocations': 0,
+            'allocated_bytes': 0,
+            'reuses': 0,
+        }
+
+    def acquire(self, size: int) -> bytearray:
+        """size バイト以上のバッファを借ります。
+
+        Args:
+            size (int): 必要なバイト数。
+
+        Returns:
+            bytearray: バッファ。 size より大きいこともあります。
+        """
+
+        granularity = self.GRANULARITY
+        buffer_size = max(-(-size // granularity), 1) * granularity
+        with self._lock:
+            for i, buffer in enumerate(self._free_buffers):
+                if len(buffer) >= size:
+                    self.counts['reuses'] += 1
+                    return self._free_buffers.pop(i)
+            self.counts['allocations'] += 1
+            self.counts['allocated_bytes'] += buffer_size
+
+        # NOTE: ロックの外で確保します。 bytearray は 0 で埋めるため大きいと時間がかかります。
+        return bytearray(buffer_size)
+
+    def release(self, buffer: bytearray) -> None:
+        """借りたバッファを返却します。
+
+        Args:
+            buffer (bytearray): acquire で借りたバッファ。
+        """
+
+        if len(buffer) > self.max_buffer_bytes:
+            return
+        with self._lock:
+            self._free_buffers.append(buffer)
+            self._free_buffers.sort(key=len)
+
+            # 多すぎるぶんは小さいものから手放します。大きいものほど作り直しが高くつくためです。
+            del self._free_buffers[:-self.max_buffers or None]
+
+    def stats(self) -> dict:
+        """確保と再利用の回数を取得します。
+
+        Returns:
+            dict: 集計。 free_bytes は取っておいているバッファの合計です。
+        """
+
+        with self._lock:
+            counts = dict(self.counts)
+            counts['free_bytes'] = sum(map(len, self._free_buffers))
+        return counts
+
+
+class BufferWriter:
+    """bytearray に先頭から書き込む、書き込み専用のストリームです。
+    StorageStreamDownloader.readinto に渡し、 Blob の中身をバッファへ直接受け取ります。
+    """
+
+    def __init__(self, buffer: bytearray):
+        self._view = memoryview(buffer)
+        self.position = 0
+
+    def write(self, data: bytes) -> int:
+
+        size = len(data)
+        self._view[self.position:self.position + size] = data
+        self.position += size
+        return size
+
+    def getbuffer(self) -> memoryview:
+        """書き込んだ範囲を、コピーせずに取得します。
+
+        Returns:
+            memoryview: 書き込んだ範囲の view。
+        """
+
+        return self._view[:self.position]
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    pool = BufferPool(max_buffers=2, max_buffer_bytes=1024 * 1024)
+    buffer = pool.acquire(100)
+    assert len(buffer) == BufferPool.GRANULARITY
+
+    writer = BufferWriter(buffer)
+    writer.write(b'abc')
+    writer.write(b'de')
+    assert bytes(writer.getbuffer()) == b'abcde'
+    pool.release(buffer)
+
+    # 返却したバッファを使い回します。
+    assert pool.acquire(200) is buffer
+    pool.release(buffer)
+    assert pool.stats() == {
+        'allocations': 1,
+        'allocated_bytes': len(buffer),
+        'reuses': 1,
+        'free_bytes': len(buffer),
+    }
+
+    # 上限より大きいバッファや、上限の数を超えたぶんは取っておきません。
+    pool.release(pool.acquire(2 * 1024 * 1024))
+    for size in (1, 100000, 200000):
+        pool.release(bytearray(size))
+    assert [len(_) for _ in pool._free_buffers] == [100000, 200000]
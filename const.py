@@ -2,13 +2,24 @@
 # Built-in modules.
 import os
 
-# Third-party modules.
-import dotenv
+# .env を読み込んだかどうかです。
+_dotenv_loaded = False
 
 
-# .env で環境変数を取得する場合に対応します。
-# NOTE: raise_error_if_not_found: .env が見つからなくてもエラーを起こさない。
-dotenv.load_dotenv(dotenv.find_dotenv(raise_error_if_not_found=False))
+def _load_dotenv() -> None:
+    """.env で環境変数を取得する場合に対応します。
+    最初に定数を参照したときに1回だけ読み込みます。
+    """
+    global _dotenv_loaded
+    if _dotenv_loaded:
+        return
+
+    # Third-party modules.
+    import dotenv
+
+    # NOTE: raise_error_if_not_found: .env が見つからなくてもエラーを起こさない。
+    dotenv.load_dotenv(dotenv.find_dotenv(raise_error_if_not_found=False))
+    _dotenv_loaded = True
 
 
 def _get_env(keyname: str) -> str:
@@ -30,15 +41,216 @@ def _get_env(keyname: str) -> str:
     return _
 
 
+def _get_optional_env(keyname: str, default: str) -> str:
+    """省略可能な環境変数を取得します。
+
+    Arguments:
+        keyname {str} -- 環境変数名。
+        default {str} -- 未設定または空欄のときの値。
+
+    Returns:
+        str -- 環境変数の値。
+    """
+    return os.environ.get(keyname) or default
+
+
 # 環境変数から取得する定数です。
-AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY = _get_env(
-    'AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY')
-PERSON_GROUP_ID = _get_env('PERSON_GROUP_ID')
-MYSQL_HOST = _get_env('MYSQL_HOST')
-MYSQL_PASSWORD = _get_env('MYSQL_PASSWORD')
-MYSQL_USER = _get_env('MYSQL_USER')
-MYSQL_DATABASE = _get_env('MYSQL_DATABASE')
-AZURE_STORAGE_CONNECTION_STRING = _get_env('AZURE_STORAGE_CONNECTION_STRING')
+# NOTE: import 時には読み込みません。初めて参照されたときに __getattr__ が読み込みます。
+# NOTE: 定数名: 値を求める関数 です。
+_SETTINGS = {
+    'AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY': lambda: _get_env(
+        'AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY'),
+    'PERSON_GROUP_ID': lambda: _get_env('PERSON_GROUP_ID'),
+    'MYSQL_HOST': lambda: _get_env('MYSQL_HOST'),
+    'MYSQL_PASSWORD': lambda: _get_env('MYSQL_PASSWORD'),
+    'MYSQL_USER': lambda: _get_env('MYSQL_USER'),
+    'MYSQL_DATABASE': lambda: _get_env('MYSQL_DATABASE'),
+    'AZURE_STORAGE_CONNECTION_STRING': lambda: _get_env(
+        'AZURE_STORAGE_CONNECTION_STRING'),
+
+    # 環境変数から取得する、省略可能な設定値です。
+    # Blob の並行ダウンロード数です。1なら逐次ダウンロードします。
+    'BLOB_DOWNLOAD_MAX_WORKERS': lambda: int(
+        _get_optional_env('BLOB_DOWNLOAD_MAX_WORKERS', '8')),
+    # 連結画像のタイル配置 (縦, 横) と、タイル1辺のピクセル数です。
+    # NOTE: 縦 x 横は Detection API が1回で返す顔の最大数 (100) 以下にします。
+    'MOSAIC_ROWS': lambda: int(_get_optional_env('MOSAIC_ROWS', '8')),
+    'MOSAIC_COLS': lambda: int(_get_optional_env('MOSAIC_COLS', '8')),
+    'MOSAIC_TILE_SIZE': lambda: int(
+        _get_optional_env('MOSAIC_TILE_SIZE', '100')),
+    # Detection API に送る画像のエンコード設定です。 png または jpeg です。
+    'DETECT_IMAGE_FORMAT': lambda: _get_optional_env(
+        'DETECT_IMAGE_FORMAT', 'png'),
+    'DETECT_JPEG_QUALITY': lambda: int(
+        _get_optional_env('DETECT_JPEG_QUALITY', '95')),
+    # PNG の圧縮レベル (0-9) です。空欄なら OpenCV の既定値です。
+    'DETECT_PNG_COMPRESSION': lambda: (
+        int(os.environ['DETECT_PNG_COMPRESSION'])
+        if os.environ.get('DETECT_PNG_COMPRESSION') else None),
+    # 1 ならグレースケールで送ります。
+    'DETECT_GRAYSCALE': lambda: _get_optional_env(
+        'DETECT_GRAYSCALE', '0') == '1',
+    # Face API のエンドポイントです。負荷試験では face_api_stub.py の URL を指定します。
+    'FACE_API_BASE_URL': lambda: _get_optional_env(
+        'FACE_API_BASE_URL',
+        'https://japaneast.api.cognitive.microsoft.com/face/v1.0'),
+    # Face API の1秒あたりのトランザクション数の上限です。0以下なら制限しません。
+    'FACE_API_TRANSACTIONS_PER_SECOND': lambda: float(
+        _get_optional_env('FACE_API_TRANSACTIONS_PER_SECOND', '10')),
+    # Face API への keep-alive 接続のプールサイズです。
+    'FACE_API_POOL_SIZE': lambda: int(
+        _get_optional_env('FACE_API_POOL_SIZE', '10')),
+    # Face API の 429, 5xx, 接続エラー時のリトライ回数と、バックオフの初期秒数です。
+    'FACE_API_MAX_RETRIES': lambda: int(
+        _get_optional_env('FACE_API_MAX_RETRIES', '5')),
+    'FACE_API_BACKOFF_SECONDS': lambda: float(
+        _get_optional_env('FACE_API_BACKOFF_SECONDS', '1')),
+    # Face API のタイムアウト秒数です。
+    'FACE_API_TIMEOUT_SECONDS': lambda: float(
+        _get_optional_env('FACE_API_TIMEOUT_SECONDS', '30')),
+    # AsyncFaceApiClient が同時に投げる Face API 呼び出しの上限です。
+    'FACE_API_MAX_CONCURRENCY': lambda: int(
+        _get_optional_env('FACE_API_MAX_CONCURRENCY', '8')),
+    # MySQL のコネクションプールのサイズです。0 なら with MySqlClient() のたびに接続します。
+    'MYSQL_POOL_SIZE': lambda: int(_get_optional_env('MYSQL_POOL_SIZE', '5')),
+    # プールに空きがないとき、空くまで待つ秒数です。
+    'MYSQL_POOL_TIMEOUT_SECONDS': lambda: float(
+        _get_optional_env('MYSQL_POOL_TIMEOUT_SECONDS', '30')),
+    # 1回に WORKING にして取得する未処理レコードの件数です。
+    # 0 なら従来どおり、 WAITING のレコードを全件そのまま取得します。
+    # NOTE: SKIP LOCKED (MySQL 8.0 以上) を使うため、既定では使いません。
+    'CLAIM_BATCH_SIZE': lambda: int(
+        _get_optional_env('CLAIM_BATCH_SIZE', '0')),
+    # WORKING のままこの秒数を過ぎたレコードは、落ちたワーカーのものとみなし WAITING に戻します。
+    'CLAIM_LEASE_SECONDS': lambda: int(
+        _get_optional_env('CLAIM_LEASE_SECONDS', '1800')),
+    # HistoryFaceImage の結果を一括更新するとき、1回の UPDATE で書き込む件数です。
+    'DB_WRITE_CHUNK_SIZE': lambda: int(
+        _get_optional_env('DB_WRITE_CHUNK_SIZE', '500')),
+    # 1 なら production_draft を asyncio で実行し、各セットの detect と identify を並行に投げます。
+    'ASYNC_ENABLED': lambda: _get_optional_env('ASYNC_ENABLED', '0') == '1',
+    # asyncio で実行するとき、同時に処理する FaceImageSet の数です。
+    'ASYNC_MAX_SETS_IN_FLIGHT': lambda: int(
+        _get_optional_env('ASYNC_MAX_SETS_IN_FLIGHT', '4')),
+    # ダウンロードした Blob のキャッシュです。メモリ上に置くバイト数の上限 (0 なら使わない)、
+    # ディスクキャッシュのディレクトリ (空欄なら使わない)、ディスク上に置くバイト数の上限です。
+    'BLOB_CACHE_MEMORY_MAX_BYTES': lambda: int(
+        _get_optional_env('BLOB_CACHE_MEMORY_MAX_BYTES',
+                          str(128 * 1024 * 1024))),
+    'BLOB_CACHE_DIR': lambda: _get_optional_env('BLOB_CACHE_DIR', ''),
+    'BLOB_CACHE_DISK_MAX_BYTES': lambda: int(
+        _get_optional_env('BLOB_CACHE_DISK_MAX_BYTES',
+                          str(1024 * 1024 * 1024))),
+    # これより大きい Blob はダウンロードしません (0 なら無制限)。そのレコードは PENDING にします。
+    'BLOB_MAX_BYTES': lambda: int(
+        _get_optional_env('BLOB_MAX_BYTES', str(20 * 1024 * 1024))),
+    # Blob の最初の GET で受け取るバイト数です。 BLOB_MAX_BYTES はこの応答で確かめます。
+    # これより大きい Blob は、残りを続く GET で受け取ります。
+    'BLOB_FIRST_GET_BYTES': lambda: int(
+        _get_optional_env('BLOB_FIRST_GET_BYTES', str(64 * 1024))),
+    # 1 ならタイルより十分大きい画像を、縮小しながら (IMREAD_REDUCED_COLOR_2/4/8) デコードします。
+    'REDUCED_DECODE_ENABLED': lambda: _get_optional_env(
+        'REDUCED_DECODE_ENABLED', '1') == '1',
+    # 1 なら Blob のキャッシュを使わないとき、 Blob を使い回すバッファへ直接受け取ります。
+    # NOTE: 既定ではキャッシュを使うため、 BLOB_CACHE_MEMORY_MAX_BYTES=0 にしたときだけ効きます。
+    # 取っておくバッファの大きさの上限です。
+    'BLOB_BUFFER_POOL_ENABLED': lambda: _get_optional_env(
+        'BLOB_BUFFER_POOL_ENABLED', '1') == '1',
+    'BLOB_BUFFER_MAX_BYTES': lambda: int(
+        _get_optional_env('BLOB_BUFFER_MAX_BYTES', str(4 * 1024 * 1024))),
+    # 同じ内容の画像の detection を省くキャッシュです。1 なら使います。
+    # NOTE: 中身が同じでも別の写真の faceId を使い回すため、既定では使いません。
+    # faceId を使い回す秒数 (24時間より短く)、メモリ上の件数の上限、 SQLite ファイルのパス (空欄ならメモリのみ) です。
+    'DETECTION_CACHE_ENABLED': lambda: _get_optional_env(
+        'DETECTION_CACHE_ENABLED', '0') == '1',
+    'DETECTION_CACHE_TTL_SECONDS': lambda: float(
+        _get_optional_env('DETECTION_CACHE_TTL_SECONDS', str(23 * 60 * 60))),
+    'DETECTION_CACHE_MAX_ENTRIES': lambda: int(
+        _get_optional_env('DETECTION_CACHE_MAX_ENTRIES', '100000')),
+    'DETECTION_CACHE_PATH': lambda: _get_optional_env(
+        'DETECTION_CACHE_PATH', ''),
+    # 1 なら画像のデコード、連結、エンコードをワーカープロセスで行います。
+    # ワーカープロセス数 (0 ならコア数) と、共有メモリに置けるタイルの枚数です。
+    'PROCESS_POOL_ENABLED': lambda: _get_optional_env(
+        'PROCESS_POOL_ENABLED', '0') == '1',
+    'PROCESS_POOL_SIZE': lambda: int(
+        _get_optional_env('PROCESS_POOL_SIZE', '0')),
+    'PROCESS_POOL_TILE_SLOTS': lambda: int(
+        _get_optional_env('PROCESS_POOL_TILE_SLOTS', '1024')),
+    # 段階ごとの所要時間や Face API のトランザクション数の出力先です。空欄なら出力しません。
+    # Prometheus のテキスト形式 (node_exporter の textfile collector 用) と、
+    # 実行結果の JSON です。
+    'METRICS_PROMETHEUS_PATH': lambda: _get_optional_env(
+        'METRICS_PROMETHEUS_PATH', ''),
+    'METRICS_JSON_PATH': lambda: _get_optional_env('METRICS_JSON_PATH', ''),
+    # CPU とメモリの計測結果 (cProfile, tracemalloc) の出力先ディレクトリです。空欄なら計測しません。
+    'PROFILE_DIR': lambda: _get_optional_env('PROFILE_DIR', ''),
+    # 1 なら production_draft はレコードをセットごとに流し、セットごとに結果を DB に書き込みます。
+    # すべての結果をためないため、件数が多くてもメモリの使用量は増えません。
+    'STREAMING_ENABLED': lambda: _get_optional_env(
+        'STREAMING_ENABLED', '0') == '1',
+    # STREAMING_ENABLED のとき、1回に取得する未処理レコードの件数です。
+    # NOTE: CLAIM_BATCH_SIZE を指定していれば、そちらの件数ずつ取得します。
+    'STREAMING_FETCH_SIZE': lambda: int(
+        _get_optional_env('STREAMING_FETCH_SIZE', '10000')),
+    # 1 なら画像を PersonGroup ごとにまとめてから、連結画像1枚ぶんずつのセットに分けます。
+    'PACK_BY_PERSON_GROUP_ENABLED': lambda: _get_optional_env(
+        'PACK_BY_PERSON_GROUP_ENABLED', '0') == '1',
+    # 1 なら identification をセットごとでなく、 PersonGroup ごとに faceId が10件そろってから行います。
+    # 端数の faceId を待たせる秒数の上限です。
+    # NOTE: セットを1つずつ順に処理する場合だけ使います。 ASYNC_ENABLED, PIPELINE_ENABLED では無視します。
+    'IDENTIFY_BATCH_ENABLED': lambda: _get_optional_env(
+        'IDENTIFY_BATCH_ENABLED', '0') == '1',
+    'IDENTIFY_BATCH_MAX_WAIT_SECONDS': lambda: float(
+        _get_optional_env('IDENTIFY_BATCH_MAX_WAIT_SECONDS', '60')),
+    # 1 なら連結する前に手元の CPU で画像を判定し、使える顔のなさそうな画像を PENDING にします。
+    # ぼけ具合 (ラプラシアンの分散) の下限、 Haar cascade の minNeighbors、
+    # 探す顔の最小の大きさ (タイルの1辺に対する比) です。
+    'PREFILTER_ENABLED': lambda: _get_optional_env(
+        'PREFILTER_ENABLED', '0') == '1',
+    'PREFILTER_MIN_BLUR_SCORE': lambda: float(
+        _get_optional_env('PREFILTER_MIN_BLUR_SCORE', '2')),
+    'PREFILTER_MIN_NEIGHBORS': lambda: int(
+        _get_optional_env('PREFILTER_MIN_NEIGHBORS', '2')),
+    'PREFILTER_MIN_FACE_RATIO': lambda: float(
+        _get_optional_env('PREFILTER_MIN_FACE_RATIO', '0.25')),
+    # 1 なら production_draft をパイプライン (段階ごとに並行) で実行します。
+    'PIPELINE_ENABLED': lambda: _get_optional_env(
+        'PIPELINE_ENABLED', '0') == '1',
+    # パイプラインの段階間キューに置ける FaceImageSet の数です。
+    'PIPELINE_QUEUE_SIZE': lambda: int(
+        _get_optional_env('PIPELINE_QUEUE_SIZE', '2')),
+    # パイプライン内で同時に保持できる、デコード済み mat の上限枚数です。
+    'PIPELINE_MAX_MATS_IN_FLIGHT': lambda: int(
+        _get_optional_env('PIPELINE_MAX_MATS_IN_FLIGHT', '256')),
+}
+
+
+def __getattr__(name: str) -> object:
+    """環境変数から取得する定数を、初めて参照されたときに読み込みます。 (PEP 562)
+    2回目からは、モジュールの属性として読み込み済みの値を返します。
+
+    Arguments:
+        name {str} -- 定数名。
+
+    Raises:
+        AttributeError: 定数が存在しない。
+        KeyError: 必須の環境変数が見つからない。
+
+    Returns:
+        object -- 定数の値。
+    """
+    if name not in _SETTINGS:
+        raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+    _load_dotenv()
+    value = _SETTINGS[name]()
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_SETTINGS))
+
 
 # HistoryFaceImage.recognitionStatus の値です。
 WORK_PROGRESS_STATUS = {
@@ -49,9 +261,9 @@ WORK_PROGRESS_STATUS = {
 }
 
 if __name__ == '__main__':
-    print(AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY)
-    print(PERSON_GROUP_ID)
-    print(MYSQL_HOST)
-    print(MYSQL_PASSWORD)
-    print(MYSQL_USER)
-    print(MYSQL_DATABASE)
+    print(__getattr__('AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY'))
+    print(__getattr__('PERSON_GROUP_ID'))
+    print(__getattr__('MYSQL_HOST'))
+    print(__getattr__('MYSQL_PASSWORD'))
+    print(__getattr__('MYSQL_USER'))
+    print(__getattr__('MYSQL_DATABASE'))
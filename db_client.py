@@ -1,6 +1,12 @@
 
+# Built-in modules.
+import logging
+import threading
+import time
+
 # Third-party modules.
 import mysql.connector
+import mysql.connector.pooling
 
 # My modules.
 import const
@@ -9,26 +15,116 @@ import util
 
 class MySqlClient:
 
+    # プロセス内で共有するコネクションプールです。
+    # NOTE: with MySqlClient() のたびに接続を張り直さないようにするためです。
+    _pool = None
+    _pool_lock = threading.Lock()
+
     def __enter__(self):
-        mysql_connection_config = {
+        if const.MYSQL_POOL_SIZE > 0:
+            self.connection = self.__get_pooled_connection()
+        else:
+            self.connection = mysql.connector.connect(
+                **self.__get_connection_config())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # NOTE: プールの接続は close で切断されず、プールに返却されます。
+        self.connection.close()
+
+    @staticmethod
+    def __get_connection_config() -> dict:
+
+        return {
             'host': const.MYSQL_HOST,
             'user': const.MYSQL_USER,
             'password': const.MYSQL_PASSWORD,
             'database': const.MYSQL_DATABASE,
         }
-        self.connection = mysql.connector.connect(**mysql_connection_config)
-        return self
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.connection.close()
+    @classmethod
+    def get_pool(cls) -> mysql.connector.pooling.MySQLConnectionPool:
+        """プロセス内で共有するコネクションプールを取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            mysql.connector.pooling.MySQLConnectionPool: 共有のプール。
+        """
+
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = mysql.connector.pooling.MySQLConnectionPool(
+                    pool_name='history_face_image',
+                    pool_size=const.MYSQL_POOL_SIZE,
+                    **cls.__get_connection_config())
+            return cls._pool
 
-    def find_waiting_images(self) -> list:
+    @classmethod
+    def __get_pooled_connection(cls) -> object:
+        """プールから接続を借ります。
+        空きがなければ const.MYSQL_POOL_TIMEOUT_SECONDS 秒まで待ちます。
+
+        Raises:
+            mysql.connector.errors.PoolError: 待っても空きができなかった。
+
+        Returns:
+            PooledMySQLConnection: 借りた接続。
+        """
+
+        pool = cls.get_pool()
+        deadline = time.monotonic() + const.MYSQL_POOL_TIMEOUT_SECONDS
+        while True:
+            try:
+                connection = pool.get_connection()
+                break
+            except mysql.connector.errors.PoolError:
+                # NOTE: MySQLConnectionPool は空きがないと待たずに例外を投げます。
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(.05)
+
+        # 借りた接続が生きているか確かめ、切れていたらつなぎ直します。
+        # NOTE: 長くプールに置かれた接続は MySQL の wait_timeout で切られていることがあります。
+        try:
+            connection.ping(reconnect=True, attempts=3, delay=1)
+        except mysql.connector.Error:
+            # つなぎ直せなくても、枠はプールに返却しておきます。
+            try:
+                connection.close()
+            except mysql.connector.Error:
+                pass
+            raise
+        return connection
+
+    def find_waiting_images(self,
+                            limit: int = None,
+                            after: tuple = None) -> list:
         """未処理のレコードを HistoryFaceImage から取得します。
+        limit を指定すると、 (createdAt, id) 順に最大 limit 件ずつ取得します。
+        claim_waiting_images と違い、 WORKING にはしません。
+
+        Args:
+            limit (int): 取得する最大件数。省略時は全件です。
+            after (tuple): 前回取得した最後のレコードの (createdAt, id)。
+                この続きから取得します。 limit を指定したときだけ使います。
 
         Returns:
             list: HistoryFaceImage のレコード。
         """
 
+        placeholder_values = [const.WORK_PROGRESS_STATUS['WAITING']]
+        keyset_condition = ''
+        order_and_limit = ''
+        if limit is not None:
+            if after is not None:
+                keyset_condition = ('AND (historyfaceimage.createdAt > %s'
+                                    ' OR (historyfaceimage.createdAt = %s'
+                                    ' AND historyfaceimage.id > %s))')
+                placeholder_values.extend((after[0], after[0], after[1]))
+            order_and_limit = ('ORDER BY historyfaceimage.createdAt,'
+                               ' historyfaceimage.id LIMIT %s')
+            placeholder_values.append(limit)
+
         select_sql = ' '.join([
             'SELECT',
                 'historyfaceimage.id,',  # noqa: E131
@@ -40,14 +136,136 @@ class MySqlClient:
                 'ON historyfaceimage.historyFaceDataId = facedata.id',
             'WHERE',
                 'recognitionStatus = %s',
+                keyset_condition,
+            order_and_limit,
         ])
         cursor = self.connection.cursor(dictionary=True)
-        cursor.execute(select_sql, (const.WORK_PROGRESS_STATUS['WAITING'],))
+        cursor.execute(select_sql, tuple(placeholder_values))
         records = cursor.fetchall()
         cursor.close()
 
         return records
 
+    def claim_waiting_images(self,
+                             limit: int,
+                             after: tuple = None) -> list:
+        """未処理のレコードを最大 limit 件、 WORKING にして取得します。
+        複数のワーカーが同時に呼んでも、同じレコードを取得することはありません。
+
+        NOTE: SELECT ... FOR UPDATE SKIP LOCKED を使うため MySQL 8.0 以上が必要です。
+
+        Args:
+            limit (int): 取得する最大件数。
+            after (tuple): 前回取得した最後のレコードの (createdAt, id)。
+                この続きから (createdAt, id) 順に取得します。
+
+        Returns:
+            list: HistoryFaceImage のレコード。 (createdAt, id) 順です。
+        """
+
+        placeholder_values = [const.WORK_PROGRESS_STATUS['WAITING']]
+        keyset_condition = ''
+        if after is not None:
+            # NOTE: (createdAt, id) > (%s, %s) と同じ意味ですが、
+            # NOTE: こう書くほうが MySQL はインデックスを使ってくれます。
+            keyset_condition = ('AND (historyfaceimage.createdAt > %s'
+                                ' OR (historyfaceimage.createdAt = %s'
+                                ' AND historyfaceimage.id > %s))')
+            placeholder_values.extend((after[0], after[0], after[1]))
+        placeholder_values.append(limit)
+
+        select_sql = ' '.join([
+            'SELECT',
+                'historyfaceimage.id,',  # noqa: E131
+                'historyfaceimage.createdAt,',
+                'historyfaceimage.imagePath,',
+                'facedata.faceApiPersonId',
+            'FROM historyfaceimage',
+            'LEFT JOIN facedata',
+                'ON historyfaceimage.historyFaceDataId = facedata.id',
+            'WHERE',
+                'recognitionStatus = %s',
+                keyset_condition,
+            'ORDER BY historyfaceimage.createdAt, historyfaceimage.id',
+            'LIMIT %s',
+            # ほかのワーカーがロック中の行は飛ばします。
+            'FOR UPDATE OF historyfaceimage SKIP LOCKED',
+        ])
+
+        # NOTE: autocommit ではないので、 SELECT から commit までがひとつのトランザクションです。
+        try:
+            cursor = self.connection.cursor(dictionary=True)
+            cursor.execute(select_sql, tuple(placeholder_values))
+            records = cursor.fetchall()
+            cursor.close()
+
+            if records:
+                self.__set_working_status([_['id'] for _ in records])
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+        return records
+
+    def __set_working_status(self, history_face_image_ids: list) -> None:
+        """HistoryFaceImage に WORKING ステータスを付与します。 commit はしません。
+        updatedAt は、リースの期限切れを判定するために秒まで入れて更新します。
+
+        Args:
+            history_face_image_ids (list): HistoryFaceImage.id の一覧。
+        """
+
+        placeholder = util.get_placeholder(len(history_face_image_ids))
+
+        # [WORKING, id, id, id, ...] です。
+        placeholder_values = [const.WORK_PROGRESS_STATUS['WORKING']]
+        placeholder_values.extend(history_face_image_ids)
+
+        # NOTE: ほかの更新と同じ形式ですが、秒を切り捨てるとリースが最大59秒早く切れます。
+        # NOTE: 秒は %S です。 %s はプレースホルダーとみなされます。
+        update_sql = ' '.join([
+            'UPDATE historyfaceimage',
+            'SET',
+                'recognitionStatus = %s,',  # noqa: E131
+                "updatedAt = DATE_FORMAT(NOW(), '%Y-%m-%dT%H:%i:%S.000Z')",
+            f'WHERE id IN ({placeholder})',
+        ])
+        cursor = self.connection.cursor()
+        cursor.execute(update_sql, tuple(placeholder_values))
+        cursor.close()
+
+    def release_expired_claims(self, lease_seconds: int) -> int:
+        """WORKING のまま lease_seconds 秒以上たったレコードを WAITING に戻します。
+        途中で落ちたワーカーが取得したレコードを、ほかのワーカーが拾えるようにするためです。
+
+        Args:
+            lease_seconds (int): WORKING のままにしておける秒数。
+
+        Returns:
+            int: WAITING に戻した件数。
+        """
+
+        # NOTE: updatedAt は DATE_FORMAT で作った文字列です。文字列のままでなく、
+        # NOTE: STR_TO_DATE で DATETIME に戻して比べます。
+        update_sql = ' '.join([
+            'UPDATE historyfaceimage',
+            'SET recognitionStatus = %s',
+            'WHERE',
+                'recognitionStatus = %s',  # noqa: E131
+                "AND STR_TO_DATE(updatedAt, '%Y-%m-%dT%H:%i:%S.%fZ')",
+                    '< NOW() - INTERVAL %s SECOND',  # noqa: E131
+        ])
+        cursor = self.connection.cursor()
+        cursor.execute(update_sql, (const.WORK_PROGRESS_STATUS['WAITING'],
+                                    const.WORK_PROGRESS_STATUS['WORKING'],
+                                    lease_seconds))
+        released_count = cursor.rowcount
+        cursor.close()
+        self.connection.commit()
+
+        return released_count
+
     def set_pending_status(self, history_face_image_ids: list) -> None:
         """HistoryFaceImage に PENDING ステータスを付与します。
 
@@ -104,3 +322,72 @@ class MySqlClient:
                                     history_face_image_id))
         cursor.close()
         self.connection.commit()
+
+    def set_completed_statuses(self,
+                               results: list,
+                               chunk_size: int = None) -> int:
+        """複数の HistoryFaceImage に COMPLETED ステータスをまとめて付与します。
+        chunk_size 件ごとに1回の UPDATE と1回の commit で書き込みます。
+
+        Args:
+            results (list): (matched, candidatePersonId,
+                candidateConfidence, id) のタプルのリスト。
+            chunk_size (int): 1回の UPDATE で書き込む件数。
+                省略時は const.DB_WRITE_CHUNK_SIZE です。
+
+        Returns:
+            int: 書き込んだ件数。
+        """
+
+        if chunk_size is None:
+            chunk_size = const.DB_WRITE_CHUNK_SIZE
+
+        started = time.perf_counter()
+        for i in range(0, len(results), chunk_size):
+            self.__update_completed_chunk(results[i:i + chunk_size])
+        elapsed = time.perf_counter() - started
+
+        rows_per_second = len(results) / elapsed if elapsed > 0 else .0
+        logging.warning(
+            f'COMPLETED ステータス一括付与: {len(results)}件, '
+            f'{elapsed:.3f}秒, {rows_per_second:.1f}件/秒')
+        return len(results)
+
+    def __update_completed_chunk(self, results: list) -> None:
+        """CASE 式で、値の異なる複数行を1回の UPDATE で書き込みます。
+
+        Args:
+            results (list): (matched, candidatePersonId,
+                candidateConfidence, id) のタプルのリスト。
+        """
+
+        # 各列の CASE id WHEN %s THEN %s ... END です。
+        case_sql = ' '.join(
+            ['CASE id'] + ['WHEN %s THEN %s'] * len(results) + ['END'])
+
+        # id 用のプレースホルダです。
+        placeholder = util.get_placeholder(len(results))
+
+        update_sql = ' '.join([
+            'UPDATE historyfaceimage',
+            'SET',
+                'recognitionStatus = %s,',  # noqa: E131
+                f'matched = {case_sql},',
+                f'candidatePersonId = {case_sql},',
+                f'candidateConfidence = {case_sql},',
+                "updatedAt = DATE_FORMAT(NOW(), '%Y-%m-%dT%H:%i:00.000Z')",
+            f'WHERE id IN ({placeholder})',
+        ])
+
+        # [COMPLETED, id, matched, ..., id, personId, ..., id, confidence, ...,
+        #  id, id, ...] です。
+        placeholder_values = [const.WORK_PROGRESS_STATUS['COMPLETED']]
+        for column in range(3):
+            for result in results:
+                placeholder_values.extend((result[3], result[column]))
+        placeholder_values.extend(result[3] for result in results)
+
+        cursor = self.connection.cursor()
+        cursor.execute(update_sql, tuple(placeholder_values))
+        cursor.close()
+        self.connection.commit()
@@ -0,0 +1,201 @@
+
+# Built-in modules.
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Third-party modules.
+import numpy
+
+# My modules.
+import const
+
+
+# Face API の faceId の有効期限 (秒) です。 detection から24時間で失効します。
+FACE_ID_LIFETIME_SECONDS = 24 * 60 * 60
+
+
+def get_tile_hash(mat: numpy.ndarray) -> str:
+    """デコード済み画像の内容のハッシュを取得します。
+    同じ画像なら、 Blob の名前が違っても同じハッシュになります。
+
+    Args:
+        mat (numpy.ndarray): mat 形式の画像。
+
+    Returns:
+        str: ハッシュ (16進数)。
+    """
+
+    # NOTE: 画素が同じでも大きさが違えば別の画像なので、 shape も含めます。
+    hash_object = hashlib.blake2b(str(mat.shape).encode(), digest_size=16)
+    hash_object.update(numpy.ascontiguousarray(mat).data)
+    return hash_object.hexdigest()
+
+
+class DetectionCache:
+    """画像の内容のハッシュから、 detection で得た faceId を引くキャッシュです。
+    faceId は発行から24時間で失効するため、 ttl_seconds を過ぎたものは返しません。
+
+    メモリ上の LRU と、任意で SQLite ファイルの2段です。
+    """
+
+    # プロセス内で共有するキャッシュです。
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self,
+                 ttl_seconds: float,
+                 max_entries: int,
+                 path: str = None):
+        """
+        Args:
+            ttl_seconds (float): faceId を使い回す秒数。24時間より短くします。
+            max_entries (int): メモリ上に置く件数の上限。
+            path (str): SQLite ファイルのパス。 None ならメモリ上だけです。
+        """
+
+        # NOTE: identify の直前に失効しないよう、24時間ちょうどまでは使いません。
+        self.ttl_seconds = min(ttl_seconds, FACE_ID_LIFETIME_SECONDS - 60)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        # ハッシュ: (faceId, 発行時刻 (UNIX 時間)) です。末尾ほど最近使ったものです。
+        self._memory = OrderedDict()
+
+        self._connection = None
+        if path:
+            # NOTE: パイプラインでは別スレッドから呼ばれるため、 self._lock で直列化します。
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS detection_cache ('
+                'tile_hash TEXT PRIMARY KEY, '
+                'face_id TEXT NOT NULL, '
+                'issued_at REAL NOT NULL)')
+            self._connection.execute(
+                'DELETE FROM detection_cache WHERE issued_at < ?',
+                (time.time() - self.ttl_seconds,))
+            self._connection.commit()
+
+        self.counts = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+        }
+
+    @classmethod
+    def get_shared(cls) -> 'DetectionCache':
+        """プロセス内で共有するキャッシュを取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            DetectionCache: 共有のキャッシュ。無効にしている場合は None です。
+        """
+
+        with cls._shared_lock:
+            if cls._shared is None and const.DETECTION_CACHE_ENABLED:
+                cls._shared = cls(const.DETECTION_CACHE_TTL_SECONDS,
+                                  const.DETECTION_CACHE_MAX_ENTRIES,
+                                  const.DETECTION_CACHE_PATH or None)
+            return cls._shared
+
+    def get(self, tile_hash: str) -> str:
+        """有効な faceId を取得します。
+
+        Args:
+            tile_hash (str): 画像の内容のハッシュ。
+
+        Returns:
+            str: faceId。なければ、または失効間近なら None です。
+        """
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(tile_hash)
+            if entry is None and self._connection is not None:
+                entry = self._connection.execute(
+                    'SELECT face_id, issued_at FROM detection_cache '
+                    'WHERE tile_hash = ?', (tile_hash,)).fetchone()
+                if entry is not None:
+                    self.__put_memory(tile_hash, tuple(entry))
+
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+
+            face_id, issued_at = entry
+            if now - issued_at >= self.ttl_seconds:
+                self._memory.pop(tile_hash, None)
+                self.counts['expired'] += 1
+                self.counts['misses'] += 1
+                return None
+
+            self._memory.move_to_end(tile_hash)
+            self.counts['hits'] += 1
+            return face_id
+
+    def put(self, tile_hash: str, face_id: str, issued_at: float) -> None:
+        """detection で得た faceId をキャッシュします。
+
+        Args:
+            tile_hash (str): 画像の内容のハッシュ。
+            face_id (str): faceId。
+            issued_at (float): detection を行った時刻 (UNIX 時間)。
+        """
+
+        with self._lock:
+            self.__put_memory(tile_hash, (face_id, issued_at))
+            if self._connection is not None:
+                self._connection.execute(
+                    'REPLACE INTO detection_cache VALUES (?, ?, ?)',
+                    (tile_hash, face_id, issued_at))
+                self._connection.commit()
+
+    def __put_memory(self, tile_hash: str, entry: tuple) -> None:
+        """メモリに載せ、上限を超えたぶんを古い順に追い出します。 self._lock の中で呼びます。
+        """
+
+        self._memory[tile_hash] = entry
+        self._memory.move_to_end(tile_hash)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        """ヒット数などの集計を取得します。
+
+        Returns:
+            dict: 集計。 expired は失効間近で使わなかった件数です (misses に含みます)。
+        """
+
+        with self._lock:
+            counts = dict(self.counts)
+        total = counts['hits'] + counts['misses']
+        counts['hit_rate'] = counts['hits'] / total if total else .0
+        return counts
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    mat_a = numpy.zeros((100, 100, 3), numpy.uint8)
+    mat_b = numpy.zeros((100, 50, 3), numpy.uint8)
+    assert get_tile_hash(mat_a) == get_tile_hash(mat_a.copy())
+    assert get_tile_hash(mat_a) != get_tile_hash(mat_b)
+
+    cache = DetectionCache(ttl_seconds=60, max_entries=2)
+    now = time.time()
+    cache.put('a', 'face-a', now)
+    cache.put('b', 'face-b', now - 61)
+    assert cache.get('a') == 'face-a'
+    assert cache.get('b') is None
+    assert cache.get('c') is None
+
+    # 上限を超えると、最近使っていない a が追い出されます。
+    cache.put('c', 'face-c', now)
+    cache.put('d', 'face-d', now)
+    assert cache.get('a') is None
+    assert cache.stats()['expired'] == 1
+
+    # TTL は faceId の有効期限より短く抑えます。
+    assert DetectionCache(10 ** 6, 1).ttl_seconds < FACE_ID_LIFETIME_SECONDS
@@ -1,6 +1,13 @@
 
 # Built-in modules.
+import asyncio
+import functools
 import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Third-party modules.
 import requests
@@ -9,18 +16,333 @@ import cv2
 
 # My modules.
 import const
+import metrics
+
+
+class FaceApiError(Exception):
+    """Face API がエラーを返した、またはリトライしても成功しなかった。
+    """
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f'Face API returned {status_code}: {body}')
+        self.status_code = status_code
+        self.body = body
+
+
+class TokenBucket:
+    """トークンバケットによるクライアント側の流量制限です。
+    1秒あたり rate 回まで、瞬間的には capacity 回まで acquire を通します。
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Args:
+            rate (float): 1秒あたりに補充するトークン数。0以下なら制限しません。
+            capacity (float): 貯められるトークンの上限。省略時は rate です。
+        """
+
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity,
+                              self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def reserve(self) -> float:
+        """トークンを1つ予約し、使えるようになるまでの待ち秒数を取得します。
+
+        Returns:
+            float: 待つべき秒数。すぐに使えるなら0です。
+        """
+
+        if self.rate <= 0:
+            return .0
+
+        with self._lock:
+            self.__refill(time.monotonic())
+
+            # NOTE: トークンは負にもなります。負のぶんは先着順の待ち行列です。
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return .0
+            return -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        """トークンを1つ取得します。足りなければ補充されるまで待ちます。
+        """
+
+        wait_seconds = self.reserve()
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+    def pause(self, seconds: float) -> None:
+        """seconds 秒間、全呼び出し元へのトークンの払い出しを止めます。
+        429 を受けたとき、ほかのスレッドまで一斉にリトライしないようにするためです。
+
+        Args:
+            seconds (float): 止める秒数。
+        """
+
+        if self.rate <= 0:
+            return
+
+        with self._lock:
+            self.__refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class ImageEncoding:
+    """Detection API に送る画像のエンコード設定です。
+    送信量とエンコードにかかる CPU 時間を、画質と引き換えに減らせます。
+    """
+
+    FORMATS = ('png', 'jpeg')
+
+    def __init__(self,
+                 format: str = 'png',
+                 jpeg_quality: int = 95,
+                 png_compression: int = None,
+                 grayscale: bool = False):
+        """
+        Args:
+            format (str): 'png' または 'jpeg'。
+            jpeg_quality (int): JPEG の画質 (0-100)。
+            png_compression (int): PNG の圧縮レベル (0-9)。 None なら OpenCV の既定値です。
+            grayscale (bool): 1チャンネルのグレースケールにしてから送る。
+
+        Raises:
+            ValueError: 対応していない format である。
+        """
+
+        if format not in self.FORMATS:
+            raise ValueError(f'Unsupported image format: {format}')
+
+        self.format = format
+        self.jpeg_quality = jpeg_quality
+        self.png_compression = png_compression
+        self.grayscale = grayscale
+
+    def __repr__(self) -> str:
+
+        if self.format == 'jpeg':
+            option = f'quality={self.jpeg_quality}'
+        else:
+            option = f'compression={self.png_compression}'
+        return (f'ImageEncoding({self.format}, {option}, '
+                f'grayscale={self.grayscale})')
+
+    @classmethod
+    def from_settings(cls) -> 'ImageEncoding':
+        """const の設定値からインスタンスを生成します。
+
+        Returns:
+            ImageEncoding: インスタンス。
+        """
+
+        return cls(const.DETECT_IMAGE_FORMAT,
+                   const.DETECT_JPEG_QUALITY,
+                   const.DETECT_PNG_COMPRESSION,
+                   const.DETECT_GRAYSCALE)
+
+    def encode(self, mat: numpy.ndarray) -> bytes:
+        """mat をバイナリに変換します。
+
+        Args:
+            mat (numpy.ndarray): mat 形式の画像。
+
+        Raises:
+            ValueError: エンコードに失敗した。
+
+        Returns:
+            bytes: エンコードした画像。
+        """
+
+        if self.grayscale and mat.ndim == 3:
+            mat = cv2.cvtColor(mat, cv2.COLOR_BGR2GRAY)
+
+        if self.format == 'jpeg':
+            extension = '.jpg'
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        else:
+            extension = '.png'
+            params = ([]
+                      if self.png_compression is None
+                      else [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+
+        encode_succeeded, buffer = cv2.imencode(extension, mat, params)
+        if not encode_succeeded:
+            raise ValueError(f'Failed to encode image with {self!r}.')
+        return buffer.tobytes()
 
 
 class FaceApiClient:
 
-    FACE_API_BASE_URL = 'https://japaneast.api.cognitive.microsoft.com/face/v1.0'  # noqa: E501
+    # Face API のエンドポイントです。 None なら const の設定値を使います。
+    # NOTE: import 時に設定を読み込まないよう、 const は使うときに参照します。
+    FACE_API_BASE_URL = None
+
+    # Detection API が1回で返す顔の最大数です。
+    DETECT_MAX_FACES = 100
+    # Detection API に送れる画像の1辺の最大ピクセル数です。
+    DETECT_MAX_IMAGE_SIZE = 4096
+    # Identification API に1回で送れる faceId の最大数です。
+    IDENTIFY_MAX_FACE_IDS = 10
+
+    # リトライする HTTP ステータスです。
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    # 実行中ずっと使い回す、 keep-alive の Session です。
+    # NOTE: 呼び出しのたびに TCP 接続と TLS ハンドシェイクをやり直さないようにするためです。
+    _session = None
+    _session_lock = threading.Lock()
+
+    # サブスクリプションの TPS (1秒あたりのトランザクション数) に合わせた流量制限です。
+    # NOTE: 初回の呼び出しで作ります。
+    _rate_limiter = None
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """プロセス内で共有する Session を取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            requests.Session: 共有の Session。
+        """
+
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=const.FACE_API_POOL_SIZE,
+                    pool_maxsize=const.FACE_API_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['Ocp-Apim-Subscription-Key'] = (
+                    const.AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY)
+                cls._session = session
+            return cls._session
+
+    @classmethod
+    def get_rate_limiter(cls) -> TokenBucket:
+        """プロセス内で共有する流量制限を取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            TokenBucket: 共有の流量制限。
+        """
+
+        with cls._session_lock:
+            if cls._rate_limiter is None:
+                cls._rate_limiter = TokenBucket(
+                    const.FACE_API_TRANSACTIONS_PER_SECOND)
+            return cls._rate_limiter
+
+    @classmethod
+    def get_base_url(cls) -> str:
+        """Face API のエンドポイントを取得します。
+
+        Returns:
+            str: FACE_API_BASE_URL。指定がなければ const の設定値です。
+        """
+
+        return cls.FACE_API_BASE_URL or const.FACE_API_BASE_URL
+
+    @classmethod
+    def _get_retry_wait_seconds(cls,
+                                response: requests.Response,
+                                attempt: int) -> float:
+        """次のリトライまで待つ秒数を求めます。
+
+        Args:
+            response (requests.Response): 失敗したレスポンス。接続エラーなら None。
+            attempt (int): 何回目の試行だったか。0始まり。
+
+        Returns:
+            float: 待つ秒数。
+        """
+
+        # Retry-After があれば従います。
+        # NOTE: Face API の 429 は秒数で返ってきます。
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    return max(float(retry_after), .0)
+                except ValueError:
+                    pass
+
+        # なければ指数バックオフします。同時に失敗した呼び出しがずれるよう揺らぎを入れます。
+        backoff = const.FACE_API_BACKOFF_SECONDS * (2 ** attempt)
+        return backoff * (.5 + random.random() / 2)
+
+    @classmethod
+    def _post(cls, url: str, **kwargs) -> object:
+        """流量制限とリトライ付きで POST します。
+
+        Args:
+            url (str): URL。
+            **kwargs: requests.Session.post に渡す引数。
+
+        Raises:
+            FaceApiError: エラーが返った、またはリトライしても成功しなかった。
+
+        Returns:
+            object: レスポンスの JSON。
+        """
+
+        session = cls.get_session()
+        rate_limiter = cls.get_rate_limiter()
+        attempt = 0
+        while True:
+            rate_limiter.acquire()
+
+            try:
+                response = session.post(
+                    url=url, timeout=const.FACE_API_TIMEOUT_SECONDS, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= const.FACE_API_MAX_RETRIES:
+                    raise
+                response = None
+            else:
+                if response.ok:
+                    return response.json()
+                if (response.status_code not in cls.RETRY_STATUS_CODES
+                        or attempt >= const.FACE_API_MAX_RETRIES):
+                    raise FaceApiError(response.status_code, response.text)
+
+            wait_seconds = cls._get_retry_wait_seconds(response, attempt)
+            metrics.Metrics.get_shared().add_face_api_retry(
+                url.rsplit('/', 1)[-1])
+            logging.warning(
+                f'Face API のリトライ {attempt + 1}/{const.FACE_API_MAX_RETRIES}。'
+                f'status={None if response is None else response.status_code},'
+                f' {wait_seconds:.1f}秒待ちます。')
+
+            # 429 のときはほかの呼び出しもまとめて止めます。
+            # NOTE: 次の acquire で止めたぶん待つことになります。
+            if (response is not None and response.status_code == 429
+                    and rate_limiter.rate > 0):
+                rate_limiter.pause(wait_seconds)
+            else:
+                time.sleep(wait_seconds)
+            attempt += 1
 
     @classmethod
-    def detect_mat(cls, mat: numpy.ndarray) -> dict:
+    def detect_mat(cls,
+                   mat: numpy.ndarray,
+                   encoding: ImageEncoding = None) -> dict:
 
         # mat をバイナリに変換します。
-        encode_succeeded, buffer = cv2.imencode('.png', mat)
-        bytes_image = buffer.tobytes()
+        # NOTE: encoding を省略したときは const の設定値に従います。 (既定では PNG)
+        encoding = encoding or ImageEncoding.from_settings()
+        with metrics.Metrics.get_shared().time('encode'):
+            bytes_image = encoding.encode(mat)
 
         # detection を行います。
         return cls.detect(bytes_image)
@@ -28,29 +350,30 @@ class FaceApiClient:
     @classmethod
     def detect(cls, bytes_image: bytes) -> dict:
 
-        url = f'{cls.FACE_API_BASE_URL}/detect'
+        url = f'{cls.get_base_url()}/detect'
         params = {
             'recognitionModel': 'recognition_02',
         }
         headers = {
             'Content-Type': 'application/octet-stream',
-            'Ocp-Apim-Subscription-Key':
-                const.AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY,
         }
-        response = requests.post(url=url,
-                                 params=params,
-                                 headers=headers,
-                                 data=bytes_image)
-        return response.json()
+        shared_metrics = metrics.Metrics.get_shared()
+        with shared_metrics.time('detect'):
+            detection_result = cls._post(url=url,
+                                         params=params,
+                                         headers=headers,
+                                         data=bytes_image)
+        shared_metrics.add_bytes('detect', len(bytes_image))
+        shared_metrics.add_face_api_transaction(
+            'detect', len(detection_result))
+        return detection_result
 
     @classmethod
     def identify(cls, person_group_id: str, face_ids: list) -> dict:
 
-        url = f'{cls.FACE_API_BASE_URL}/identify'
+        url = f'{cls.get_base_url()}/identify'
         headers = {
             'Content-Type': 'application/json',
-            'Ocp-Apim-Subscription-Key':
-                const.AZURE_COGNITIVE_SERVICES_SUBSCRIPTION_KEY,
         }
         # NOTE: payload は積載物って意味。
         payload = {
@@ -59,7 +382,74 @@ class FaceApiClient:
             'maxNumOfCandidatesReturned': 1,
             'confidenceThreshold': .65,
         }
-        response = requests.post(url=url,
-                                 headers=headers,
-                                 data=json.dumps(payload))
-        return response.json()
+        shared_metrics = metrics.Metrics.get_shared()
+        with shared_metrics.time('identify'):
+            identification_result = cls._post(url=url,
+                                              headers=headers,
+                                              data=json.dumps(payload))
+        shared_metrics.add_face_api_transaction('identify', len(face_ids))
+        return identification_result
+
+
+class AsyncFaceApiClient:
+    """FaceApiClient の asyncio 版です。
+    独立した detect, identify を同時に max_concurrency 件まで投げます。
+
+    NOTE: 呼び出しそのものは FaceApiClient (共有 Session, 流量制限, リトライ) を
+    NOTE: 専用スレッドで実行します。 aiohttp などの依存を増やさないためです。
+
+    使い方:
+        async with AsyncFaceApiClient() as client:
+            detection_result = await client.detect_mat(mat)
+    """
+
+    def __init__(self, max_concurrency: int = None):
+        """
+        Args:
+            max_concurrency (int): 同時に投げる呼び出しの上限。
+                省略時は const.FACE_API_MAX_CONCURRENCY です。
+        """
+
+        if max_concurrency is None:
+            max_concurrency = const.FACE_API_MAX_CONCURRENCY
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency,
+            thread_name_prefix='face-api')
+
+        # NOTE: Python 3.7 の Semaphore は作成時のイベントループに紐づくため、
+        # NOTE: 最初の呼び出し時 (ループの中) に作ります。
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func: callable, *args) -> object:
+        """func を同時実行数の制限つきで専用スレッドで実行します。
+        """
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args))
+
+    async def detect_mat(self,
+                         mat: numpy.ndarray,
+                         encoding: ImageEncoding = None) -> dict:
+
+        return await self._run(FaceApiClient.detect_mat, mat, encoding)
+
+    async def detect(self, bytes_image: bytes) -> dict:
+
+        return await self._run(FaceApiClient.detect, bytes_image)
+
+    async def identify(self, person_group_id: str, face_ids: list) -> dict:
+
+        return await self._run(
+            FaceApiClient.identify, person_group_id, face_ids)
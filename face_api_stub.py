@@ -0,0 +1,325 @@
+"""Face API stand-in server
+
+このスクリプトの目標。
+
+- 本物のクォータを使わずに production_draft の負荷試験をする。
+- /detect と /identify だけを持つ、手元の Face API の代役を立てる。
+- 遅延、スロットリング (429)、エラー (500) を設定で注入できる。
+- /detect は送られてきた連結画像のうち、空白でないタイルの数だけ
+  faceRectangle を返す。 trial.py に残してある本物の返り値と同じ形です。
+
+使い方:
+    python face_api_stub.py --port 8080 --latency-ms 200 --throttle-tps 10
+    export FACE_API_BASE_URL=http://127.0.0.1:8080/face/v1.0
+    python production_draft.py
+
+"""
+
+# Built-in modules.
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Third-party modules.
+import numpy
+import cv2
+
+
+class StubConfig:
+    """代役サーバーの振る舞いの設定です。
+    """
+
+    def __init__(self,
+                 latency_ms: float = 0,
+                 latency_jitter_ms: float = 0,
+                 throttle_tps: float = 0,
+                 throttle_rate: float = 0,
+                 error_rate: float = 0,
+                 no_candidate_rate: float = 0,
+                 tile_size: int = 100):
+        """
+        Args:
+            latency_ms (float): 1リクエストあたりの応答遅延の平均。
+            latency_jitter_ms (float): 応答遅延の揺らぎの幅 (±)。
+            throttle_tps (float): これを超える秒間リクエストに 429 を返します。0なら無制限。
+            throttle_rate (float): ランダムに 429 を返す割合 (0-1)。
+            error_rate (float): ランダムに 500 を返す割合 (0-1)。
+            no_candidate_rate (float): /identify で候補なしにする割合 (0-1)。
+            tile_size (int): 連結画像のタイル1辺のピクセル数。
+        """
+
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.throttle_tps = throttle_tps
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.no_candidate_rate = no_candidate_rate
+        self.tile_size = tile_size
+
+
+class FaceApiStubServer:
+    """Face API の代役サーバーです。別スレッドで動かせます。
+
+    使い方:
+        server = FaceApiStubServer(StubConfig(latency_ms=100))
+        server.start()
+        ... FACE_API_BASE_URL に server.base_url を指定して処理 ...
+        server.stop()
+    """
+
+    # 空白タイルとみなす画素値の下限です。 MosaicBuilder は空きタイルを白で埋めます。
+    BLANK_THRESHOLD = 250
+
+    # 1 PersonGroup あたりの架空の人数です。
+    PERSONS_PER_GROUP = 10
+
+    def __init__(self,
+                 config: StubConfig,
+                 host: str = '127.0.0.1',
+                 port: int = 0):
+        self.config = config
+        self.httpd = ThreadingHTTPServer((host, port), _StubRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = None
+
+        # 呼び出しの集計です。
+        self.counts = {
+            'detect': 0,
+            'identify': 0,
+            'throttled': 0,
+            'errors': 0,
+            'faces': 0,
+        }
+        self._lock = threading.Lock()
+
+        # 秒間リクエスト数の制限に使う、直近1秒の受付時刻です。
+        self._accepted_at = []
+
+    @property
+    def base_url(self) -> str:
+
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/face/v1.0'
+
+    def start(self) -> None:
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='face-api-stub',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def count(self, key: str, value: int = 1) -> None:
+
+        with self._lock:
+            self.counts[key] += value
+
+    def should_throttle(self) -> bool:
+        """このリクエストに 429 を返すか判定します。
+        """
+
+        if random.random() < self.config.throttle_rate:
+            return True
+        if self.config.throttle_tps <= 0:
+            return False
+
+        with self._lock:
+            now = time.monotonic()
+            self._accepted_at = [_ for _ in self._accepted_at if now - _ < 1]
+            if len(self._accepted_at) >= self.config.throttle_tps:
+                return True
+            self._accepted_at.append(now)
+            return False
+
+    def detect(self, bytes_image: bytes) -> list:
+        """空白でないタイルごとに、タイル内の faceRectangle を返します。
+
+        Args:
+            bytes_image (bytes): 連結画像。
+
+        Returns:
+            list: Detection 結果。
+        """
+
+        mat = cv2.imdecode(numpy.frombuffer(bytes_image, numpy.uint8),
+                           cv2.IMREAD_GRAYSCALE)
+        if mat is None:
+            raise ValueError('Image format is not supported.')
+
+        tile_size = self.config.tile_size
+        rows = mat.shape[0] // tile_size
+        cols = mat.shape[1] // tile_size
+
+        # タイルごとの最小画素値です。すべて白に近ければ空白タイルです。
+        tiles = mat[:rows * tile_size, :cols * tile_size].reshape(
+            rows, tile_size, cols, tile_size)
+        tile_minimums = tiles.min(axis=(1, 3))
+
+        # 本物と同じく、タイル内の少しずれた位置に 64-84px (100px 換算) の顔を置きます。
+        scale = tile_size / 100
+        detection_result = []
+        for vertical_index, horizontal_index in zip(
+                *numpy.nonzero(tile_minimums < self.BLANK_THRESHOLD)):
+            size = int(random.randint(64, 84) * scale)
+            detection_result.append({
+                'faceId': str(uuid.uuid4()),
+                'faceRectangle': {
+                    'top': int(vertical_index * tile_size
+                               + random.randint(4, 18) * scale),
+                    'left': int(horizontal_index * tile_size
+                                + random.randint(4, 18) * scale),
+                    'width': size,
+                    'height': size,
+                },
+            })
+        return detection_result
+
+    def identify(self, payload: dict) -> list:
+        """faceId ごとに、 PersonGroup 内の架空の人物を候補として返します。
+
+        Args:
+            payload (dict): Identification API のリクエスト。
+
+        Raises:
+            ValueError: faceIds が本物の制限 (1-10件) を外れている。
+
+        Returns:
+            list: Identification 結果。
+        """
+
+        face_ids = payload.get('faceIds') or []
+        if not 1 <= len(face_ids) <= 10:
+            raise ValueError('The length of faceIds must be 1-10.')
+
+        identification_result = []
+        for face_id in face_ids:
+            candidates = []
+            if random.random() >= self.config.no_candidate_rate:
+                person_number = random.randrange(self.PERSONS_PER_GROUP)
+                person_id = uuid.uuid5(
+                    uuid.NAMESPACE_URL,
+                    f'{payload.get("personGroupId")}/{person_number}')
+                candidates.append({
+                    'personId': str(person_id),
+                    'confidence': round(random.uniform(.65, 1), 5),
+                })
+            identification_result.append({
+                'faceId': face_id,
+                'candidates': candidates,
+            })
+        return identification_result
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        config = stub.config
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        # 遅延を注入します。
+        latency_ms = config.latency_ms + random.uniform(
+            -config.latency_jitter_ms, config.latency_jitter_ms)
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000)
+
+        # スロットリングとエラーを注入します。本物と同じ形のエラーを返します。
+        if stub.should_throttle():
+            stub.count('throttled')
+            self.__send_json(429, {'error': {
+                'code': '429',
+                'message': 'Rate limit is exceeded. Try again in 1 seconds.',
+            }}, {'Retry-After': '1'})
+            return
+        if random.random() < config.error_rate:
+            stub.count('errors')
+            self.__send_json(500, {'error': {
+                'code': 'InternalServerError',
+                'message': 'Injected error.',
+            }})
+            return
+
+        path = urlparse(self.path).path
+        try:
+            if path.endswith('/detect'):
+                stub.count('detect')
+                result = stub.detect(body)
+                stub.count('faces', len(result))
+            elif path.endswith('/identify'):
+                stub.count('identify')
+                result = stub.identify(json.loads(body))
+            else:
+                self.__send_json(404, {'error': {
+                    'code': 'NotFound', 'message': path}})
+                return
+        except ValueError as e:
+            self.__send_json(400, {'error': {
+                'code': 'BadArgument', 'message': str(e)}})
+            return
+
+        self.__send_json(200, result)
+
+    def __send_json(self,
+                    status_code: int,
+                    payload: object,
+                    headers: dict = None) -> None:
+
+        body = json.dumps(payload).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        # NOTE: リクエストごとのアクセスログは負荷試験では多すぎるので出しません。
+        pass
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0)
+    parser.add_argument('--throttle-tps', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--no-candidate-rate', type=float, default=0)
+    parser.add_argument('--tile-size', type=int, default=100)
+    args = parser.parse_args()
+
+    server = FaceApiStubServer(
+        StubConfig(latency_ms=args.latency_ms,
+                   latency_jitter_ms=args.latency_jitter_ms,
+                   throttle_tps=args.throttle_tps,
+                   throttle_rate=args.throttle_rate,
+                   error_rate=args.error_rate,
+                   no_candidate_rate=args.no_candidate_rate,
+                   tile_size=args.tile_size),
+        args.host, args.port)
+    print(f'Face API stand-in: {server.base_url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(server.counts)
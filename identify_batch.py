@@ -0,0 +1,209 @@
+
+# Built-in modules.
+import logging
+import time
+
+# My modules.
+import const
+import face_api
+
+
+class IdentifyAccumulator:
+    """detection 済みの FaceImage をセットをまたいでためて、
+    PersonGroup ごとに faceId が上限 (10件) そろってから Identification API にまわします。
+
+    セットごとに identification すると、 PersonGroup ごとの端数 (1-3件など) の呼び出しが
+    セットの数だけ増えます。まとめればトランザクションは faceId の数 / 10 に近づきます。
+    端数は flush で、または一番古い faceId が max_wait_seconds 待ったところで投げます。
+
+    NOTE: 1つのスレッドから使います。
+    """
+
+    def __init__(self,
+                 max_wait_seconds: float = None,
+                 identify: callable = None):
+        """
+        Args:
+            max_wait_seconds (float): 端数の faceId を待たせる秒数の上限。
+                省略時は const.IDENTIFY_BATCH_MAX_WAIT_SECONDS です。
+            identify (callable): (PersonGroupId, faceId のリスト) を受け取り、
+                Identification 結果を返す関数。省略時は FaceApiClient.identify です。
+        """
+
+        if max_wait_seconds is None:
+            max_wait_seconds = const.IDENTIFY_BATCH_MAX_WAIT_SECONDS
+        self.max_wait_seconds = max_wait_seconds
+        self.identify = identify or face_api.FaceApiClient.identify
+        self.batch_size = face_api.FaceApiClient.IDENTIFY_MAX_FACE_IDS
+
+        # (PersonGroupId, faceId): FaceImage のリスト です。
+        # NOTE: 同じ画像はセットが違っても (detection のキャッシュで) 同じ faceId なので、
+        # NOTE: 1回の identification でまとめて埋めます。
+        self.__face_images_by_group_and_face_id = {}
+
+        # PersonGroupId: まだ投げていない faceId のリスト です。
+        self.__pending_face_ids = {}
+
+        # PersonGroupId: 一番古い未送信の faceId をためた時刻 です。
+        self.__pending_since = {}
+
+        self.counts = {
+            'calls': 0,
+            'full_calls': 0,
+            'face_ids': 0,
+        }
+
+    def add(self, face_images: list) -> list:
+        """detection 済みの FaceImage をためます。
+        上限に達した PersonGroup と、待ちすぎた PersonGroup は identification します。
+
+        Args:
+            face_images (list): detection 済みの FaceImage のリスト。
+
+        Returns:
+            list: identification の済んだ FaceImage のリスト。
+                faceId のない FaceImage は identification できないため、そのまま含めます。
+        """
+
+        completed_face_images = []
+        now = time.monotonic()
+        for face_image in face_images:
+            face_id = face_image.detected_face_id
+            if not face_id:
+                completed_face_images.append(face_image)
+                continue
+
+            person_group_id = face_image.get_person_group_id()
+            key = (person_group_id, face_id)
+            if key in self.__face_images_by_group_and_face_id:
+                self.__face_images_by_group_and_face_id[key].append(
+                    face_image)
+                continue
+            self.__face_images_by_group_and_face_id[key] = [face_image]
+
+            pending_face_ids = self.__pending_face_ids.setdefault(
+                person_group_id, [])
+            pending_face_ids.append(face_id)
+            self.__pending_since.setdefault(person_group_id, now)
+            if len(pending_face_ids) == self.batch_size:
+                completed_face_images.extend(self.__send(person_group_id))
+
+        # 端数を待たせすぎないよう、古いものから投げます。
+        # NOTE: faceId は24時間で失効し、 FaceImage も DB に書き込むまで手放せません。
+        for person_group_id, pending_since in list(
+                self.__pending_since.items()):
+            if now - pending_since >= self.max_wait_seconds:
+                completed_face_images.extend(self.__send(person_group_id))
+        return completed_face_images
+
+    def flush(self) -> list:
+        """ためている faceId を、端数もすべて identification します。
+
+        Returns:
+            list: identification の済んだ FaceImage のリスト。
+        """
+
+        completed_face_images = []
+        for person_group_id in list(self.__pending_face_ids):
+            completed_face_images.extend(self.__send(person_group_id))
+        return completed_face_images
+
+    def __send(self, person_group_id: str) -> list:
+        """PersonGroup の未送信の faceId を identification し、 candidate を与えます。
+
+        Args:
+            person_group_id (str): PersonGroupId。
+
+        Returns:
+            list: candidate を与えた (候補なしを含む) FaceImage のリスト。
+        """
+
+        face_ids = self.__pending_face_ids.pop(person_group_id, [])
+        self.__pending_since.pop(person_group_id, None)
+        if not face_ids:
+            return []
+
+        identification_result = self.identify(person_group_id, face_ids)
+        self.counts['calls'] += 1
+        self.counts['face_ids'] += len(face_ids)
+        if len(face_ids) == self.batch_size:
+            self.counts['full_calls'] += 1
+
+        # 候補のある faceId の FaceImage に candidate を与えます。
+        for result in identification_result:
+            if not result['candidates']:
+                continue
+            for face_image in self.__face_images_by_group_and_face_id.get(
+                    (person_group_id, result['faceId']), ()):
+                face_image.candidate_person_id = (
+                    result['candidates'][0]['personId'])
+                face_image.candidate_confidence = (
+                    result['candidates'][0]['confidence'])
+
+        completed_face_images = []
+        for face_id in face_ids:
+            completed_face_images.extend(
+                self.__face_images_by_group_and_face_id.pop(
+                    (person_group_id, face_id)))
+        return completed_face_images
+
+    def log_stats(self) -> None:
+        """呼び出し回数と、1回あたりの faceId 数をログに出します。
+        """
+
+        calls = self.counts['calls']
+        logging.warning(
+            f'identification の呼び出し: {calls}回, '
+            f'うち10件そろったもの: {self.counts["full_calls"]}回, '
+            f'1回あたりの faceId: '
+            f'{self.counts["face_ids"] / calls if calls else .0:.1f}件')
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    import image
+
+    requests = []
+
+    def identify(person_group_id, face_ids):
+        requests.append((person_group_id, list(face_ids)))
+        return [{'faceId': face_id,
+                 'candidates': [{'personId': f'p-{face_id}',
+                                 'confidence': .9}]}
+                for face_id in face_ids]
+
+    def create_face_images(first_id, count, container_name):
+        face_images = []
+        for i in range(first_id, first_id + count):
+            face_image = image.FaceImage(
+                i, f'/{container_name}/{i}.png', f'p-face-{i}')
+            face_image.detected_face_id = f'face-{i}'
+            face_images.append(face_image)
+        return face_images
+
+    accumulator = IdentifyAccumulator(max_wait_seconds=60, identify=identify)
+
+    # 2セットで a が 7 + 7 件なら、10件の1回と端数4件の1回です。
+    completed = accumulator.add(create_face_images(0, 7, 'a'))
+    assert completed == [] and requests == []
+    completed = accumulator.add(create_face_images(7, 7, 'a')
+                                + create_face_images(100, 2, 'b'))
+    assert len(completed) == 10 and requests[0][0] == 'a'
+    assert completed[0].candidate_person_id == 'p-face-0'
+    assert completed[0].matched()
+    completed = accumulator.flush()
+    assert len(completed) == 6 and len(requests) == 3
+    assert accumulator.counts == {'calls': 3, 'full_calls': 1, 'face_ids': 16}
+
+    # faceId のない画像はすぐに返します。同じ faceId は1回だけ投げます。
+    requests.clear()
+    no_face_image = image.FaceImage(200, '/a/200.png', 'p')
+    same_face_images = create_face_images(300, 1, 'a') * 2
+    completed = accumulator.add([no_face_image] + same_face_images)
+    assert completed == [no_face_image]
+    assert len(accumulator.flush()) == 2 and requests == [('a', ['face-300'])]
+
+    # 待ちすぎた端数は add の中で投げます。
+    accumulator = IdentifyAccumulator(max_wait_seconds=0, identify=identify)
+    assert len(accumulator.add(create_face_images(0, 3, 'a'))) == 3
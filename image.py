@@ -1,193 +1,672 @@
 
-# Third-party modules.
-import numpy
-import cv2
-from azure.storage.blob import BlobServiceClient
+# NOTE: 型注釈は評価しません。注釈のために重いモジュールを読み込まないようにするためです。
+from __future__ import annotations
+
+# Built-in modules.
+import asyncio
+import logging
+import sys
+import time
+from array import array
 
 # My modules.
 import const
+import metrics
 import util
-import face_api
+
+# NOTE: 以下は numpy, cv2, requests, Azure SDK を読み込むため、
+#       import だけで数百ミリ秒かかります。初めて使うときに読み込みます。
+numpy = util.lazy_import('numpy')
+blob_storage = util.lazy_import('blob_storage')
+detection_cache = util.lazy_import('detection_cache')
+face_api = util.lazy_import('face_api')
+mosaic = util.lazy_import('mosaic')
+prefilter = util.lazy_import('prefilter')
+tile_pool = util.lazy_import('tile_pool')
+
+
+def create_mosaic_builder() -> mosaic.MosaicBuilder:
+    """const の設定値どおりのタイル配置の MosaicBuilder を作ります。
+
+    Raises:
+        ValueError: Detection API の制限を超えるタイル配置である。
+
+    Returns:
+        mosaic.MosaicBuilder: インスタンス。
+    """
+
+    rows, cols = const.MOSAIC_ROWS, const.MOSAIC_COLS
+    tile_size = const.MOSAIC_TILE_SIZE
+
+    # 1回の detection で全タイルの顔が返ってくる配置でないといけません。
+    if rows * cols > face_api.FaceApiClient.DETECT_MAX_FACES:
+        raise ValueError(
+            f'{rows}x{cols} tiles exceed '
+            f'{face_api.FaceApiClient.DETECT_MAX_FACES} faces per detection.')
+    if max(rows, cols) * tile_size > face_api.FaceApiClient.DETECT_MAX_IMAGE_SIZE:  # noqa: E501
+        raise ValueError(
+            f'{rows}x{cols} tiles of {tile_size}px exceed '
+            f'{face_api.FaceApiClient.DETECT_MAX_IMAGE_SIZE}px.')
+
+    return mosaic.MosaicBuilder(rows, cols, tile_size)
 
 
 class FaceImageSet:
 
-    def __init__(self, face_images: list):
+    def __init__(self,
+                 face_images: list,
+                 max_workers: int = None,
+                 mosaic_builder: mosaic.MosaicBuilder = None,
+                 cache: detection_cache.DetectionCache = None,
+                 process_pool: tile_pool.TileProcessPool = None,
+                 face_prefilter: prefilter.FacePrefilter = None,
+                 mat_list: list = None):
         self.face_images = face_images
 
+        # 大きすぎる、またはデコードできなかった画像です。 get_mat_list で face_images から移します。
+        # NOTE: faceId がつかないため、呼び出し側で COMPLETED でなく PENDING にします。
+        self.unreadable_face_images = []
+
+        # prefilter で顔のなさそうな画像です。 remove_rejected で face_images から移します。
+        # NOTE: こちらも呼び出し側で PENDING にします。
+        self.rejected_face_images = []
+
+        # face_images の取得済みの画像です。 get_mat_list はダウンロードせずにこれを返します。
+        # NOTE: prefilter で空いたタイルを詰め直したセット (iter_image_sets) で使います。
+        self.__fetched_mat_list = mat_list
+
+        # Blob の並行ダウンロード数です。 None なら const の設定値を使います。
+        self.max_workers = max_workers
+
+        # 連結画像のバッファです。
+        # NOTE: 省略時はセットごとに確保します。パイプラインでは前のセットの
+        # NOTE: detection 中に次のセットを連結するため、共有してはいけません。
+        # NOTE: 端数のセットは、収まる最小のタイル配置に縮めます。
+        self.__base_mosaic_builder = mosaic_builder or create_mosaic_builder()
+        self.mosaic_builder = self.__base_mosaic_builder.shrink_to_fit(
+            len(face_images))
+
+        # detection 済みの画像の faceId を引くキャッシュです。
+        # NOTE: 省略時はプロセス内で共有のものを使います。無効にしていれば None です。
+        self.detection_cache = (
+            cache or detection_cache.DetectionCache.get_shared())
+
+        # 連結画像のタイルごとの FaceImage のリストと、画像の内容のハッシュです。
+        # NOTE: 同じ画像が複数あればひとつのタイルにまとめるため、 FaceImage はリストです。
+        self.__tile_face_images = [[_] for _ in face_images]
+        self.__tile_hashes = [None] * len(face_images)
+
+        # (PersonGroupId, faceId): FaceImage のリスト です。
+        # NOTE: identification の結果ごとにセット全体を見直さないよう、1回だけ作ります。
+        self.__face_images_by_group_and_face_id = {}
+
+        # デコード、連結、エンコードを行うワーカープロセスのプールです。
+        # NOTE: 省略時はプロセス内で共有のものを使います。無効にしていれば None で、
+        # NOTE: その場合はこのプロセス内で mat を扱います。
+        self.process_pool = (
+            process_pool or tile_pool.TileProcessPool.get_shared())
+
+        # 顔のなさそうな画像を連結する前に除くフィルタです。
+        # NOTE: 省略時はプロセス内で共有のものを使います。無効にしていれば None です。
+        self.face_prefilter = (
+            face_prefilter or prefilter.FacePrefilter.get_shared())
+
     def __repr__(self) -> str:
 
         return [repr(face_image) for face_image in self.face_images]
 
     def identify_by_face_api(self) -> list:
 
+        # 実画像の取得から detection までを行い、各 FaceImage に faceId を与えます。
+        self.detect_by_face_api()
+
+        # Identification API を利用し、各 FaceImage に candidate を与えます。
+        self.identify()
+
+        # 各情報が付与された face_images を返却します。
+        return self.face_images
+
+    def detect_by_face_api(self) -> list:
+        """identify_by_face_api のうち、 detection までを行います。
+        identification をセットをまたいでまとめる場合に使います。
+        (identify_batch.IdentifyAccumulator)
+
+        Returns:
+            list: faceId が付与された face_images。
+        """
+
         # 実画像を mat で取得します。
-        mat_list = self.__get_mat_list()
+        mat_list = self.get_mat_list()
 
-        # mat を8x8で連結。内部で mat_list は空になります。
-        concatenated_mat = self.__concatenate_mat_8x8(mat_list)
+        # mat をタイル状に連結します。
+        # NOTE: デコード済みの mat は連結したら不要なので、すぐに手放します。
+        concatenated_mat = self.concatenate_mat(mat_list)
+        del mat_list
 
-        # Detection API にまわし、結果を取得します。
-        detection_result = face_api.FaceApiClient.detect_mat(concatenated_mat)
+        # Detection API にまわし、各 FaceImage に faceId を与えます。
+        self.detect(concatenated_mat)
+        del concatenated_mat
 
-        # 各 FaceImage に faceId を与えます。
-        self.__add_detected_face_ids(detection_result)
+        return self.face_images
 
-        # Identification API を利用し、各 FaceImage に candidate を与えます。
-        self.__identify_and_add_candidates()
+    async def identify_by_face_api_async(
+            self, client: face_api.AsyncFaceApiClient) -> list:
+        """identify_by_face_api の asyncio 版です。
+        identification はこのセットのぶんをすべて同時に投げます。
+
+        Args:
+            client (face_api.AsyncFaceApiClient): 同時実行数を制限するクライアント。
+
+        Returns:
+            list: 各情報が付与された face_images。
+        """
+
+        loop = asyncio.get_event_loop()
+
+        # 実画像の取得と連結は CPU とブロッキング I/O なのでスレッドで行います。
+        # NOTE: イベントループのスレッドで連結すると、そのあいだ他のセットの
+        # NOTE: detection や identification の応答を受け取れません。
+        # NOTE: プロセスプールを使う場合も、ワーカーの結果はスレッドで待ちます。
+        mat_list = await loop.run_in_executor(None, self.get_mat_list)
+        concatenated_mat = await loop.run_in_executor(
+            None, self.concatenate_mat, mat_list)
+        del mat_list
+
+        # Detection API にまわし、各 FaceImage に faceId を与えます。
+        # NOTE: 全画像がキャッシュにあれば detection は不要です。
+        if isinstance(concatenated_mat, bytes):
+            detected_at = time.time()
+            detection_result = await client.detect(concatenated_mat)
+            self.__add_detected_face_ids(detection_result, detected_at)
+        elif concatenated_mat is not None:
+            detected_at = time.time()
+            detection_result = await client.detect_mat(concatenated_mat)
+            self.__add_detected_face_ids(detection_result, detected_at)
+
+        # NOTE: detection が済めば連結画像とそのバッファは不要です。
+        # NOTE: identification の応答を待つあいだ、セットの数だけ抱えないよう手放します。
+        del concatenated_mat
+        self.__base_mosaic_builder = None
+        self.mosaic_builder = None
+
+        # Identification API に同時にまわします。
+        # NOTE: gather は投げた順で結果を返すため、 candidate の付与順は逐次版と同じです。
+        identify_requests = self.__get_identify_requests()
+        identification_results = await asyncio.gather(*(
+            client.identify(person_group_id, face_ids_max10)
+            for person_group_id, face_ids_max10 in identify_requests
+        ))
+        for (person_group_id, _), identification_result in zip(
+                identify_requests, identification_results):
+            self.__add_candidates(person_group_id, identification_result)
 
-        # 各情報が付与された face_images を返却します。
         return self.face_images
 
-    def __get_mat_list(self) -> list:
+    # NOTE: 以下の4メソッドは identify_by_face_api の各段階です。
+    # NOTE: pipeline.PipelineRunner が段階ごとに別スレッドで呼び出すため公開しています。
+
+    def get_mat_list(self) -> list:
         """self.face_images の各画像について実画像を mat 形式で取得します。
+        取得できなかった画像は self.face_images から self.unreadable_face_images に移します。
+        取得済みの画像を渡して作ったセットなら、それを返します。
 
         Returns:
             list: mat 形式の画像のリスト。
+                プロセスプールを使う場合は tile_pool.SharedTile のリストです。
+        """
+
+        if self.__fetched_mat_list is not None:
+            mat_list = self.__fetched_mat_list
+            self.__fetched_mat_list = None
+            return mat_list
+        return self.__remove_unreadable(self.__get_mat_list())
+
+    def concatenate_mat(self, mat_list: list) -> numpy.ndarray:
+        """画像の一覧を連結し、 detection にまわす1枚の mat を取得します。
+        detection 済みの画像はキャッシュの faceId を与え、連結しません。
+
+        Args:
+            mat_list (list): mat 形式の画像のリスト。
+
+        Returns:
+            numpy.ndarray: 連結したひとつの mat 画像。
+                すべての画像がキャッシュにあれば None です。
+                プロセスプールを使う場合はエンコード済みの bytes です。
+        """
+
+        return self.__concatenate_mat(mat_list)
+
+    def detect(self, concatenated_mat: numpy.ndarray) -> None:
+        """Detection API にまわし、各 FaceImage に faceId を与えます。
+
+        Args:
+            concatenated_mat (numpy.ndarray): 連結したひとつの mat 画像。
+                エンコード済みの bytes でも大丈夫です。
+                None (すべての画像がキャッシュにあった) なら何もしません。
+        """
+
+        if concatenated_mat is None:
+            return
+
+        # NOTE: faceId の有効期限は detection の時刻から数えます。
+        detected_at = time.time()
+        if isinstance(concatenated_mat, bytes):
+            detection_result = face_api.FaceApiClient.detect(concatenated_mat)
+        else:
+            detection_result = face_api.FaceApiClient.detect_mat(
+                concatenated_mat)
+        self.__add_detected_face_ids(detection_result, detected_at)
+
+    def identify(self) -> None:
+        """Identification API を利用し、各 FaceImage に candidate を与えます。
         """
 
-        # BlobServiceClient を作成します。
-        blob_service_client = BlobServiceClient.from_connection_string(
-            const.AZURE_STORAGE_CONNECTION_STRING)
+        self.__identify_and_add_candidates()
+
+    def remove_rejected(self, mat_list: list) -> list:
+        """prefilter で顔のなさそうな画像を self.rejected_face_images に移します。
+        除いた画像は連結せず、 Detection API にもまわしません。
+
+        Args:
+            mat_list (list): get_mat_list で取得した画像のリスト。
+
+        Returns:
+            list: 除いた残りの画像のリスト。順序は self.face_images と同じです。
+        """
+
+        # NOTE: ワーカーでデコードした画像は、判定もワーカーで済んでいます。
+        # NOTE: ここではワーカーと同じく、タイルに縮めた画像で判定します。
+        shared_metrics = metrics.Metrics.get_shared()
+        rejections = []
+        for mat in mat_list:
+            if isinstance(mat, tile_pool.SharedTile):
+                rejections.append(mat.rejection)
+            else:
+                with shared_metrics.time('prefilter'):
+                    rejections.append(self.face_prefilter.check(
+                        self.__base_mosaic_builder.fit_to_tile(mat)))
+        if not any(rejections):
+            return mat_list
+
+        kept_face_images = []
+        kept_mats = []
+        rejected_mats = []
+        rejected_counts = {}
+        for face_image, mat, rejection in zip(
+                self.face_images, mat_list, rejections):
+            if rejection is None:
+                kept_face_images.append(face_image)
+                kept_mats.append(mat)
+                continue
+            self.rejected_face_images.append(face_image)
+            rejected_mats.append(mat)
+            rejected_counts[rejection] = rejected_counts.get(rejection, 0) + 1
+        logging.warning(f'prefilter で保留にする件数: {rejected_counts}')
+
+        # NOTE: 除いた画像のスロットはすぐに返却します。
+        if self.process_pool is not None:
+            self.process_pool.release(rejected_mats)
+
+        # NOTE: 以降の連結と DB 更新は、残した画像だけを対象にします。
+        self.face_images = kept_face_images
+        return kept_mats
+
+    def get_pending_face_images(self) -> list:
+        """PENDING にする画像 (取得できなかった画像と、 prefilter で除いた画像) を取得します。
+        どちらも faceId がつかないため、 COMPLETED (matched=False) とは書き込みません。
+
+        Returns:
+            list: FaceImage のリスト。
+        """
+
+        return self.unreadable_face_images + self.rejected_face_images
+
+    def __get_mat_list(self) -> list:
+        """self.face_images の各画像について実画像を mat 形式で取得します。
+
+        Returns:
+            list: mat 形式の画像のリスト。
+                プロセスプールを使う場合は tile_pool.SharedTile のリストです。
+        """
 
         # 各 FaceImage の実画像を mat 形式で取得します。
-        mat_list = []
-        for face_image in self.face_images:
+        # NOTE: BlobServiceClient は実行中ずっと共有のものを使います。
+        # NOTE: 結果は self.face_images と同じ順序で返ってきます。
+        container_and_blob_names = [
+            tuple(face_image.get_container_and_blob_names())
+            for face_image in self.face_images
+        ]
+        if self.process_pool is None:
+            return blob_storage.BlobStorageClient.download_mats(
+                container_and_blob_names, self.max_workers)
+
+        # デコードはワーカーで行い、画素は共有メモリのタイルに置きます。
+        bytes_list = blob_storage.BlobStorageClient.download_bytes_list(
+            container_and_blob_names, self.max_workers)
+        return self.process_pool.decode(
+            bytes_list,
+            with_hash=self.detection_cache is not None,
+            face_prefilter=self.face_prefilter)
+
+    def __remove_unreadable(self, mat_list: list) -> list:
+        """取得できなかった画像を self.face_images から self.unreadable_face_images に移します。
+
+        Args:
+            mat_list (list): mat 形式の画像 (または tile_pool.SharedTile) のリスト。
+                大きすぎる、またはデコードできなかった画像は None です。
 
-            # BlobClient を作成します。
-            container_name, blob_name = (
-                face_image.get_container_and_blob_names())
-            blob_client = blob_service_client.get_blob_client(
-                container=container_name, blob=blob_name)
+        Returns:
+            list: 除いた残りの画像のリスト。順序は self.face_images と同じです。
+        """
 
-            # 画像を DL します。
-            # HACK: azure.core.pipeline.policies.http_logging_policy のログが多すぎてログが見づらい。抑制。  # noqa
-            downloaded_bytes = blob_client.download_blob().readall()
+        if all(mat is not None for mat in mat_list):
+            return mat_list
+
+        kept_face_images = []
+        kept_mats = []
+        for face_image, mat in zip(self.face_images, mat_list):
+            if mat is None:
+                self.unreadable_face_images.append(face_image)
+                continue
+            kept_face_images.append(face_image)
+            kept_mats.append(mat)
+        logging.warning(
+            f'取得できなかったため保留にする件数: {len(self.unreadable_face_images)}')
 
-            # 画像を mat 化します。
-            downloaded_ndarray = numpy.frombuffer(downloaded_bytes, numpy.uint8)
-            downloaded_mat = cv2.imdecode(downloaded_ndarray, cv2.IMREAD_COLOR)
-            mat_list.append(downloaded_mat)
-        return mat_list
+        # NOTE: 以降の連結と DB 更新は、取得できた画像だけを対象にします。
+        self.face_images = kept_face_images
+        return kept_mats
 
-    def __concatenate_mat_8x8(self, list_1d: list) -> numpy.ndarray:
-        """画像の一覧を連結し8x8の mat 形式で取得します。
+    def __concatenate_mat(self, list_1d: list) -> numpy.ndarray:
+        """画像の一覧をタイル状に連結した mat 形式で取得します。
 
         Args:
-            list_1d (list): mat 形式の画像のリスト。64枚なくても大丈夫です。
+            list_1d (list): mat 形式の画像のリスト。
+                tile_pool.SharedTile のリストなら、ワーカーで連結します。
 
         Returns:
             numpy.ndarray: 連結したひとつの mat 画像。
+                ワーカーで連結した場合はエンコード済みの bytes です。
         """
 
-        # 画像が64枚に満たないときのための空白画像です。
-        blank_mat = numpy.ones((100, 100, 3), numpy.uint8) * 255
+        if self.process_pool is None:
+            tile_mats = self.__select_tiles(list_1d)
+            if not tile_mats:
+                return None
+
+            # バッファの各タイルへ直接コピーします。
+            # NOTE: タイルの大きさに合わない画像は縮小します。空きタイルは白で埋まります。
+            with metrics.Metrics.get_shared().time('mosaic'):
+                return self.mosaic_builder.build(tile_mats)
+
+        # NOTE: 連結し終えたら、キャッシュで省いたタイルも含めてスロットを返却します。
+        try:
+            tiles = self.__select_tiles(list_1d)
+            if not tiles:
+                return None
+            return self.process_pool.build_and_encode(
+                tiles,
+                self.mosaic_builder.rows,
+                self.mosaic_builder.cols,
+                face_api.ImageEncoding.from_settings())
+        finally:
+            self.process_pool.release(list_1d)
+
+    def __select_tiles(self, list_1d: list) -> list:
+        """連結画像に並べる画像を選び、タイルと FaceImage の対応を作ります。
+        detection 済みの画像はキャッシュの faceId を与え、選びません。
+        self.mosaic_builder は選んだ枚数が収まる配置に縮めます。
 
-        # 8x8の2次元配列に変換します。
-        list_2d = util.convert_list_8x8(list_1d, blank_mat)
+        Args:
+            list_1d (list): mat 形式の画像 (または tile_pool.SharedTile) のリスト。
+
+        Returns:
+            list: 並べる順の画像のリスト。
+        """
+
+        self.__tile_face_images = []
+        self.__tile_hashes = []
+        tile_mats = []
+
+        # 画像の内容のハッシュ: タイルのインデックス です。
+        tile_index_by_hash = {}
 
-        # mat の1次元配列を受け取り、タイル状に連結します。
-        return cv2.vconcat([cv2.hconcat(list_1d) for list_1d in list_2d])
+        for face_image, mat in zip(self.face_images, list_1d):
+
+            if self.detection_cache is None:
+                self.__tile_face_images.append([face_image])
+                self.__tile_hashes.append(None)
+                tile_mats.append(mat)
+                continue
+
+            # NOTE: ワーカーでデコードした画像は、ハッシュもワーカーで求め済みです。
+            if isinstance(mat, tile_pool.SharedTile):
+                tile_hash = mat.tile_hash
+            else:
+                tile_hash = detection_cache.get_tile_hash(mat)
+
+            # 同じセットに同じ画像があれば、タイルはひとつにまとめます。
+            if tile_hash in tile_index_by_hash:
+                self.__tile_face_images[
+                    tile_index_by_hash[tile_hash]].append(face_image)
+                continue
 
-    def __add_detected_face_ids(self, detection_result: list) -> None:
+            # detection 済みの画像は連結せず、キャッシュの faceId で identification へ進みます。
+            face_id = self.detection_cache.get(tile_hash)
+            if face_id is not None:
+                face_image.detected_face_id = face_id
+                continue
+
+            tile_index_by_hash[tile_hash] = len(tile_mats)
+            self.__tile_face_images.append([face_image])
+            self.__tile_hashes.append(tile_hash)
+            tile_mats.append(mat)
+
+        # NOTE: キャッシュで減ったぶん、収まる最小のタイル配置に縮めます。
+        self.mosaic_builder = self.__base_mosaic_builder.shrink_to_fit(
+            len(tile_mats))
+        return tile_mats
+
+    def __add_detected_face_ids(self,
+                                detection_result: list,
+                                detected_at: float) -> None:
         """FaceImage.detected_face_id を埋めます。
 
         Args:
             detection_result (list): Detection 結果。
+            detected_at (float): detection を行った時刻 (UNIX 時間)。
         """
 
-        # 画像の一覧を一時的に2次元配列にします。
-        face_images_2d = util.convert_list_8x8(self.face_images, None)
-
         # faceRectangle の座標をもとに FaceImage.detected_face_id を埋めます。
         # HACK: detection_result を class 化すればもっと読みやすそう。
-        for result in detection_result:
-            face_rectangle = result['faceRectangle']
-
-            # x 軸で何番目の画像?
-            # NOTE: 画像サイズが100x100 なので、
-            # NOTE: 左上の x 座標 / 100 で切り捨て除算を行えば、 x 軸のインデックスになります。
-            horizontal_index = face_rectangle['left'] // 100
-            # y 軸で何番目の画像?
-            vertical_index = face_rectangle['top'] // 100
+        rectangles = numpy.array([
+            [result['faceRectangle']['left'],
+             result['faceRectangle']['top'],
+             result['faceRectangle']['width'],
+             result['faceRectangle']['height']]
+            for result in detection_result
+        ], numpy.float64).reshape(-1, 4)
+
+        # 顔の中心を含むタイルが、何番目の画像か一括で求めます。
+        # NOTE: 連結時と同じ MosaicBuilder が座標とインデックスの対応を持っています。
+        # NOTE: 1つのタイルに複数の顔があれば、面積の大きいものを選びます。
+        assignment = self.mosaic_builder.assign_rectangles(
+            rectangles, tile_count=len(self.__tile_face_images))
+
+        # 空きタイルや連結画像の外で検出されたもの、同じタイルで選ばれなかったものは使いません。
+        # NOTE: 使わない faceId を identification にまわすと、トランザクションの無駄です。
+        if len(assignment.unassigned) or len(assignment.conflicted):
+            logging.warning(
+                f'タイルに割り当てなかった顔があります。'
+                f'タイルの外: {len(assignment.unassigned)}, '
+                f'同じタイルの2つ目以降: {len(assignment.conflicted)}')
+
+        for index, rectangle_index in assignment.items():
+            result = detection_result[rectangle_index]
 
             # 座標から求めた、この faceId に対応する画像です。
-            target_image = face_images_2d[vertical_index][horizontal_index]
-            target_image.detected_face_id = result['faceId']
+            for target_image in self.__tile_face_images[index]:
+                target_image.detected_face_id = result['faceId']
+
+            # 次からは detection を省けるよう、画像の内容と faceId を覚えておきます。
+            tile_hash = self.__tile_hashes[index]
+            if self.detection_cache is not None and tile_hash is not None:
+                self.detection_cache.put(
+                    tile_hash, result['faceId'], detected_at)
 
     def __identify_and_add_candidates(self) -> None:
         """Identification API を利用し、各 FaceImage に candidate を与えます。
-        HACK: 読みづらすぎるし長いのでリファクタリング。
+        """
+
+        for person_group_id, face_ids_max10 in self.__get_identify_requests():
+
+            # Identification API にまわし、結果を取得します。
+            identification_result = face_api.FaceApiClient.identify(
+                person_group_id, face_ids_max10)
+
+            # 各 FaceImage に candidate を与えます。
+            self.__add_candidates(person_group_id, identification_result)
+
+    def __get_identify_requests(self) -> list:
+        """Identification API に投げる (PersonGroupId, faceId 最大10件) の一覧を作ります。
+
+        Returns:
+            list: (PersonGroupId, faceId のリスト) のリスト。
         """
 
         # Identification は person_group_id ごとに行います。
-        # そのため face_images を person_group_id ごとに分けます。
-        face_images_by_person_group_id = {}
+        # そのため faceId のある face_images を person_group_id ごとに分けます。
+        # NOTE: 同じ画像は同じ faceId を共有するため、 faceId の重複は除きます。
+        self.__face_images_by_group_and_face_id = {}
+        face_ids_by_person_group_id = {}
         for face_image in self.face_images:
+            face_id = face_image.detected_face_id
+            if not face_id:
+                continue
             person_group_id = face_image.get_person_group_id()
-            if person_group_id not in face_images_by_person_group_id:
-                face_images_by_person_group_id[person_group_id] = []
-            face_images_by_person_group_id[person_group_id].append(face_image)
-
-        # PersonGroupId ごとに identification API にまわします。
-        for person_group_id, face_images_in_group in face_images_by_person_group_id.items():  # noqa: E501
-            # このグループの画像の faceId 一覧を回収します。
-            face_ids = [
-                face_image.detected_face_id
-                for face_image in face_images_in_group
-                if face_image.detected_face_id
-            ]
-
-            while face_ids:
-
-                # faceId 10件ずつ処理します。
-                # NOTE: Identification API には最大で10件という制限があるため。
-                face_ids_max10 = face_ids[:10]
-                face_ids = face_ids[10:]
-
-                # Identification API にまわし、結果を取得します。
-                identification_result = face_api.FaceApiClient.identify(
-                    person_group_id, face_ids_max10)
-
-                # 各 FaceImage に candidate を与えます。
-                self.__add_candidates(identification_result)
-
-    def __add_candidates(self, identification_result: list) -> None:
+            key = (person_group_id, face_id)
+            if key not in self.__face_images_by_group_and_face_id:
+                self.__face_images_by_group_and_face_id[key] = []
+                face_ids_by_person_group_id.setdefault(
+                    person_group_id, []).append(face_id)
+            self.__face_images_by_group_and_face_id[key].append(face_image)
+
+        identify_requests = []
+        for person_group_id, face_ids in face_ids_by_person_group_id.items():
+
+            # faceId 10件ずつ処理します。
+            # NOTE: Identification API には最大で10件という制限があるため。
+            batch_size = face_api.FaceApiClient.IDENTIFY_MAX_FACE_IDS
+            for i in range(0, len(face_ids), batch_size):
+                identify_requests.append(
+                    (person_group_id, face_ids[i:i + batch_size]))
+        return identify_requests
+
+    def __add_candidates(self,
+                         person_group_id: str,
+                         identification_result: list) -> None:
         """FaceImage.candidate_person_id と FaceImage.candidate_confidence を埋めます。
+        同じ faceId の FaceImage (同じ内容の画像) には同じ候補を与えます。
 
         Args:
+            person_group_id (str): identification した PersonGroupId。
             identification_result (list): Identification 結果。
         """
 
-        # 次の処理で扱いやすいよう identification_result の構造を変えます。
-        # {faceId: {personId, confidence}}
-        # HACK: identification_result を class 化すればもっと読みやすそう。
-        result_dic = {}
         for result in identification_result:
 
             # 候補が見つからないときもあります。
             if not result['candidates']:
                 continue
 
-            result_dic[result['faceId']] = {
-                'personId': result['candidates'][0]['personId'],
-                'confidence': result['candidates'][0]['confidence'],
-            }
-
-        # 整理したデータをもとに candidate_person_id と candidate_confidence を埋めます。
-        for face_image in self.face_images:
-
-            if face_image.detected_face_id not in result_dic:
-                continue
-
-            face_image.candidate_person_id = result_dic[
-                face_image.detected_face_id]['personId']
-            face_image.candidate_confidence = result_dic[
-                face_image.detected_face_id]['confidence']
+            # __get_identify_requests で作った索引から、この faceId の FaceImage を引きます。
+            # NOTE: 同じ画像が別の PersonGroup にもあれば、そちらは別の結果で埋めます。
+            face_images = self.__face_images_by_group_and_face_id.get(
+                (person_group_id, result['faceId']), ())
+            for face_image in face_images:
+                face_image.candidate_person_id = (
+                    result['candidates'][0]['personId'])
+                face_image.candidate_confidence = (
+                    result['candidates'][0]['confidence'])
+
+
+def iter_image_sets(face_image_lists: object,
+                    mosaic_builder: mosaic.MosaicBuilder = None) -> object:
+    """連結画像1枚ぶんずつの FaceImage のリストから、 FaceImageSet を順に作ります。
+
+    prefilter を使う場合は、ここで実画像を取得して顔のなさそうな画像を除き、
+    空いたタイルを後続の画像で埋めます。除いた画像のぶん detection の回数が減ります。
+    NOTE: 除いた画像と取得できなかった画像は、そのとき作るセットの
+    NOTE: get_pending_face_images に入れます。 PENDING にするのは呼び出し側です。
+
+    Args:
+        face_image_lists (object): FaceImage のリストを順に返す iterable。
+            1つのリストは連結画像1枚に並ぶ数までです。
+        mosaic_builder (mosaic.MosaicBuilder): 全セットで共有する連結画像のバッファ。
+            省略時はセットごとに確保します。
+
+    Yields:
+        FaceImageSet: セット。 prefilter を使う場合は取得済みの画像を持ちます。
+    """
+
+    face_prefilter = prefilter.FacePrefilter.get_shared()
+    if face_prefilter is None:
+        for face_images in face_image_lists:
+            yield FaceImageSet(face_images, mosaic_builder=mosaic_builder)
+        return
+
+    # NOTE: 取得と判定だけを行うセットは連結しないため、バッファは1つで足ります。
+    fetch_mosaic_builder = mosaic_builder or create_mosaic_builder()
+    capacity = fetch_mosaic_builder.capacity
+
+    # 残した画像と mat、 PENDING にする画像です。セットに入れるまで持ちます。
+    # NOTE: 持つのは端数の1セットぶん未満と、取得した1セットぶんだけです。
+    kept_face_images = []
+    kept_mats = []
+    unreadable_face_images = []
+    rejected_face_images = []
+
+    def create_set(count: int) -> FaceImageSet:
+        face_image_set = FaceImageSet(kept_face_images[:count],
+                                      mosaic_builder=mosaic_builder,
+                                      face_prefilter=face_prefilter,
+                                      mat_list=kept_mats[:count])
+        face_image_set.unreadable_face_images = unreadable_face_images[:]
+        face_image_set.rejected_face_images = rejected_face_images[:]
+        del kept_face_images[:count], kept_mats[:count]
+        unreadable_face_images.clear()
+        rejected_face_images.clear()
+        return face_image_set
+
+    for face_images in face_image_lists:
+        fetched_set = FaceImageSet(face_images,
+                                   mosaic_builder=fetch_mosaic_builder,
+                                   face_prefilter=face_prefilter)
+        kept_mats.extend(
+            fetched_set.remove_rejected(fetched_set.get_mat_list()))
+        kept_face_images.extend(fetched_set.face_images)
+        unreadable_face_images.extend(fetched_set.unreadable_face_images)
+        rejected_face_images.extend(fetched_set.rejected_face_images)
+        del fetched_set
+
+        # タイルが埋まったぶんからセットにします。端数は次に取得する画像と合わせます。
+        while len(kept_face_images) >= capacity:
+            yield create_set(capacity)
+
+    if kept_face_images or unreadable_face_images or rejected_face_images:
+        yield create_set(len(kept_face_images))
 
 
 class FaceImage:
 
+    # NOTE: 10万件単位で作るため、インスタンスごとの __dict__ を持たせません。
+    __slots__ = ('id',
+                 'image_path',
+                 'person_id_from_history_log',
+                 'detected_face_id',
+                 'candidate_person_id',
+                 'candidate_confidence')
+
     def __init__(self,
                  id: int,
                  image_path: str,
@@ -289,3 +768,166 @@ class FaceImage:
         has_enough_confidence = self.candidate_confidence >= .78
 
         return person_id_is_matched and has_enough_confidence
+
+    def get_completed_status_values(self) -> tuple:
+        """MySqlClient.set_completed_statuses に渡す値を取得します。
+
+        Returns:
+            tuple: (matched, candidatePersonId, candidateConfidence, id)
+        """
+
+        return (self.matched(),
+                self.candidate_person_id,
+                self.candidate_confidence,
+                self.id)
+
+
+class FaceImageView(FaceImage):
+    """FaceImageBatch の1行を FaceImage として扱うための view です。
+    属性の読み書きはすべて FaceImageBatch の列に対して行います。
+    """
+
+    # NOTE: FaceImage の slot は使いません。下の property が優先されます。
+    __slots__ = ('batch', 'row')
+
+    def __init__(self, batch: 'FaceImageBatch', row: int):
+        self.batch = batch
+        self.row = row
+
+    @property
+    def id(self) -> int:
+        return self.batch.ids[self.row]
+
+    @property
+    def image_path(self) -> str:
+        return self.batch.image_paths[self.row]
+
+    @property
+    def person_id_from_history_log(self) -> str:
+        return self.batch.person_ids_from_history_log[self.row]
+
+    @property
+    def detected_face_id(self) -> str:
+        return self.batch.detected_face_ids[self.row]
+
+    @detected_face_id.setter
+    def detected_face_id(self, value: str) -> None:
+        self.batch.detected_face_ids[self.row] = value
+
+    @property
+    def candidate_person_id(self) -> str:
+        return self.batch.candidate_person_ids[self.row]
+
+    @candidate_person_id.setter
+    def candidate_person_id(self, value: str) -> None:
+        self.batch.candidate_person_ids[self.row] = (
+            sys.intern(value) if value is not None else None)
+
+    @property
+    def candidate_confidence(self) -> float:
+        return self.batch.candidate_confidences[self.row]
+
+    @candidate_confidence.setter
+    def candidate_confidence(self, value: float) -> None:
+        self.batch.candidate_confidences[self.row] = value
+
+    def get_person_group_id(self) -> str:
+
+        # NOTE: パスを分解し直さないよう、 FaceImageBatch で1回だけ求めます。
+        return self.batch.get_person_group_id(self.row)
+
+
+class FaceImageBatch:
+    """大量の FaceImage を列ごとの配列で持ちます。
+    1件ずつ FaceImage を持つより小さく済みます。
+
+    FaceImage として扱う場合は batch[row] で FaceImageView を取得します。
+    view はその場で作る軽いオブジェクトで、持ち続ける必要はありません。
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.image_paths = []
+        self.person_ids_from_history_log = []
+        self.detected_face_ids = []
+        self.candidate_person_ids = []
+        self.candidate_confidences = array('d')
+
+        # 行ごとの PersonGroupId です。初めて使うときに求めるため、それまでは None です。
+        # NOTE: faceId や PersonGroupId から行を引く索引は持ちません。
+        # NOTE: identification ではセット (FaceImageSet) やためている faceId
+        # NOTE: (identify_batch.IdentifyAccumulator) のぶんだけを引けば足ります。
+        self.__person_group_ids = []
+
+    @classmethod
+    def from_history_face_image_records(
+            cls, records: object) -> 'FaceImageBatch':
+        """HistoryFaceImage のレコードから FaceImageBatch を生成します。
+
+        Args:
+            records (object): レコードのリストやジェネレータ。
+
+        Returns:
+            FaceImageBatch: インスタンス。
+        """
+
+        batch = cls()
+        for record in records:
+            batch.append(record['id'],
+                         record['imagePath'],
+                         record['faceApiPersonId'])
+        return batch
+
+    def append(self,
+               id: int,
+               image_path: str,
+               person_id_from_history_log: str) -> FaceImageView:
+        """1行追加します。
+
+        Returns:
+            FaceImageView: 追加した行の view。
+        """
+
+        # NOTE: personId は多くの行で重複するため、同じ文字列オブジェクトを共有します。
+        self.ids.append(id)
+        self.image_paths.append(image_path)
+        self.person_ids_from_history_log.append(
+            sys.intern(person_id_from_history_log)
+            if person_id_from_history_log is not None else None)
+        self.detected_face_ids.append(None)
+        self.candidate_person_ids.append(None)
+        self.candidate_confidences.append(.0)
+        self.__person_group_ids.append(None)
+        return FaceImageView(self, len(self.ids) - 1)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, row: int) -> FaceImageView:
+
+        if not 0 <= row < len(self.ids):
+            raise IndexError(row)
+        return FaceImageView(self, row)
+
+    def __iter__(self) -> object:
+        return (FaceImageView(self, row) for row in range(len(self.ids)))
+
+    def iter_valid(self) -> object:
+        """有効な行の view を順に返します。
+
+        Yields:
+            FaceImageView: FaceImage.is_valid() が真の行の view。
+        """
+
+        for row in range(len(self.ids)):
+            if self.image_paths[row] and self.person_ids_from_history_log[row]:
+                yield FaceImageView(self, row)
+
+    def get_person_group_id(self, row: int) -> str:
+
+        person_group_id = self.__person_group_ids[row]
+        if person_group_id is None:
+            person_group_id = sys.intern(
+                FaceImage.get_person_group_id(FaceImageView(self, row)))
+            self.__person_group_ids[row] = person_group_id
+        return person_group_id
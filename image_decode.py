@@ -0,0 +1,132 @@
+
+# Built-in modules.
+import struct
+
+# Third-party modules.
+import numpy
+import cv2
+
+
+# 縮小率: 縮小しながらデコードする imread のフラグ です。
+# NOTE: JPEG は DCT の段階で縮めるため、デコードそのものが速くなります。
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# JPEG の SOF (Start Of Frame) マーカーです。ここに画像の大きさがあります。
+# NOTE: C4 (DHT), C8 (JPG), CC (DAC) は SOF ではありません。
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def get_image_size(bytes_image: bytes) -> tuple:
+    """デコードせずに、 JPEG か PNG のヘッダから画像の大きさを取得します。
+
+    Args:
+        bytes_image (bytes): 画像のバイナリ。
+
+    Returns:
+        tuple: (幅, 高さ)。 JPEG, PNG 以外やヘッダが読めない場合は None です。
+    """
+
+    # PNG は先頭の IHDR チャンクに幅と高さがあります。
+    if bytes_image[:8] == _PNG_SIGNATURE and len(bytes_image) >= 24:
+        return struct.unpack('>II', bytes_image[16:24])
+
+    if bytes_image[:2] != b'\xff\xd8':
+        return None
+
+    # JPEG はマーカーのセグメントを SOF まで読み飛ばします。
+    i = 2
+    while i + 9 <= len(bytes_image):
+        if bytes_image[i] != 0xFF:
+            return None
+        marker = bytes_image[i + 1]
+        if marker == 0xFF:
+            # マーカーの前の詰め物です。
+            i += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', bytes_image[i + 5:i + 9])
+            return width, height
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # 長さを持たないマーカーです。
+            i += 2
+            continue
+        length, = struct.unpack('>H', bytes_image[i + 2:i + 4])
+        i += 2 + length
+    return None
+
+
+def get_reduction_factor(width: int, height: int, tile_size: int) -> int:
+    """縮めてもタイルより小さくならない、最大の縮小率を取得します。
+
+    Args:
+        width (int): 画像の幅。
+        height (int): 画像の高さ。
+        tile_size (int): タイル1辺のピクセル数。
+
+    Returns:
+        int: 1, 2, 4, 8 のいずれか。
+    """
+
+    # NOTE: タイルには縦横比を変えて収めるため、短い辺がタイルより小さくならないようにします。
+    for factor in (8, 4, 2):
+        if min(width, height) >= tile_size * factor:
+            return factor
+    return 1
+
+
+def decode_tile(bytes_image: bytes, tile_size: int) -> tuple:
+    """画像をデコードします。タイルより十分大きい画像は縮小しながらデコードし、
+    タイルの大きさに縮めます。
+
+    Args:
+        bytes_image (bytes): 画像のバイナリ。 memoryview でも大丈夫です。
+        tile_size (int): タイル1辺のピクセル数。
+
+    Returns:
+        tuple: (mat 形式の画像, 縮小しなかった場合と比べて減った画素のバイト数)。
+            デコードできなければ mat は None です。
+            縮小しなかった画像は、従来どおり元の大きさのまま返します。
+    """
+
+    size = get_image_size(bytes_image)
+    factor = get_reduction_factor(*size, tile_size) if size else 1
+
+    mat = cv2.imdecode(numpy.frombuffer(bytes_image, numpy.uint8),
+                       REDUCED_READ_FLAGS[factor])
+    if mat is None or factor == 1:
+        return mat, 0
+
+    # NOTE: 縮小なので INTER_AREA です。 MosaicBuilder.fit_to_tile と同じ補間です。
+    full_bytes = size[0] * size[1] * mat.shape[2]
+    mat = cv2.resize(mat, (tile_size, tile_size),
+                     interpolation=cv2.INTER_AREA)
+    return mat, full_bytes - mat.nbytes
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    large_mat = numpy.full((900, 1200, 3), 128, numpy.uint8)
+    for extension in ('.jpg', '.png'):
+        bytes_image = cv2.imencode(extension, large_mat)[1].tobytes()
+        assert get_image_size(bytes_image) == (1200, 900)
+        mat, saved_bytes = decode_tile(bytes_image, 100)
+        assert mat.shape == (100, 100, 3)
+        assert saved_bytes == large_mat.nbytes - mat.nbytes
+
+    assert get_reduction_factor(1200, 900, 100) == 8
+    assert get_reduction_factor(1200, 300, 100) == 2
+    assert get_reduction_factor(150, 150, 100) == 1
+    assert get_image_size(b'GIF89a') is None
+
+    # タイルに近い大きさの画像は、従来どおりそのまま返します。
+    with open('./100x100-egc.png', 'rb') as f:
+        mat, saved_bytes = decode_tile(f.read(), 100)
+    assert mat.shape[:2] == (100, 100) and saved_bytes == 0
@@ -0,0 +1,332 @@
+
+# Built-in modules.
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Histogram:
+    """Prometheus の histogram と同じ形で、値の分布を集計します。
+    """
+
+    # 既定のバケットの上限 (秒) です。 Face API の呼び出しまで収まるよう 30 秒まで取ります。
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                       1, 2.5, 5, 10, 30)
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+
+        # バケットごとの件数です。末尾は +Inf のぶんです。
+        # NOTE: Prometheus の形式 (累積) には出力時に直します。
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = .0
+        self.max = .0
+
+    def observe(self, value: float) -> None:
+
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative_counts(self) -> list:
+        """(上限, 上限以下の件数) のリストを取得します。末尾の上限は +Inf です。
+        """
+
+        cumulative_counts = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),),
+                                self.bucket_counts):
+            total += count
+            cumulative_counts.append((bound, total))
+        return cumulative_counts
+
+    def quantile(self, q: float) -> float:
+        """バケットから分位点を見積もります。バケット内は一様に分布するとみなします。
+
+        Args:
+            q (float): 0.0 から 1.0 の分位。
+
+        Returns:
+            float: 分位点の見積もり。
+        """
+
+        if not self.count:
+            return .0
+
+        rank = q * self.count
+        lower = .0
+        previous_total = 0
+        for bound, total in self.cumulative_counts():
+            if total >= rank:
+                if bound == float('inf'):
+                    return self.max
+                in_bucket = total - previous_total
+                fraction = (rank - previous_total) / in_bucket
+                return min(lower + (bound - lower) * fraction, self.max)
+            lower = bound
+            previous_total = total
+        return self.max
+
+
+class Metrics:
+    """処理の段階ごとの所要時間、転送バイト数、 Face API のトランザクション数を集計します。
+    Prometheus のテキスト形式と、実行結果の JSON に出力できます。
+
+    段階の名前は以下です。
+        db_fetch, blob_download, decode, mosaic, encode, detect, identify,
+        db_update
+    """
+
+    # 出力するメトリクス名の接頭辞です。
+    PREFIX = 'face_recognition'
+
+    # プロセス内で共有する集計です。
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+        # 段階: Histogram です。
+        self.stage_seconds = {}
+
+        # 段階: バイト数 です。
+        self.stage_bytes = {}
+
+        # Face API の操作 (detect, identify): 件数 です。
+        self.face_api_transactions = {}
+        self.face_api_faces = {}
+        self.face_api_retries = {}
+
+        # 処理した画像の件数です。
+        self.images = 0
+
+    @classmethod
+    def get_shared(cls) -> 'Metrics':
+        """プロセス内で共有する集計を取得します。初回呼び出し時に作成します。
+
+        Returns:
+            Metrics: 共有の集計。
+        """
+
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @classmethod
+    def reset_shared(cls) -> 'Metrics':
+        """共有の集計を空にします。実行ごとに集計し直す場合に使います。
+
+        Returns:
+            Metrics: 新しい共有の集計。
+        """
+
+        with cls._shared_lock:
+            cls._shared = cls()
+            return cls._shared
+
+    @contextmanager
+    def time(self, stage: str):
+        """with 文の中の所要時間を stage のものとして集計します。
+
+        Args:
+            stage (str): 段階の名前。
+        """
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage: str, seconds: float) -> None:
+
+        with self._lock:
+            if stage not in self.stage_seconds:
+                self.stage_seconds[stage] = Histogram()
+            self.stage_seconds[stage].observe(seconds)
+
+    def add_bytes(self, stage: str, byte_count: int) -> None:
+
+        with self._lock:
+            self.stage_bytes[stage] = (
+                self.stage_bytes.get(stage, 0) + byte_count)
+
+    def add_face_api_transaction(self,
+                                 operation: str,
+                                 face_count: int) -> None:
+        """成功した Face API の呼び出し (課金されるトランザクション) を集計します。
+
+        Args:
+            operation (str): detect または identify。
+            face_count (int): detect なら検出した顔の数、 identify なら送った faceId の数。
+        """
+
+        with self._lock:
+            self.face_api_transactions[operation] = (
+                self.face_api_transactions.get(operation, 0) + 1)
+            self.face_api_faces[operation] = (
+                self.face_api_faces.get(operation, 0) + face_count)
+
+    def add_face_api_retry(self, operation: str) -> None:
+
+        with self._lock:
+            self.face_api_retries[operation] = (
+                self.face_api_retries.get(operation, 0) + 1)
+
+    def add_images(self, image_count: int) -> None:
+
+        with self._lock:
+            self.images += image_count
+
+    def to_summary(self) -> dict:
+        """実行結果の要約を取得します。
+
+        Returns:
+            dict: 段階ごとの件数、合計、分位点と、 Face API の効率です。
+        """
+
+        with self._lock:
+            stages = {}
+            for stage, histogram in self.stage_seconds.items():
+                stages[stage] = {
+                    'count': histogram.count,
+                    'seconds': round(histogram.sum, 6),
+                    'p50_ms': round(histogram.quantile(.5) * 1000, 3),
+                    'p95_ms': round(histogram.quantile(.95) * 1000, 3),
+                    'p99_ms': round(histogram.quantile(.99) * 1000, 3),
+                    'max_ms': round(histogram.max * 1000, 3),
+                }
+            for stage, byte_count in self.stage_bytes.items():
+                stages.setdefault(stage, {})['bytes'] = byte_count
+
+            face_api = {}
+            for operation, count in self.face_api_transactions.items():
+                face_api[operation] = {
+                    'transactions': count,
+                    'faces': self.face_api_faces[operation],
+                    'faces_per_call': round(
+                        self.face_api_faces[operation] / count, 3),
+                    'retries': self.face_api_retries.get(operation, 0),
+                }
+            transactions = sum(self.face_api_transactions.values())
+
+            return {
+                'started_at': self.started_at,
+                'wall_seconds': round(time.time() - self.started_at, 3),
+                'images': self.images,
+                'face_api_transactions': transactions,
+                'face_api_transactions_per_image': round(
+                    transactions / self.images, 4) if self.images else .0,
+                'stages': stages,
+                'face_api': face_api,
+            }
+
+    def to_prometheus_text(self) -> str:
+        """Prometheus のテキスト形式 (node_exporter の textfile collector 用) で出力します。
+
+        Returns:
+            str: テキスト。
+        """
+
+        prefix = self.PREFIX
+        lines = []
+        with self._lock:
+            lines.append(f'# HELP {prefix}_stage_seconds '
+                         'Time spent in each processing stage.')
+            lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+            for stage, histogram in sorted(self.stage_seconds.items()):
+                for bound, total in histogram.cumulative_counts():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{prefix}_stage_seconds_bucket'
+                                 f'{{stage="{stage}",le="{le}"}} {total}')
+                lines.append(f'{prefix}_stage_seconds_sum'
+                             f'{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_seconds_count'
+                             f'{{stage="{stage}"}} {histogram.count}')
+
+            lines.append(f'# HELP {prefix}_stage_bytes_total '
+                         'Bytes transferred in each processing stage.')
+            lines.append(f'# TYPE {prefix}_stage_bytes_total counter')
+            for stage, byte_count in sorted(self.stage_bytes.items()):
+                lines.append(f'{prefix}_stage_bytes_total'
+                             f'{{stage="{stage}"}} {byte_count}')
+
+            for name, values, description in (
+                    ('face_api_transactions_total',
+                     self.face_api_transactions,
+                     'Successful (billed) Face API calls.'),
+                    ('face_api_faces_total',
+                     self.face_api_faces,
+                     'Faces detected or sent to identification.'),
+                    ('face_api_retries_total',
+                     self.face_api_retries,
+                     'Retried Face API calls.')):
+                lines.append(f'# HELP {prefix}_{name} {description}')
+                lines.append(f'# TYPE {prefix}_{name} counter')
+                for operation, count in sorted(values.items()):
+                    lines.append(f'{prefix}_{name}'
+                                 f'{{operation="{operation}"}} {count}')
+
+            lines.append(f'# HELP {prefix}_images_total Images processed.')
+            lines.append(f'# TYPE {prefix}_images_total counter')
+            lines.append(f'{prefix}_images_total {self.images}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self,
+              prometheus_path: str = None,
+              json_path: str = None) -> None:
+        """ファイルに出力します。
+
+        Args:
+            prometheus_path (str): Prometheus のテキスト形式の出力先。 None なら出力しません。
+            json_path (str): 実行結果の JSON の出力先。 None なら出力しません。
+        """
+
+        # NOTE: 収集中のファイルを読まれないよう、一時ファイルに書いてから置き換えます。
+        for path, text in (
+                (prometheus_path, self.to_prometheus_text),
+                (json_path, lambda: json.dumps(
+                    self.to_summary(), ensure_ascii=False, indent=2))):
+            if not path:
+                continue
+            temporary_path = f'{path}.tmp'
+            with open(temporary_path, 'w', encoding='utf-8') as f:
+                f.write(text())
+            os.replace(temporary_path, path)
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    histogram = Histogram(buckets=(1, 2, 4))
+    for value in (.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.cumulative_counts() == [
+        (1, 1), (2, 3), (4, 4), (float('inf'), 5)]
+    assert histogram.quantile(.5) == 1.75
+    assert histogram.quantile(1) == 10
+
+    metrics = Metrics()
+    with metrics.time('detect'):
+        pass
+    metrics.add_bytes('blob_download', 300)
+    metrics.add_face_api_transaction('detect', 64)
+    metrics.add_face_api_transaction('identify', 10)
+    metrics.add_images(64)
+    summary = metrics.to_summary()
+    assert summary['stages']['detect']['count'] == 1
+    assert summary['stages']['blob_download']['bytes'] == 300
+    assert summary['face_api']['detect']['faces_per_call'] == 64
+    assert summary['face_api_transactions_per_image'] == round(2 / 64, 4)
+    text = metrics.to_prometheus_text()
+    assert 'face_recognition_stage_seconds_count{stage="detect"} 1' in text
+    assert 'face_recognition_images_total 64' in text
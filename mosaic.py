@@ -0,0 +1,286 @@
+
+# Third-party modules.
+import numpy
+import cv2
+
+
+class MosaicBuilder:
+    """画像をタイル状に並べた1枚の mat を作ります。
+
+    連結先のバッファをひとつ確保し、各タイルの view へ直接コピーします。
+    タイルの位置と画像のインデックスの対応もここで扱います。
+    """
+
+    # 画像が足りない空きタイルの色です。
+    BLANK_VALUE = 255
+
+    def __init__(self, rows: int = 8, cols: int = 8, tile_size: int = 100):
+        """
+        Args:
+            rows (int): 縦のタイル数。
+            cols (int): 横のタイル数。
+            tile_size (int): タイル1辺のピクセル数。
+        """
+
+        self.rows = rows
+        self.cols = cols
+        self.tile_size = tile_size
+
+        # 連結先のバッファです。 build のたびに使い回します。
+        self.buffer = numpy.empty(
+            (rows * tile_size, cols * tile_size, 3), numpy.uint8)
+
+    @property
+    def capacity(self) -> int:
+        """1枚に並べられる画像の数です。
+        """
+
+        return self.rows * self.cols
+
+    def tile_view(self, index: int) -> numpy.ndarray:
+        """index 番目のタイルに当たるバッファの view を取得します。
+
+        Args:
+            index (int): 画像のインデックス。左上から右へ、行ごとに数えます。
+
+        Returns:
+            numpy.ndarray: バッファの view。書き込むとバッファに反映されます。
+        """
+
+        vertical_index, horizontal_index = divmod(index, self.cols)
+        top = vertical_index * self.tile_size
+        left = horizontal_index * self.tile_size
+        return self.buffer[top:top + self.tile_size,
+                           left:left + self.tile_size]
+
+    def build(self, mat_list: list) -> numpy.ndarray:
+        """画像の一覧をバッファに並べます。
+
+        NOTE: 戻り値はバッファそのものです。次に build を呼ぶと上書きされます。
+        NOTE: 別のスレッドで使い続ける場合は MosaicBuilder をセットごとに作ってください。
+
+        Args:
+            mat_list (list): mat 形式の画像のリスト。 capacity 枚なくても大丈夫です。
+
+        Raises:
+            ValueError: 画像が capacity 枚より多い。
+
+        Returns:
+            numpy.ndarray: 連結したひとつの mat 画像。
+        """
+
+        if len(mat_list) > self.capacity:
+            raise ValueError(
+                f'{len(mat_list)} images do not fit in '
+                f'{self.rows}x{self.cols} tiles.')
+
+        for index, mat in enumerate(mat_list):
+            self.tile_view(index)[...] = self.fit_to_tile(mat)
+
+        # 空きタイルは白で埋めます。
+        # NOTE: 前回の build の画像が残らないようにするためです。
+        # NOTE: 途中までの行はタイルごとに、まるごと空いている行はまとめて埋めます。
+        filled_rows = -(-len(mat_list) // self.cols)
+        for index in range(len(mat_list), filled_rows * self.cols):
+            self.tile_view(index).fill(self.BLANK_VALUE)
+        self.buffer[filled_rows * self.tile_size:].fill(self.BLANK_VALUE)
+
+        return self.buffer
+
+    def fit_to_tile(self, mat: numpy.ndarray) -> numpy.ndarray:
+        """タイルの大きさに合わない画像を縮小 (または拡大) します。
+
+        Args:
+            mat (numpy.ndarray): mat 形式の画像。
+
+        Returns:
+            numpy.ndarray: tile_size x tile_size の mat 画像。
+        """
+
+        height, width = mat.shape[:2]
+        if height == self.tile_size and width == self.tile_size:
+            return mat
+
+        # NOTE: 縮小には INTER_AREA がきれいです。拡大は INTER_LINEAR にします。
+        interpolation = (cv2.INTER_AREA
+                         if max(height, width) > self.tile_size
+                         else cv2.INTER_LINEAR)
+        return cv2.resize(mat, (self.tile_size, self.tile_size),
+                          interpolation=interpolation)
+
+    def shrink_to_fit(self, count: int) -> 'MosaicBuilder':
+        """count 枚が収まる最小のタイル配置の MosaicBuilder を取得します。
+        端数のセットで、白い余白ばかりの大きな画像を送らないようにするためです。
+
+        Args:
+            count (int): 並べる画像の数。
+
+        Returns:
+            MosaicBuilder: 縮めた MosaicBuilder。縮める必要がなければ self です。
+        """
+
+        rows, cols = self.rows, self.cols
+        for candidate_cols in range(1, self.cols + 1):
+            candidate_rows = max(-(-count // candidate_cols), 1)
+            if candidate_rows > self.rows:
+                continue
+
+            # タイル数が少ないものを、同数なら正方形に近いもの、横長のものを選びます。
+            if (_grid_preference(candidate_rows, candidate_cols)
+                    < _grid_preference(rows, cols)):
+                rows, cols = candidate_rows, candidate_cols
+
+        if (rows, cols) == (self.rows, self.cols):
+            return self
+        return MosaicBuilder(rows, cols, self.tile_size)
+
+    def assign_rectangles(self,
+                          rectangles: numpy.ndarray,
+                          tile_count: int = None) -> 'RectangleAssignment':
+        """検出された顔の矩形を、中心の座標からタイルへ一括で割り当てます。
+        1つのタイルに複数の顔があれば、面積の大きいもの、同じならタイルの中心に近いものを選びます。
+
+        Args:
+            rectangles (numpy.ndarray): (顔の数, 4) の left, top, width, height。
+            tile_count (int): 画像を置いたタイルの数。これ以降の空きタイルの顔は割り当てません。
+                省略時は全タイルです。
+
+        Returns:
+            RectangleAssignment: 割り当ての結果。
+        """
+
+        if tile_count is None:
+            tile_count = self.capacity
+        rectangles = numpy.asarray(rectangles, numpy.float64).reshape(-1, 4)
+        left, top, width, height = rectangles.T
+
+        # NOTE: 左上の座標では、隣のタイルの余白から始まる顔を隣の画像に割り当ててしまいます。
+        center_x = left + width / 2
+        center_y = top + height / 2
+        horizontal_indexes = numpy.floor(center_x / self.tile_size)
+        vertical_indexes = numpy.floor(center_y / self.tile_size)
+        tile_indexes = (vertical_indexes * self.cols
+                        + horizontal_indexes).astype(numpy.int64)
+
+        # 連結画像の外や、空きタイルの顔です。
+        inside = ((0 <= horizontal_indexes) & (horizontal_indexes < self.cols)
+                  & (0 <= vertical_indexes) & (vertical_indexes < self.rows)
+                  & (tile_indexes < tile_count))
+        candidates = numpy.flatnonzero(inside)
+
+        # タイルごとに、面積の大きい順、タイルの中心に近い順に並べ、先頭を選びます。
+        # NOTE: lexsort は最後のキーから優先します。
+        half = self.tile_size / 2
+        distances = numpy.hypot(
+            center_x - (horizontal_indexes * self.tile_size + half),
+            center_y - (vertical_indexes * self.tile_size + half))
+        order = candidates[numpy.lexsort((
+            distances[candidates],
+            -(width * height)[candidates],
+            tile_indexes[candidates]))]
+        sorted_tile_indexes = tile_indexes[order]
+        is_first = numpy.ones(len(order), bool)
+        is_first[1:] = sorted_tile_indexes[1:] != sorted_tile_indexes[:-1]
+
+        assigned = numpy.full(tile_count, -1, numpy.int64)
+        assigned[sorted_tile_indexes[is_first]] = order[is_first]
+        return RectangleAssignment(assigned,
+                                   numpy.flatnonzero(~inside),
+                                   numpy.sort(order[~is_first]))
+
+    def tile_index_at(self, x: int, y: int) -> int:
+        """座標を含むタイルの、画像のインデックスを取得します。
+
+        Args:
+            x (int): 連結画像上の x 座標。
+            y (int): 連結画像上の y 座標。
+
+        Returns:
+            int: 画像のインデックス。連結画像の外なら None です。
+        """
+
+        horizontal_index = x // self.tile_size
+        vertical_index = y // self.tile_size
+        if not (0 <= horizontal_index < self.cols
+                and 0 <= vertical_index < self.rows):
+            return None
+        return vertical_index * self.cols + horizontal_index
+
+
+class RectangleAssignment:
+    """MosaicBuilder.assign_rectangles の結果です。
+    """
+
+    __slots__ = ('rectangle_indexes', 'unassigned', 'conflicted')
+
+    def __init__(self,
+                 rectangle_indexes: numpy.ndarray,
+                 unassigned: numpy.ndarray,
+                 conflicted: numpy.ndarray):
+        """
+        Args:
+            rectangle_indexes (numpy.ndarray): タイルごとの、割り当てた矩形のインデックス。
+                顔のないタイルは -1 です。
+            unassigned (numpy.ndarray): 連結画像の外や空きタイルにあった矩形のインデックス。
+            conflicted (numpy.ndarray): 同じタイルのほかの顔に負けた矩形のインデックス。
+        """
+
+        self.rectangle_indexes = rectangle_indexes
+        self.unassigned = unassigned
+        self.conflicted = conflicted
+
+    def items(self) -> object:
+        """(タイルのインデックス, 矩形のインデックス) を顔のあるタイルについて順に返します。
+        """
+
+        tile_indexes = numpy.flatnonzero(self.rectangle_indexes >= 0)
+        return zip(tile_indexes.tolist(),
+                   self.rectangle_indexes[tile_indexes].tolist())
+
+
+def _grid_preference(rows: int, cols: int) -> tuple:
+    """タイル配置を比べるためのキーです。小さいほど好ましい配置です。
+    """
+
+    return (rows * cols, abs(rows - cols), -cols)
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    builder = MosaicBuilder(rows=2, cols=3, tile_size=2)
+    mat_list = [numpy.full((2, 2, 3), i, numpy.uint8) for i in range(4)]
+    actual = builder.build(mat_list)[:, :, 0].tolist()
+    expected = [
+        [0, 0, 1, 1, 2, 2],
+        [0, 0, 1, 1, 2, 2],
+        [3, 3, 255, 255, 255, 255],
+        [3, 3, 255, 255, 255, 255]]
+    assert actual == expected
+
+    assert builder.tile_index_at(0, 0) == 0
+    assert builder.tile_index_at(5, 1) == 2
+    assert builder.tile_index_at(1, 3) == 3
+    assert builder.tile_index_at(6, 0) is None
+
+    # 中心で割り当てます。 1 番目の矩形は左上が 0 番のタイルでも、中心は 1 番です。
+    # 3 番のタイルには2つあり、面積の大きい 3 番目が勝ちます。 4 番目は空きタイルです。
+    rectangles = [[0, 0, 2, 2], [1, 0, 2, 2], [0, 2, 1, 1],
+                  [0, 2, 2, 2], [2, 2, 2, 2], [9, 9, 1, 1]]
+    assignment = builder.assign_rectangles(rectangles, tile_count=4)
+    assert assignment.rectangle_indexes.tolist() == [0, 1, -1, 3]
+    assert assignment.unassigned.tolist() == [4, 5]
+    assert assignment.conflicted.tolist() == [2]
+    assert list(assignment.items()) == [(0, 0), (1, 1), (3, 3)]
+
+    actual = builder.fit_to_tile(numpy.zeros((5, 7, 3), numpy.uint8)).shape
+    assert actual == (2, 2, 3)
+
+    builder = MosaicBuilder()
+    assert builder.shrink_to_fit(64) is builder
+    actual = builder.shrink_to_fit(3)
+    assert (actual.rows, actual.cols) == (1, 3)
+    actual = builder.shrink_to_fit(10)
+    assert (actual.rows, actual.cols) == (2, 5)
+    actual = builder.shrink_to_fit(50)
+    assert (actual.rows, actual.cols) == (7, 8)
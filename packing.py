@@ -0,0 +1,108 @@
+
+# Built-in modules.
+from collections import OrderedDict
+
+
+def pack_by_key(items: list, capacity: int, key: callable) -> list:
+    """items を key (PersonGroupId など) ごとにまとめてから、 capacity 件ずつのセットに分けます。
+
+    セットの数は、 DB の順序のまま capacity 件ずつ分けた場合と同じです。
+    最後のセット以外は capacity 件ちょうどで、連結画像の空きタイルは増えません。
+    そのうえで、同じ key の items はできるだけ同じセットに入れ、
+    1つの key がまたがるセットは連続する2つまでです (capacity を超えるぶんを除く)。
+
+    Args:
+        items (list): FaceImage などのリスト。
+        capacity (int): 1セットの件数の上限。連結画像1枚に並ぶ数です。
+        key (callable): item を受け取り、まとめる単位 (PersonGroupId) を返す関数。
+
+    Returns:
+        list: セット (items のリスト) のリスト。
+    """
+
+    # key ごとに、最初に現れた順で分けます。
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+
+    # capacity 件そろう key は、その key だけのセットにします。
+    sets = []
+    remainders = []
+    for group in groups.values():
+        full_count = len(group) - len(group) % capacity
+        for i in range(0, full_count, capacity):
+            sets.append(group[i:i + capacity])
+        if full_count < len(group):
+            remainders.append(group[full_count:])
+
+    # 端数は多い順に詰め、 capacity 件ごとに切ります。
+    # NOTE: セットの境目にかかる key だけが2つのセットに分かれます。
+    # NOTE: 多い順にすると、少ない key ほど境目にかからず1つのセットに収まります。
+    # NOTE: sorted は安定なので、同じ件数なら最初に現れた順です。
+    remainders.sort(key=len, reverse=True)
+    current_set = []
+    for remainder in remainders:
+        while remainder:
+            space = capacity - len(current_set)
+            current_set.extend(remainder[:space])
+            remainder = remainder[space:]
+            if len(current_set) == capacity:
+                sets.append(current_set)
+                current_set = []
+    if current_set:
+        sets.append(current_set)
+    return sets
+
+
+def count_identify_calls(sets: list, key: callable, batch_size: int) -> int:
+    """セットごとに identification したときの呼び出し回数を数えます。
+
+    Args:
+        sets (list): セット (items のリスト) のリスト。
+        key (callable): item を受け取り、 PersonGroupId を返す関数。
+        batch_size (int): 1回の identification に送れる faceId の数。
+
+    Returns:
+        int: 呼び出し回数。
+    """
+
+    calls = 0
+    for items in sets:
+        counts = {}
+        for item in items:
+            group = key(item)
+            counts[group] = counts.get(group, 0) + 1
+        calls += sum(-(-count // batch_size) for count in counts.values())
+    return calls
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    items = [f'{group}{i}'
+             for i in range(70)
+             for group in 'abc'
+             if group == 'a' or (group == 'b' and i < 30) or
+             (group == 'c' and i < 5)]
+
+    def get_group(item):
+        return item[0]
+
+    sets = pack_by_key(items, 64, get_group)
+
+    # セット数は変わらず、最後以外は満杯です。
+    assert len(sets) == -(-len(items) // 64) == 2
+    assert [len(_) for _ in sets] == [64, 41]
+    assert sorted(sum(sets, [])) == sorted(items)
+
+    # a は64件のセットと端数の6件、 b と c はどちらも1つのセットに収まります。
+    assert set(map(get_group, sets[0])) == {'a'}
+    assert {get_group(_) for _ in sets[1]} == {'a', 'b', 'c'}
+
+    # DB の順序 (PersonGroup が交互) のまま分けるより、 identification が減ります。
+    items = [f'{group}{i}' for i in range(30) for group in 'abcd']
+    sets = pack_by_key(items, 64, get_group)
+    in_order = [items[i:i + 64] for i in range(0, len(items), 64)]
+    assert [len(_) for _ in sets] == [64, 56]
+    assert count_identify_calls(sets, get_group, 10) == 7 + 6
+    assert count_identify_calls(in_order, get_group, 10) == 8 + 8
@@ -0,0 +1,464 @@
+
+# Built-in modules.
+import logging
+import queue
+import threading
+import time
+
+# My modules.
+import const
+import db_client
+import metrics
+import profiling
+
+
+# 段階間キューに流す、終端を表すオブジェクトです。
+_END = object()
+
+
+class MatBudget:
+    """同時に保持できるデコード済み mat の枚数を制限します。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self.peak = 0
+        self.closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, count: int) -> None:
+        """count 枚ぶんの空きができるまで待ちます。
+
+        Args:
+            count (int): 確保する枚数。
+        """
+
+        # NOTE: 上限より大きいセットが来ても止まらないよう、上限で頭打ちにします。
+        count = min(count, self.capacity)
+        with self._condition:
+            while not self.closed and self.in_use + count > self.capacity:
+                self._condition.wait()
+            self.in_use += count
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, count: int) -> None:
+        """count 枚ぶんを返却します。
+
+        Args:
+            count (int): 返却する枚数。
+        """
+
+        count = min(count, self.capacity)
+        with self._condition:
+            self.in_use -= count
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """待っているスレッドをすべて解放します。異常終了時に使います。
+        """
+
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class StageStats:
+    """パイプラインの段階ごとの稼働状況です。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.busy_seconds = .0
+        self.items = 0
+
+    def add(self, seconds: float) -> None:
+        self.busy_seconds += seconds
+        self.items += 1
+
+    def utilization(self, wall_seconds: float) -> float:
+        """実行時間のうち、この段階が処理をしていた割合です。
+
+        Args:
+            wall_seconds (float): パイプライン全体の実行時間。
+
+        Returns:
+            float: 0.0 から 1.0 の稼働率。
+        """
+
+        if wall_seconds <= 0:
+            return .0
+        return self.busy_seconds / wall_seconds
+
+
+class PipelineRunner:
+    """FaceImageSet を fetch -> mosaic -> detect -> identify -> DB 更新の
+    各段階に分け、段階ごとのスレッドで並行に処理します。
+    セット N が detect 中に、セット N+1 のダウンロードが進みます。
+    """
+
+    STAGE_NAMES = ('fetch', 'mosaic', 'detect', 'identify', 'db_write')
+
+    def __init__(self,
+                 queue_size: int = None,
+                 max_mats_in_flight: int = None):
+        """
+        Args:
+            queue_size (int): 段階間キューの大きさ。
+                省略時は const.PIPELINE_QUEUE_SIZE です。
+            max_mats_in_flight (int): 同時に保持できるデコード済み mat の枚数。
+                省略時は const.PIPELINE_MAX_MATS_IN_FLIGHT です。
+        """
+
+        if queue_size is None:
+            queue_size = const.PIPELINE_QUEUE_SIZE
+        if max_mats_in_flight is None:
+            max_mats_in_flight = const.PIPELINE_MAX_MATS_IN_FLIGHT
+
+        self.queue_size = queue_size
+        self.mat_budget = MatBudget(max_mats_in_flight)
+        self.stats = {name: StageStats(name) for name in self.STAGE_NAMES}
+        self.wall_seconds = .0
+
+        # 処理済みの FaceImage です。
+        self.completed_face_images = []
+
+        self._failed = threading.Event()
+        self._errors = []
+
+    def run(self, face_image_sets: iter) -> list:
+        """パイプラインを実行します。
+
+        Args:
+            face_image_sets (iter): FaceImageSet を順に返す iterable。
+
+        Raises:
+            Exception: いずれかの段階で起きた最初の例外。
+
+        Returns:
+            list: DB 更新まで完了した FaceImage のリスト。
+        """
+
+        # 段階の数 - 1 個のキューでつなぎます。
+        queues = [queue.Queue(maxsize=self.queue_size)
+                  for _ in range(len(self.STAGE_NAMES) - 1)]
+
+        threads = [
+            threading.Thread(
+                target=self.__run_source,
+                args=(face_image_sets, queues[0]),
+                name='pipeline-fetch'),
+            threading.Thread(
+                target=self.__run_stage,
+                args=('mosaic', self.__mosaic, queues[0], queues[1],
+                      self.__discard_mats),
+                name='pipeline-mosaic'),
+            threading.Thread(
+                target=self.__run_stage,
+                args=('detect', self.__detect, queues[1], queues[2]),
+                name='pipeline-detect'),
+            threading.Thread(
+                target=self.__run_stage,
+                args=('identify', self.__identify, queues[2], queues[3]),
+                name='pipeline-identify'),
+            threading.Thread(
+                target=self.__run_db_write_stage,
+                args=(queues[3],),
+                name='pipeline-db_write'),
+        ]
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.wall_seconds = time.perf_counter() - started
+
+        if self._errors:
+            raise self._errors[0]
+        return self.completed_face_images
+
+    def report(self) -> str:
+        """段階ごとの稼働率のレポートを作ります。
+
+        Returns:
+            str: 1行1段階のレポート。
+        """
+
+        lines = [f'wall={self.wall_seconds:.3f}s, '
+                 f'peak mats in flight={self.mat_budget.peak}'
+                 f'/{self.mat_budget.capacity}']
+        for stats in self.stats.values():
+            lines.append(
+                f'{stats.name}: items={stats.items}, '
+                f'busy={stats.busy_seconds:.3f}s, '
+                f'utilization={stats.utilization(self.wall_seconds):.1%}')
+        return '\n'.join(lines)
+
+    def __fail(self, error: Exception) -> None:
+        """例外を記録し、全段階に停止を伝えます。
+        """
+
+        logging.exception('パイプラインでエラーが発生しました。')
+        self._errors.append(error)
+        self._failed.set()
+        self.mat_budget.close()
+
+    def __run_source(self, face_image_sets: iter, out_queue: queue.Queue):
+        """fetch 段階です。 FaceImageSet ごとに実画像を取得し、次段階へ渡します。
+        """
+
+        stats = self.stats['fetch']
+        face_image_sets = iter(face_image_sets)
+        try:
+            while not self._failed.is_set():
+
+                # NOTE: prefilter を使う場合、セットは作るときに実画像を取得します。
+                # NOTE: (image.iter_image_sets) その時間も fetch 段階に含めます。
+                started = time.perf_counter()
+                face_image_set = next(face_image_sets, None)
+                if face_image_set is None:
+                    break
+                busy_seconds = time.perf_counter() - started
+
+                # デコード済み mat の枚数に空きができるまで待ちます。
+                # NOTE: mat は mosaic 段階で連結し終えたら解放します。
+                # NOTE: 取得できなかった画像を除くと mat_list は短くなるため、
+                # NOTE: 返却するのは mat_list の長さでなく、ここで確保した枚数です。
+                # NOTE: 取得済みのセットは mat を持ったまま待つため、上限を超えて持つのは
+                # NOTE: 詰め直し中の端数と取得した1セットぶんまでです。
+                mat_count = len(face_image_set.face_images)
+                self.mat_budget.acquire(mat_count)
+
+                started = time.perf_counter()
+                try:
+                    mat_list = face_image_set.get_mat_list()
+                except BaseException:
+                    self.mat_budget.release(mat_count)
+                    raise
+                stats.add(busy_seconds + time.perf_counter() - started)
+                out_queue.put((face_image_set, mat_list, mat_count))
+        except Exception as e:
+            self.__fail(e)
+        finally:
+            out_queue.put(_END)
+
+    def __run_stage(self,
+                    name: str,
+                    func: callable,
+                    in_queue: queue.Queue,
+                    out_queue: queue.Queue,
+                    discard: callable = None) -> None:
+        """中間の段階です。 in_queue から受け取り、 func の結果を out_queue に渡します。
+        異常終了後に読み捨てる item は、 discard があれば渡して後始末させます。
+        """
+
+        stats = self.stats[name]
+        try:
+            while True:
+                item = in_queue.get()
+                if item is _END:
+                    break
+
+                # 異常終了時は、上流が詰まらないよう読み捨てだけ続けます。
+                # NOTE: 読み捨てる item が握っているスロットや枠は返却します。
+                # NOTE: 共有のプロセスプールは次の実行でも使うため、返さないと待ち続けます。
+                if self._failed.is_set():
+                    if discard is not None:
+                        discard(item)
+                    continue
+
+                started = time.perf_counter()
+                try:
+                    result = func(item)
+                except Exception as e:
+                    self.__fail(e)
+                    continue
+                stats.add(time.perf_counter() - started)
+                out_queue.put(result)
+        finally:
+            out_queue.put(_END)
+
+    def __mosaic(self, item: tuple) -> tuple:
+        face_image_set, mat_list, mat_count = item
+        try:
+            concatenated_mat = face_image_set.concatenate_mat(mat_list)
+        finally:
+            # 連結し終えた mat は不要なので枠を返却します。
+            del mat_list
+            self.mat_budget.release(mat_count)
+        return face_image_set, concatenated_mat
+
+    def __discard_mats(self, item: tuple) -> None:
+        """連結せずに読み捨てる mat のスロットと枠を返却します。
+        """
+
+        face_image_set, mat_list, mat_count = item
+        if face_image_set.process_pool is not None:
+            face_image_set.process_pool.release(mat_list)
+        self.mat_budget.release(mat_count)
+
+    def __detect(self, item: tuple) -> object:
+        face_image_set, concatenated_mat = item
+        face_image_set.detect(concatenated_mat)
+        return face_image_set
+
+    def __identify(self, face_image_set: object) -> object:
+        face_image_set.identify()
+        return face_image_set
+
+    def __run_db_write_stage(self, in_queue: queue.Queue) -> None:
+        """DB 更新段階です。 MySQL の接続はこのスレッド専用に1本張ります。
+        """
+
+        stats = self.stats['db_write']
+        ended = False
+        try:
+            with db_client.MySqlClient() as mysql_client:
+                while True:
+                    face_image_set = in_queue.get()
+                    if face_image_set is _END:
+                        ended = True
+                        break
+                    if self._failed.is_set():
+                        continue
+
+                    started = time.perf_counter()
+                    with metrics.Metrics.get_shared().time('db_update'):
+                        mysql_client.set_completed_statuses([
+                            face_image.get_completed_status_values()
+                            for face_image in face_image_set.face_images
+                        ])
+
+                    # 取得できなかった画像と prefilter で除いた画像は、
+                    # faceId がつかないため保留にします。
+                    pending_face_images = (
+                        face_image_set.get_pending_face_images())
+                    if pending_face_images:
+                        mysql_client.set_pending_status(
+                            [_.id for _ in pending_face_images])
+                    for face_image in face_image_set.face_images:
+                        logging.warning(
+                            f'UPDATE 完了: {face_image}, '
+                            f'matched={face_image.matched()}')
+                    stats.add(time.perf_counter() - started)
+                    self.completed_face_images.extend(
+                        face_image_set.face_images)
+
+                    # NOTE: パイプラインでは複数のセットが同時に流れるため、
+                    # NOTE: ピークは DB 更新を終えたセットまでの区間のものです。
+                    profiler = profiling.RunProfiler.get_shared()
+                    if profiler is not None:
+                        profiler.snapshot_set(face_image_set.face_images)
+        except Exception as e:
+            self.__fail(e)
+            # 上流が詰まらないよう、残りを読み捨てます。
+            while not ended and in_queue.get() is not _END:
+                pass
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    # NOTE: DB と Face API を使わないよう、 FaceImageSet と MySqlClient の代役で流します。
+    class _StandInFaceImage:
+
+        id = 0
+
+        def get_completed_status_values(self) -> tuple:
+            return ()
+
+        def matched(self) -> bool:
+            return False
+
+    class _StandInFaceImageSet:
+        """get_mat_list で半分を取得できなかったことにする、 FaceImageSet の代役です。
+        """
+
+        def __init__(self, count: int, process_pool: object = None):
+            self.face_images = [_StandInFaceImage() for _ in range(count)]
+            self.unreadable_face_images = []
+            self.process_pool = process_pool
+
+        def get_mat_list(self) -> list:
+            self.unreadable_face_images = self.face_images[1::2]
+            self.face_images = self.face_images[::2]
+            return [object() for _ in self.face_images]
+
+        def get_pending_face_images(self) -> list:
+            return self.unreadable_face_images
+
+        def concatenate_mat(self, mat_list: list) -> object:
+            return None
+
+        def detect(self, concatenated_mat: object) -> None:
+            if self.process_pool is not None:
+                raise RuntimeError('detection failed')
+
+        def identify(self) -> None:
+            pass
+
+    class _StandInMySqlClient:
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            pass
+
+        def set_completed_statuses(self, results: list) -> None:
+            pass
+
+        def set_pending_status(self, history_face_image_ids: list) -> None:
+            pass
+
+    db_client.MySqlClient = _StandInMySqlClient
+    profiling.RunProfiler.get_shared = classmethod(lambda cls: None)
+
+    # 除かれたぶんの枠も返却し、上限が小さくても止まらないことを確かめます。
+    runner = PipelineRunner(queue_size=2, max_mats_in_flight=16)
+    thread = threading.Thread(
+        target=runner.run,
+        args=([_StandInFaceImageSet(8) for _ in range(20)],),
+        daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), 'pipeline stalled on the mat budget'
+    assert len(runner.completed_face_images) == 80
+    assert runner.mat_budget.in_use == 0
+
+    class _StandInProcessPool:
+        """取得した mat の数から、返却されていないスロットの数を数えます。
+        """
+
+        def __init__(self):
+            self.in_use = 0
+
+        def release(self, tiles: list) -> None:
+            self.in_use -= len(tiles)
+
+    class _StandInPooledFaceImageSet(_StandInFaceImageSet):
+        """detection で失敗する、プロセスプールを使う場合の FaceImageSet の代役です。
+        """
+
+        def get_mat_list(self) -> list:
+            mat_list = super().get_mat_list()
+            self.process_pool.in_use += len(mat_list)
+            return mat_list
+
+        def concatenate_mat(self, mat_list: list) -> object:
+            self.process_pool.release(mat_list)
+            return None
+
+    # 失敗したあとに読み捨てたセットも、スロットと枠を返却することを確かめます。
+    process_pool = _StandInProcessPool()
+    runner = PipelineRunner(queue_size=2, max_mats_in_flight=16)
+    try:
+        runner.run([_StandInPooledFaceImageSet(8, process_pool)
+                    for _ in range(20)])
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the detection error was not raised')
+    assert process_pool.in_use == 0
+    assert runner.mat_budget.in_use == 0
@@ -0,0 +1,125 @@
+
+# Built-in modules.
+import threading
+
+# Third-party modules.
+import numpy
+import cv2
+
+# My modules.
+import const
+
+
+class FacePrefilter:
+    """Detection API にまわす前に、手元の CPU で顔のなさそうな画像を見分けます。
+
+    顔のない画像も連結画像のタイルを1枚使い、 detection のトランザクションを増やします。
+    あとで faceId がつかず終わるだけなので、連結する前に除いて PENDING にします。
+
+    判定は2段です。
+    - ぼけ具合: ラプラシアンの分散が min_blur_score 未満なら、ぼけすぎか無地です。
+    - 顔: OpenCV 同梱の Haar cascade で顔がひとつも見つからなければ、顔がありません。
+    どちらも、はっきり使えない画像だけを除くよう緩めにしてあります。
+    """
+
+    # 同梱の Haar cascade です。
+    CASCADE_PATH = (cv2.data.haarcascades
+                    + 'haarcascade_frontalface_default.xml')
+
+    # プロセス内で共有するフィルタです。
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self,
+                 min_blur_score: float,
+                 min_neighbors: int,
+                 min_face_ratio: float):
+        """
+        Args:
+            min_blur_score (float): これ未満のぼけ具合の画像は除きます。0 なら見ません。
+            min_neighbors (int): Haar cascade の minNeighbors。小さいほど顔を見つけやすい。
+            min_face_ratio (float): 探す顔の最小の大きさ (画像の短い辺に対する比)。
+        """
+
+        self.min_blur_score = min_blur_score
+        self.min_neighbors = min_neighbors
+        self.min_face_ratio = min_face_ratio
+
+        # NOTE: CascadeClassifier はスレッド間で共有しないよう、スレッドごとに読み込みます。
+        self._local = threading.local()
+
+    @classmethod
+    def get_shared(cls) -> 'FacePrefilter':
+        """プロセス内で共有するフィルタを取得します。
+        初回呼び出し時に作成します。
+
+        Returns:
+            FacePrefilter: 共有のフィルタ。無効にしている場合は None です。
+        """
+
+        with cls._shared_lock:
+            if cls._shared is None and const.PREFILTER_ENABLED:
+                cls._shared = cls(const.PREFILTER_MIN_BLUR_SCORE,
+                                  const.PREFILTER_MIN_NEIGHBORS,
+                                  const.PREFILTER_MIN_FACE_RATIO)
+            return cls._shared
+
+    def __get_classifier(self) -> cv2.CascadeClassifier:
+
+        classifier = getattr(self._local, 'classifier', None)
+        if classifier is None:
+            classifier = cv2.CascadeClassifier(self.CASCADE_PATH)
+            self._local.classifier = classifier
+        return classifier
+
+    @staticmethod
+    def get_blur_score(gray_mat: numpy.ndarray) -> float:
+        """ぼけ具合を取得します。ラプラシアン (輪郭の強さ) の分散です。
+
+        Args:
+            gray_mat (numpy.ndarray): グレースケールの mat 画像。
+
+        Returns:
+            float: ぼけ具合。小さいほどぼけています。無地なら0です。
+        """
+
+        return float(cv2.Laplacian(gray_mat, cv2.CV_64F).var())
+
+    def check(self, mat: numpy.ndarray) -> str:
+        """画像に使える顔がありそうか判定します。
+
+        Args:
+            mat (numpy.ndarray): mat 形式の画像。タイルの大きさに縮めたものを渡します。
+
+        Returns:
+            str: 除く理由 ('blurry' または 'no_face')。使えそうなら None です。
+        """
+
+        gray_mat = cv2.cvtColor(mat, cv2.COLOR_BGR2GRAY)
+        if (self.min_blur_score > 0
+                and self.get_blur_score(gray_mat) < self.min_blur_score):
+            return 'blurry'
+
+        # NOTE: scaleFactor は 1.05 から 1.1 に粗くし、判定の時間をおよそ半分にしました。
+        # NOTE: 既定の設定では、顔のある画像を誤って除く割合は変わりません。
+        # NOTE: (benchmark_prefilter.py)
+        min_size = max(int(min(gray_mat.shape) * self.min_face_ratio), 1)
+        faces = self.__get_classifier().detectMultiScale(
+            gray_mat,
+            scaleFactor=1.1,
+            minNeighbors=self.min_neighbors,
+            minSize=(min_size, min_size))
+        if len(faces) == 0:
+            return 'no_face'
+        return None
+
+
+if __name__ == '__main__':
+
+    # 簡易的なユニットテスト。
+    face_prefilter = FacePrefilter(
+        min_blur_score=2, min_neighbors=2, min_face_ratio=.25)
+    assert face_prefilter.check(cv2.imread('./100x100-egc.png')) is None
+    assert face_prefilter.check(cv2.imread('./100x100-dog.png')) == 'no_face'
+    blank_mat = numpy.full((100, 100, 3), 255, numpy.uint8)
+    assert face_prefilter.check(blank_mat) == 'blurry'
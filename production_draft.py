@@ -8,11 +8,26 @@
 """
 
 # Built-in modules.
+import asyncio
 import logging
 
 # My modules.
+import const
 import db_client
-import image
+import metrics
+import packing
+import pipeline
+import profiling
+import util
+
+# NOTE: 以下は numpy, cv2, requests, Azure SDK を読み込むため、 import だけで数百ミリ秒かかります。
+#       最初の DB 問い合わせを待たせないよう、初めて使うときに読み込みます。
+blob_storage = util.lazy_import('blob_storage')
+detection_cache = util.lazy_import('detection_cache')
+face_api = util.lazy_import('face_api')
+identify_batch = util.lazy_import('identify_batch')
+image = util.lazy_import('image')
+tile_pool = util.lazy_import('tile_pool')
 
 
 # ローカル環境ではコレを書かないと logging.*** は機能しません。
@@ -24,6 +39,11 @@ def main() -> None:
     logging.warning(
         'taskal-history-face-image-recognition-function-app 処理開始。')
 
+    # PROFILE_DIR を指定したときだけ CPU とメモリを計測します。
+    profiler = profiling.RunProfiler.get_shared()
+    if profiler is not None:
+        profiler.start()
+
     try:
         _main()
     except Exception:
@@ -33,15 +53,134 @@ def main() -> None:
     else:
         logging.warning(
             'taskal-history-face-image-recognition-function-app 正常終了。')
+    finally:
+        # ワーカープロセスを使っていれば終了させます。
+        if const.PROCESS_POOL_ENABLED:
+            tile_pool.TileProcessPool.close_shared()
+        if profiler is not None:
+            profiler.stop()
 
 
 def _main() -> None:
 
-    # 未処理の HistoryFaceImage レコードを DB から取得します。
-    with db_client.MySqlClient() as mysql_client:
-        records = mysql_client.find_waiting_images()
+    # identification をセットをまたいでまとめるのは、セットを1つずつ順に処理する場合だけです。
+    # NOTE: 並行にセットを処理する場合は設定を無視するため、そのことを出力しておきます。
+    if const.IDENTIFY_BATCH_ENABLED and (
+            const.PIPELINE_ENABLED
+            or (const.ASYNC_ENABLED and not _is_streaming())):
         logging.warning(
-            f'未処理の HistoryFaceImage レコードを DB から取得しました。件数: {len(records)}')
+            'IDENTIFY_BATCH_ENABLED は ASYNC_ENABLED, PIPELINE_ENABLED '
+            'では使えないため、 identification はセットごとに行います。')
+
+    # 従来どおり、未処理のレコードを全件取得してまとめて処理します。
+    if not const.CLAIM_BATCH_SIZE and not _is_streaming():
+        with db_client.MySqlClient() as mysql_client, \
+                metrics.Metrics.get_shared().time('db_fetch'):
+            records = mysql_client.find_waiting_images()
+            logging.warning(
+                f'未処理の HistoryFaceImage レコードを DB から取得しました。件数: {len(records)}')  # noqa: E501
+        _process_records(records)
+        _log_cache_stats()
+        _write_metrics()
+        return
+
+    if const.CLAIM_BATCH_SIZE:
+
+        # 落ちたワーカーが WORKING にしたままのレコードを WAITING に戻します。
+        with db_client.MySqlClient() as mysql_client:
+            released_count = mysql_client.release_expired_claims(
+                const.CLAIM_LEASE_SECONDS)
+            logging.warning(f'期限切れの WORKING レコードを戻しました。件数: {released_count}')  # noqa: E501
+
+        # 未処理のレコードを一定件数ずつ WORKING にして取得します。
+        # NOTE: ほかのワーカーと同時に動いても、同じレコードを処理することはありません。
+        def find_records(mysql_client, after):
+            return mysql_client.claim_waiting_images(
+                const.CLAIM_BATCH_SIZE, after)
+    else:
+
+        # セットごとに流す場合も、レコードは一定件数ずつ取得します。
+        # NOTE: 全件を一度に取得すると、未処理のレコードが多いほどメモリを使います。
+        def find_records(mysql_client, after):
+            return mysql_client.find_waiting_images(
+                const.STREAMING_FETCH_SIZE, after)
+
+    # 取得したぶんずつ処理します。
+    after = None
+    while True:
+        with db_client.MySqlClient() as mysql_client, \
+                metrics.Metrics.get_shared().time('db_fetch'):
+            records = find_records(mysql_client, after)
+            logging.warning(
+                f'未処理の HistoryFaceImage レコードを DB から取得しました。件数: {len(records)}')  # noqa: E501
+        if not records:
+            break
+        after = (records[-1]['createdAt'], records[-1]['id'])
+        _process_records(records)
+    _log_cache_stats()
+    _write_metrics()
+
+
+def _is_streaming() -> bool:
+    """セットごとに流して書き込む (_process_records_streaming を使う) 設定である。
+
+    Returns:
+        bool: STREAMING_ENABLED で、 PIPELINE_ENABLED ではない。
+    """
+
+    # NOTE: パイプラインはもともとセットごとに書き込むため、そちらを優先します。
+    return const.STREAMING_ENABLED and not const.PIPELINE_ENABLED
+
+
+def _log_cache_stats() -> None:
+    """Blob キャッシュのヒット数と、ダウンロードせずに済んだバイト数を出力します。
+    キャッシュを使わない場合は、 Blob を受け取るバッファの確保と再利用の回数を出力します。
+    detection キャッシュのヒット数 (省けた detection の画像数) も出力します。
+    """
+
+    cache = blob_storage.BlobStorageClient.get_cache()
+    if cache is not None:
+        logging.warning(f'Blob キャッシュ: {cache.stats()}')
+    else:
+        buffers = blob_storage.BlobStorageClient.get_buffer_pool()
+        if buffers is not None:
+            logging.warning(f'Blob のバッファ: {buffers.stats()}')
+
+    cache = detection_cache.DetectionCache.get_shared()
+    if cache is not None:
+        logging.warning(f'Detection キャッシュ: {cache.stats()}')
+
+
+def _write_metrics() -> None:
+    """段階ごとの所要時間や Face API のトランザクション数を出力します。
+    設定があれば Prometheus のテキスト形式と JSON のファイルにも書き出します。
+    """
+
+    shared_metrics = metrics.Metrics.get_shared()
+    summary = shared_metrics.to_summary()
+    logging.warning(
+        f'Face API トランザクション数: {summary["face_api_transactions"]}, '
+        f'画像1件あたり: {summary["face_api_transactions_per_image"]}')
+    for stage, values in summary['stages'].items():
+        logging.warning(f'段階 {stage}: {values}')
+    for operation, values in summary['face_api'].items():
+        logging.warning(f'Face API {operation}: {values}')
+
+    shared_metrics.write(const.METRICS_PROMETHEUS_PATH or None,
+                         const.METRICS_JSON_PATH or None)
+
+
+def _process_records(records: list) -> None:
+    """HistoryFaceImage のレコードを identification し、結果を DB に書き込みます。
+
+    Args:
+        records (list): HistoryFaceImage のレコード。
+    """
+
+    # セットごとに流して書き込む場合は、すべての結果をためません。
+    if _is_streaming():
+        _process_records_streaming(records)
+        return
 
     # 各画像のインスタンスを作成します。
     face_images = []
@@ -54,6 +193,7 @@ def _main() -> None:
             defective_face_images.append(face_image)
     logging.warning(
         f'有効なレコード件数: {len(face_images)}, 無効なレコード件数: {len(defective_face_images)}')  # noqa: E501
+    metrics.Metrics.get_shared().add_images(len(face_images))
 
     # 無効なレコードには保留ステータスを付与します。
     if defective_face_images:
@@ -64,42 +204,304 @@ def _main() -> None:
     else:
         logging.warning('保留ステータス付与スキップ。無効レコードがないため。')
 
+    # パイプラインで実行する場合は、 DB 更新までパイプライン内で行います。
+    if const.PIPELINE_ENABLED:
+        _run_pipeline(face_images)
+        return
+
     # Identification 処理の完了した FaceImage を格納します。
-    identified_face_images_all = []
+    if const.ASYNC_ENABLED:
+        identified_face_images_all = asyncio.run(_identify_async(face_images))
+    else:
+        identified_face_images_all = _identify(face_images)
+
+    # 結果をもって、 HistoryFaceImage レコードを更新します。
+    if not identified_face_images_all:
+        return
+    _write_completed_statuses(identified_face_images_all)
+    logging.warning('レコードへの処理済みステータス付与完了。')
+
+
+def _process_records_streaming(records: list) -> None:
+    """HistoryFaceImage のレコードをセットごとに identification し、
+    セットごとに結果を DB に書き込みます。
+    FaceImage もデコード済みの mat も、同時に持つのは処理中の1セットぶんだけです。
+
+    Args:
+        records (list): HistoryFaceImage のレコード。
+    """
+
+    # レコードは列ごとの配列にまとめます。
+    # NOTE: FaceImage としての view は、処理中のセットのぶんだけ作ります。
+    batch = image.FaceImageBatch.from_history_face_image_records(records)
+    valid_count = 0
+    defective_history_face_image_ids = [
+        face_image.id for face_image in batch if not face_image.is_valid()]
+
+    # 連結画像のバッファは全セットで使い回します。
+    mosaic_builder = image.create_mosaic_builder()
+    profiler = profiling.RunProfiler.get_shared()
+    accumulator = _create_identify_accumulator()
+
+    # NOTE: prefilter を使う場合、除いた画像で空いたタイルは後続の画像で埋めます。
+    for face_image_set in image.iter_image_sets(
+            _split_batch(batch, mosaic_builder.capacity), mosaic_builder):
+
+        # このセットの結果をすぐに書き込み、 FaceImage を手放します。
+        # NOTE: identification をまとめる場合は、済んだものから書き込みます。
+        if accumulator is None:
+            face_image_set.identify_by_face_api()
+            _write_completed_statuses(face_image_set.face_images)
+        else:
+            identified_face_images = accumulator.add(
+                face_image_set.detect_by_face_api())
+            if identified_face_images:
+                _write_completed_statuses(identified_face_images)
+        pending_face_images = face_image_set.get_pending_face_images()
+        _write_pending_statuses(pending_face_images)
+        set_count = len(face_image_set.face_images) + len(pending_face_images)
+        metrics.Metrics.get_shared().add_images(set_count)
+        valid_count += set_count
+        if profiler is not None:
+            profiler.snapshot_set(face_image_set.face_images)
+        del face_image_set, pending_face_images
+
+    # ためている端数の faceId を identification し、書き込みます。
+    if accumulator is not None:
+        identified_face_images = accumulator.flush()
+        if identified_face_images:
+            _write_completed_statuses(identified_face_images)
+        accumulator.log_stats()
+
+    # 無効なレコードには保留ステータスを付与します。
+    if defective_history_face_image_ids:
+        with db_client.MySqlClient() as mysql_client:
+            mysql_client.set_pending_status(defective_history_face_image_ids)
+    logging.warning(
+        f'有効なレコード件数: {valid_count}, 無効なレコード件数: {len(defective_history_face_image_ids)}')  # noqa: E501
+    logging.warning('レコードへの処理済みステータス付与完了。')
+
 
-    while face_images:
+def _write_completed_statuses(face_images: list) -> None:
+    """identification の結果をもって、 HistoryFaceImage レコードを更新します。
 
-        # 64画像ずつ処理します。
-        images_max64 = face_images[:64]
-        face_images = face_images[64:]
-        logging.warning(f'残り{len(face_images)}個。')
+    Args:
+        face_images (list): Identification 処理の完了した FaceImage のリスト。
+    """
 
-        # 64画像はセットで扱います。
-        face_image_set = image.FaceImageSet(images_max64)
+    with db_client.MySqlClient() as mysql_client:
+
+        # まとめて UPDATE します。 commit は一定件数ごとに1回です。
+        with metrics.Metrics.get_shared().time('db_update'):
+            mysql_client.set_completed_statuses([
+                face_image.get_completed_status_values()
+                for face_image in face_images
+            ])
+    for face_image in face_images:
+        logging.warning(
+            f'UPDATE 完了: {face_image}, matched={face_image.matched()}')
+
+
+def _write_pending_statuses(face_images: list) -> None:
+    """取得できなかった (大きすぎる、またはデコードできなかった) 画像と、
+    prefilter で除いた画像の HistoryFaceImage に保留ステータスを付与します。
+    faceId がつかないため、照合できなかった (matched=False) とは書き込みません。
+
+    Args:
+        face_images (list): FaceImageSet.get_pending_face_images の結果。
+    """
+
+    if not face_images:
+        return
+    with db_client.MySqlClient() as mysql_client:
+        mysql_client.set_pending_status([_.id for _ in face_images])
+
+
+def _identify(face_images: list) -> list:
+    """セットを1つずつ順に identification します。
+
+    Args:
+        face_images (list): 有効な FaceImage のリスト。
+
+    Returns:
+        list: Identification 処理の完了した FaceImage のリスト。
+    """
+
+    identified_face_images_all = []
+
+    # 連結画像のバッファは全セットで使い回します。
+    # NOTE: 以下のループではセットを1つずつ処理するため共有しても安全です。
+    mosaic_builder = image.create_mosaic_builder()
+    profiler = profiling.RunProfiler.get_shared()
+    accumulator = _create_identify_accumulator()
+
+    # 連結画像1枚に並ぶ数 (既定では64) ずつ処理します。
+    # NOTE: 残りを切り出し直すと件数の2乗のコピーになるため、先頭から順に分けます。
+    # NOTE: prefilter を使う場合、除いた画像で空いたタイルは後続の画像で埋めます。
+    remaining_count = len(face_images)
+    for face_image_set in image.iter_image_sets(
+            _split_face_images(face_images, mosaic_builder.capacity),
+            mosaic_builder):
+        pending_face_images = face_image_set.get_pending_face_images()
+        remaining_count -= (len(face_image_set.face_images)
+                            + len(pending_face_images))
+        logging.warning(f'残り{remaining_count}個。')
 
         # Identification を行います。
         # (画像の連結、 FaceAPI による detection、同じく identification すべて行います。)
-        identified_face_images = face_image_set.identify_by_face_api()
+        # NOTE: identification をまとめる場合は、 faceId がそろったものから済みます。
+        if accumulator is None:
+            identified_face_images = face_image_set.identify_by_face_api()
+        else:
+            identified_face_images = accumulator.add(
+                face_image_set.detect_by_face_api())
+        _write_pending_statuses(face_image_set.get_pending_face_images())
+        if profiler is not None:
+            profiler.snapshot_set(face_image_set.face_images)
 
         # 別のリストに格納します。 while 外で一気に DB 更新を行うためです。
         identified_face_images_all.extend(identified_face_images)
 
-    # 結果をもって、 HistoryFaceImage レコードを更新します。
-    if not identified_face_images_all:
+    # ためている端数の faceId を identification します。
+    if accumulator is not None:
+        identified_face_images_all.extend(accumulator.flush())
+        accumulator.log_stats()
+
+    return identified_face_images_all
+
+
+def _split_face_images(face_images: list, capacity: int) -> object:
+    """face_images を、連結画像1枚に並ぶ数ずつのリストに分けます。
+    PACK_BY_PERSON_GROUP_ENABLED なら、 PersonGroup ごとにまとめてから分けます。
+
+    Args:
+        face_images (list): 有効な FaceImage のリスト。
+        capacity (int): 連結画像1枚に並ぶ数。
+
+    Returns:
+        object: FaceImage のリストを順に返す iterable。
+    """
+
+    # NOTE: DB の順序のままだと1枚に多くの PersonGroup が混ざり、
+    # NOTE: PersonGroup ごとの identification の端数がセットの数だけ増えます。
+    if not const.PACK_BY_PERSON_GROUP_ENABLED:
+        return util.chunked(face_images, capacity)
+    return packing.pack_by_key(face_images,
+                               capacity,
+                               lambda _: _.get_person_group_id())
+
+
+def _split_batch(batch: object, capacity: int) -> object:
+    """FaceImageBatch の有効な行を、連結画像1枚に並ぶ数ずつの view のリストにして順に返します。
+    _split_face_images の FaceImageBatch 版です。
+
+    Args:
+        batch (image.FaceImageBatch): レコードを列ごとの配列にまとめたもの。
+        capacity (int): 連結画像1枚に並ぶ数。
+
+    Yields:
+        list: FaceImageView のリスト。
+    """
+
+    if not const.PACK_BY_PERSON_GROUP_ENABLED:
+        yield from util.chunked(batch.iter_valid(), capacity)
         return
-    with db_client.MySqlClient() as mysql_client:
 
-        for face_image in identified_face_images_all:
-            mysql_client.set_completed_status(
-                face_image.matched(),
-                face_image.candidate_person_id,
-                face_image.candidate_confidence,
-                face_image.id,
-            )
-            logging.warning(
-                f'UPDATE 完了: {face_image}, matched={face_image.matched()}')
+    # NOTE: view をまとめて作らないよう、行番号で分けてからセットごとに view にします。
+    rows = [face_image.row for face_image in batch.iter_valid()]
+    for rows_max64 in packing.pack_by_key(rows,
+                                          capacity,
+                                          batch.get_person_group_id):
+        yield [batch[row] for row in rows_max64]
+
+
+def _create_identify_accumulator() -> object:
+    """identification をセットをまたいでまとめる場合に、そのためのインスタンスを作ります。
+
+    Returns:
+        identify_batch.IdentifyAccumulator: インスタンス。まとめない場合は None です。
+    """
+
+    if not const.IDENTIFY_BATCH_ENABLED:
+        return None
+    return identify_batch.IdentifyAccumulator()
+
+
+async def _identify_async(face_images: list) -> list:
+    """複数のセットの detection と identification を並行に投げます。
+    Face API の同時呼び出し数は AsyncFaceApiClient が制限します。
+
+    Args:
+        face_images (list): 有効な FaceImage のリスト。
+
+    Returns:
+        list: Identification 処理の完了した FaceImage のリスト。順序はセットの順です。
+    """
+
+    loop = asyncio.get_event_loop()
+    profiler = profiling.RunProfiler.get_shared()
 
-        logging.warning('レコードへの処理済みステータス付与完了。')
+    # NOTE: 並行に処理するため、連結画像のバッファはセットごとに確保します。
+    # NOTE: 先に全セットを作るとバッファを全セットぶん抱えるため、順番が来てから作ります。
+    # NOTE: prefilter を使う場合、セットは作るときに実画像を取得するためスレッドで作ります。
+    capacity = image.create_mosaic_builder().capacity
+    face_image_sets = image.iter_image_sets(
+        _split_face_images(face_images, capacity))
+    next_set_lock = asyncio.Lock()
+
+    # セットの順に、 identification の済んだ FaceImage のリストを入れます。
+    results = []
+
+    async def identify_sets() -> None:
+        while True:
+            # NOTE: ジェネレータは同時に進められないため、1つずつ取り出します。
+            async with next_set_lock:
+                face_image_set = await loop.run_in_executor(
+                    None, next, face_image_sets, None)
+                if face_image_set is None:
+                    return
+                index = len(results)
+                results.append(None)
+
+            results[index] = (
+                await face_image_set.identify_by_face_api_async(client))
+            await loop.run_in_executor(
+                None,
+                _write_pending_statuses,
+                face_image_set.get_pending_face_images())
+            del face_image_set
+            if profiler is not None:
+                profiler.snapshot_set(results[index])
+
+    # 同時に処理するセットの数です。デコード済み画像でメモリを使いすぎないよう制限します。
+    async with face_api.AsyncFaceApiClient() as client:
+        await asyncio.gather(*(identify_sets() for _ in range(
+            const.ASYNC_MAX_SETS_IN_FLIGHT)))
+
+    identified_face_images_all = []
+    for identified_face_images in results:
+        identified_face_images_all.extend(identified_face_images)
+    return identified_face_images_all
+
+
+def _run_pipeline(face_images: list) -> None:
+    """fetch, mosaic, detect, identify, DB 更新を段階ごとに並行して実行します。
+
+    Args:
+        face_images (list): 有効な FaceImage のリスト。
+    """
+
+    # 連結画像1枚に並ぶ数ずつのセットを順に作ります。
+    # NOTE: prefilter を使う場合、除いた画像で空いたタイルは後続の画像で埋めます。
+    capacity = image.create_mosaic_builder().capacity
+    face_image_sets = image.iter_image_sets(
+        _split_face_images(face_images, capacity))
+
+    runner = pipeline.PipelineRunner()
+    completed_face_images = runner.run(face_image_sets)
+    logging.warning(
+        f'レコードへの処理済みステータス付与完了。件数: {len(completed_face_images)}')
+    logging.warning(f'パイプラインの段階ごとの稼働状況:\n{runner.report()}')
 
 
 if __name__ == '__main__':
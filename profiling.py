@@ -0,0 +1,177 @@
+
+# Built-in modules.
+import cProfile
+import gc
+import logging
+import os
+import pstats
+import reprlib
+import sys
+import threading
+import tracemalloc
+
+# My modules.
+import const
+
+
+class RunProfiler:
+    """production_draft の1回の実行の CPU とメモリを調べます。
+    const.PROFILE_DIR を指定したときだけ有効です。
+
+    - 実行全体の cProfile の結果を run.pstats に書き出します。
+      NOTE: パイプラインなどの別スレッドのぶんも合算します。
+    - FaceImageSet ごとに tracemalloc のピークと、確保の多い行の一覧を書き出します。
+    - 実行の最後に、まだ生きている大きなオブジェクトをログに出します。
+    """
+
+    # プロセス内で共有するプロファイラです。
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    # 確保の多い行、大きなオブジェクトを何件出すかです。
+    TOP_COUNT = 20
+
+    # tracemalloc で記録するスタックの深さです。深いほど重くなります。
+    TRACEBACK_LIMIT = 5
+
+    def __init__(self, output_dir: str):
+        """
+        Args:
+            output_dir (str): 結果を書き出すディレクトリ。
+        """
+
+        self.output_dir = output_dir
+        self._lock = threading.Lock()
+
+        # スレッドごとの cProfile です。
+        self._profiles = []
+        self._set_count = 0
+
+    @classmethod
+    def get_shared(cls) -> 'RunProfiler':
+        """プロセス内で共有するプロファイラを取得します。初回呼び出し時に作成します。
+
+        Returns:
+            RunProfiler: 共有のプロファイラ。無効にしている場合は None です。
+        """
+
+        # NOTE: 無効のときは呼び出し側で None を判定するだけで、計測の処理は一切動きません。
+        if not const.PROFILE_DIR:
+            return None
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(const.PROFILE_DIR)
+            return cls._shared
+
+    def start(self) -> None:
+        """計測を始めます。
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        tracemalloc.start(self.TRACEBACK_LIMIT)
+
+        # これから作られるスレッドでも cProfile を動かします。
+        threading.setprofile(self.__start_thread_profile)
+        self.__start_thread_profile()
+
+    def __start_thread_profile(self, *args) -> None:
+        """このスレッドの cProfile を始めます。
+        threading.setprofile に渡すと、スレッドの開始時に1回だけ呼ばれます。
+        """
+
+        # NOTE: enable でこのスレッドのプロファイル関数は cProfile に置き換わります。
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def stop(self) -> None:
+        """計測を終え、 cProfile の結果を書き出し、大きなオブジェクトをログに出します。
+        """
+
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self._profiles)
+
+        # NOTE: disable はこのスレッドのぶんだけ止めます。ほかのスレッドは終了済みです。
+        profiles[0].disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        pstats_path = os.path.join(self.output_dir, 'run.pstats')
+        stats.dump_stats(pstats_path)
+        logging.warning(
+            f'cProfile の結果を書き出しました。スレッド数: {len(profiles)}, '
+            f'{pstats_path}')
+
+        self.__log_largest_objects()
+        tracemalloc.stop()
+
+    def snapshot_set(self, face_images: list) -> None:
+        """FaceImageSet 1つの処理を終えた時点のメモリを書き出します。
+
+        Args:
+            face_images (list): そのセットの FaceImage のリスト。
+        """
+
+        label = (f'{len(face_images)} images, '
+                 f'id {face_images[0].id}-{face_images[-1].id}'
+                 if face_images else '0 images')
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+
+        # NOTE: 前のセットからのピークを出すため、ピークを戻します。
+        # NOTE: reset_peak は Python 3.9 からです。それより前は実行開始からのピークです。
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        with self._lock:
+            self._set_count += 1
+            number = self._set_count
+
+        top_stats = snapshot.statistics('lineno')[:self.TOP_COUNT]
+        lines = [
+            f'set: {label}',
+            f'current: {current_bytes} bytes',
+            f'peak: {peak_bytes} bytes',
+            '',
+        ] + [str(stat) for stat in top_stats]
+        path = os.path.join(self.output_dir, f'set-{number:05d}.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        # NOTE: 後から tracemalloc.Snapshot.load で読み込んで比べられます。
+        snapshot.dump(os.path.join(self.output_dir,
+                                   f'set-{number:05d}.snapshot'))
+        logging.warning(
+            f'メモリ: {label}, current={current_bytes}, peak={peak_bytes}')
+
+    def __log_largest_objects(self) -> None:
+        """まだ生きているオブジェクトのうち、大きいものをログに出します。
+        """
+
+        # NOTE: gc が追跡するのはコンテナだけです。 ndarray や bytes も拾えるよう、
+        # NOTE: コンテナが直接参照しているオブジェクトも含めます。
+        gc.collect()
+        objects = {}
+        for obj in gc.get_objects():
+            objects[id(obj)] = obj
+            for referent in gc.get_referents(obj):
+                objects.setdefault(id(referent), referent)
+
+        sizes = []
+        for obj in objects.values():
+            try:
+                sizes.append((sys.getsizeof(obj), obj))
+            except TypeError:
+                continue
+        del objects
+        sizes.sort(key=lambda _: _[0], reverse=True)
+
+        for size, obj in sizes[:self.TOP_COUNT]:
+            logging.warning(
+                f'生きているオブジェクト: {size} bytes, '
+                f'{type(obj).__module__}.{type(obj).__qualname__}, '
+                f'{reprlib.repr(obj)}')
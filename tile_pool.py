@@ -0,0 +1,306 @@
+
+# Built-in modules.
+import ctypes
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.sharedctypes import RawArray
+
+# Third-party modules.
+import numpy
+import cv2
+
+# My modules.
+import const
+import detection_cache
+import image_decode
+import metrics
+import mosaic
+import prefilter
+
+
+class SharedTile:
+    """共有メモリ上のスロットに置いた、デコード済みのタイル1枚です。
+    """
+
+    __slots__ = ('slot', 'tile_hash', 'rejection')
+
+    def __init__(self, slot: int, tile_hash: str, rejection: str = None):
+        self.slot = slot
+        self.tile_hash = tile_hash
+
+        # prefilter.FacePrefilter で除いた理由です。除いていなければ None です。
+        self.rejection = rejection
+
+
+class TileProcessPool:
+    """画像のデコード、連結、エンコードを別プロセスで行います。
+    CPU を使う段階を複数のコアに分けるためです。
+
+    タイルの画素は pickle せず、共有メモリのスロットで受け渡します。
+    プロセス間を行き来するのは Blob のバイナリ、ハッシュ、エンコード済みの連結画像だけです。
+    """
+
+    # プロセス内で共有するプールです。
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, processes: int, slots: int, tile_size: int):
+        """
+        Args:
+            processes (int): ワーカープロセス数。
+            slots (int): 共有メモリに置けるタイルの枚数。
+            tile_size (int): タイル1辺のピクセル数。
+        """
+
+        self.processes = processes
+        self.slots = slots
+        self.tile_size = tile_size
+
+        # タイルを置く共有メモリです。 slots x tile_size x tile_size x 3 の uint8 です。
+        # NOTE: Python 3.7 には shared_memory モジュールがないため RawArray を使います。
+        # NOTE: 書き込みは空きスロットを確保したワーカーだけが行うため、ロックは不要です。
+        self._tiles = RawArray(ctypes.c_uint8,
+                               slots * tile_size * tile_size * 3)
+
+        self._free_slots = list(range(slots))
+        self._condition = threading.Condition()
+
+        # NOTE: パイプラインのスレッドが動いている中で fork すると OpenCV などが
+        # NOTE: ロックを握ったまま複製されかねないため、 spawn で起動します。
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(processes,
+                                  initializer=_initialize_worker,
+                                  initargs=(self._tiles, slots, tile_size))
+
+    @classmethod
+    def get_shared(cls) -> 'TileProcessPool':
+        """プロセス内で共有するプールを取得します。
+        初回呼び出し時にワーカープロセスを起動します。
+
+        Returns:
+            TileProcessPool: 共有のプール。無効にしている場合は None です。
+        """
+
+        with cls._shared_lock:
+            if cls._shared is None and const.PROCESS_POOL_ENABLED:
+
+                # NOTE: 1セットぶんのタイルが確保できないと止まるため、最低でも1枚ぶんは確保します。
+                # NOTE: prefilter を使う場合は、詰め直し中の端数のタイルを持ったまま
+                # NOTE: 次のセットを取得するため、2枚ぶんです。 (image.iter_image_sets)
+                min_slots = const.MOSAIC_ROWS * const.MOSAIC_COLS
+                if const.PREFILTER_ENABLED:
+                    min_slots *= 2
+                slots = max(const.PROCESS_POOL_TILE_SLOTS, min_slots)
+                cls._shared = cls(const.PROCESS_POOL_SIZE or os.cpu_count(),
+                                  slots,
+                                  const.MOSAIC_TILE_SIZE)
+            return cls._shared
+
+    @classmethod
+    def close_shared(cls) -> None:
+        """共有のプールのワーカープロセスを終了します。
+        """
+
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.close()
+                cls._shared = None
+
+    def close(self) -> None:
+
+        self._pool.close()
+        self._pool.join()
+
+    def __acquire_slots(self, count: int) -> list:
+        """count 枚ぶんの空きスロットができるまで待ち、まとめて確保します。
+        """
+
+        if count > self.slots:
+            raise ValueError(
+                f'{count} tiles do not fit in {self.slots} shared slots.')
+
+        # NOTE: 1枚ずつ確保すると、複数のセットが少しずつ握りあって止まりかねません。
+        with self._condition:
+            while len(self._free_slots) < count:
+                self._condition.wait()
+            acquired = self._free_slots[:count]
+            del self._free_slots[:count]
+            return acquired
+
+    def release(self, tiles: list) -> None:
+        """タイルのスロットを返却します。
+
+        Args:
+            tiles (list): SharedTile のリスト。 None を含んでいても大丈夫です。
+        """
+
+        with self._condition:
+            self._free_slots.extend(
+                tile.slot for tile in tiles if tile is not None)
+            self._condition.notify_all()
+
+    def decode(self,
+               bytes_list: list,
+               with_hash: bool = True,
+               face_prefilter: prefilter.FacePrefilter = None) -> list:
+        """画像のバイナリをワーカーでデコードし、共有メモリのタイルに置きます。
+        タイルの大きさに合わない画像は縮小します。
+
+        Args:
+            bytes_list (list): 画像のバイナリのリスト。 None を含んでいても大丈夫です。
+            with_hash (bool): detection キャッシュのために画像の内容のハッシュを求めるか。
+            face_prefilter (prefilter.FacePrefilter): 指定すると、タイルに縮めた画像を
+                ワーカーで判定し、 SharedTile.rejection に結果を入れます。
+
+        Returns:
+            list: SharedTile のリスト。順序は bytes_list と同じです。
+                デコードできなかった画像は None です。
+        """
+
+        indexes = [i for i, _ in enumerate(bytes_list) if _ is not None]
+        slots = self.__acquire_slots(len(indexes))
+
+        # NOTE: フィルタそのものは pickle できないため、設定値を渡してワーカーで作ります。
+        prefilter_settings = None
+        if face_prefilter is not None:
+            prefilter_settings = (face_prefilter.min_blur_score,
+                                  face_prefilter.min_neighbors,
+                                  face_prefilter.min_face_ratio)
+
+        # NOTE: starmap は入力順で結果を返します。
+        try:
+            decode_results = self._pool.starmap(
+                _decode,
+                [(slot, bytes_list[i], with_hash,
+                  const.REDUCED_DECODE_ENABLED, prefilter_settings)
+                 for slot, i in zip(slots, indexes)])
+        except BaseException:
+            self.release([SharedTile(slot, None) for slot in slots])
+            raise
+
+        # NOTE: ワーカーで測った1枚ごとのデコード時間を、このプロセスの集計に加えます。
+        shared_metrics = metrics.Metrics.get_shared()
+        tiles = [None] * len(bytes_list)
+        failed_tiles = []
+        for slot, i, (tile_hash, seconds, saved_bytes, rejection,
+                      prefilter_seconds) in zip(
+                slots, indexes, decode_results):
+            shared_metrics.observe('decode', seconds)
+            shared_metrics.add_bytes('decode_saved', saved_bytes)
+            if prefilter_settings is not None:
+                shared_metrics.observe('prefilter', prefilter_seconds)
+            if tile_hash is _DECODE_FAILED:
+                failed_tiles.append(SharedTile(slot, None))
+                continue
+            tiles[i] = SharedTile(slot, tile_hash, rejection)
+        self.release(failed_tiles)
+        return tiles
+
+    def build_and_encode(self,
+                         tiles: list,
+                         rows: int,
+                         cols: int,
+                         encoding: object) -> bytes:
+        """タイルをワーカーで連結し、 Detection API に送るバイナリにエンコードします。
+
+        Args:
+            tiles (list): 並べる順の SharedTile のリスト。
+            rows (int): 縦のタイル数。
+            cols (int): 横のタイル数。
+            encoding (face_api.ImageEncoding): エンコードの設定。
+
+        Returns:
+            bytes: エンコードした連結画像。
+        """
+
+        bytes_image, build_seconds, encode_seconds = self._pool.apply(
+            _build_and_encode,
+            ([tile.slot for tile in tiles], rows, cols, encoding))
+
+        shared_metrics = metrics.Metrics.get_shared()
+        shared_metrics.observe('mosaic', build_seconds)
+        shared_metrics.observe('encode', encode_seconds)
+        return bytes_image
+
+
+# デコードできなかったことを表す値です。ハッシュを求めない場合の None と区別します。
+_DECODE_FAILED = ''
+
+# 以下はワーカープロセス側の状態です。
+# 共有メモリのタイルを (slots, tile_size, tile_size, 3) として見る view です。
+_worker_tiles = None
+
+# タイル配置: MosaicBuilder です。連結先のバッファをプロセス内で使い回します。
+_worker_builders = {}
+
+# 設定値: FacePrefilter です。 cascade の読み込みをプロセス内で1回にします。
+_worker_prefilters = {}
+
+
+def _initialize_worker(tiles: RawArray, slots: int, tile_size: int) -> None:
+
+    global _worker_tiles
+
+    # NOTE: プロセスごとに OpenCV のスレッドを立てると、コア数以上に奪い合います。
+    cv2.setNumThreads(1)
+
+    _worker_tiles = numpy.frombuffer(tiles, numpy.uint8).reshape(
+        slots, tile_size, tile_size, 3)
+
+
+def _get_worker_builder(rows: int, cols: int) -> mosaic.MosaicBuilder:
+
+    if (rows, cols) not in _worker_builders:
+        _worker_builders[(rows, cols)] = mosaic.MosaicBuilder(
+            rows, cols, _worker_tiles.shape[1])
+    return _worker_builders[(rows, cols)]
+
+
+def _decode(slot: int,
+            bytes_image: bytes,
+            with_hash: bool,
+            reduced: bool,
+            prefilter_settings: tuple) -> tuple:
+
+    started = time.perf_counter()
+    saved_bytes = 0
+    if reduced:
+        mat, saved_bytes = image_decode.decode_tile(
+            bytes_image, _worker_tiles.shape[1])
+    else:
+        mat = cv2.imdecode(numpy.frombuffer(bytes_image, numpy.uint8),
+                           cv2.IMREAD_COLOR)
+    seconds = time.perf_counter() - started
+    if mat is None:
+        return _DECODE_FAILED, seconds, saved_bytes, None, .0
+
+    # NOTE: ハッシュはタイルに収める前の画像で求め、プールを使わない場合と同じキーにします。
+    tile_hash = detection_cache.get_tile_hash(mat) if with_hash else None
+    _worker_tiles[slot] = _get_worker_builder(1, 1).fit_to_tile(mat)
+
+    # NOTE: 判定はタイルに縮めた画像で行い、プールを使わない場合とそろえます。
+    rejection = None
+    started = time.perf_counter()
+    if prefilter_settings is not None:
+        if prefilter_settings not in _worker_prefilters:
+            _worker_prefilters[prefilter_settings] = prefilter.FacePrefilter(
+                *prefilter_settings)
+        rejection = _worker_prefilters[prefilter_settings].check(
+            _worker_tiles[slot])
+    return (tile_hash, seconds, saved_bytes, rejection,
+            time.perf_counter() - started)
+
+
+def _build_and_encode(slots: list,
+                      rows: int,
+                      cols: int,
+                      encoding: object) -> tuple:
+
+    started = time.perf_counter()
+    builder = _get_worker_builder(rows, cols)
+    concatenated_mat = builder.build([_worker_tiles[slot] for slot in slots])
+    built = time.perf_counter()
+    bytes_image = encoding.encode(concatenated_mat)
+    return bytes_image, built - started, time.perf_counter() - built
@@ -1,4 +1,10 @@
 
+# Built-in modules.
+import importlib.util
+import itertools
+import sys
+
+
 def get_placeholder(count: int) -> str:
     """count ぶんのプレースホルダ文字列を作ります。
     %s, %s, %s, %s, ...
@@ -13,22 +19,26 @@ def get_placeholder(count: int) -> str:
     return ','.join(('%s' for i in range(count)))
 
 
-def convert_list_8x8(list_1d: list, blank: object) -> list:
-    """1次元リストを8x8の2次元リストに変換します。
+def convert_list_2d(list_1d: list,
+                    blank: object,
+                    rows: int,
+                    cols: int) -> list:
+    """1次元リストを rows x cols の2次元リストに変換します。
 
     Args:
         list_1d (list): 1次元リスト。
         blank (object): 空きスペースに置くオブジェクト。
-        use_pop (bool): もとの1次元リストは空にする。
+        rows (int): 行数。
+        cols (int): 列数。
 
     Returns:
         list: 2次元リスト。
     """
 
-    list_2d = [[] for i in range(8)]
+    list_2d = [[] for i in range(rows)]
     i = 0
-    for v in range(8):
-        for h in range(8):
+    for v in range(rows):
+        for h in range(cols):
             if i < len(list_1d):
                 list_2d[v].append(list_1d[i])
                 i += 1
@@ -37,6 +47,67 @@ def convert_list_8x8(list_1d: list, blank: object) -> list:
     return list_2d
 
 
+def convert_list_8x8(list_1d: list, blank: object) -> list:
+    """1次元リストを8x8の2次元リストに変換します。
+
+    Args:
+        list_1d (list): 1次元リスト。
+        blank (object): 空きスペースに置くオブジェクト。
+
+    Returns:
+        list: 2次元リスト。
+    """
+
+    return convert_list_2d(list_1d, blank, 8, 8)
+
+
+def chunked(iterable: object, size: int) -> object:
+    """iterable を size 件ずつのリストに分けて順に返します。
+    リストを先頭から切り出し直さないため、件数が多くてもコピーは1回ずつです。
+
+    Args:
+        iterable (object): リストやジェネレータ。
+        size (int): 1つのリストの件数。
+
+    Yields:
+        list: size 件 (最後だけは端数) のリスト。
+    """
+
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def lazy_import(name: str) -> object:
+    """モジュールを、属性を初めて参照したときに読み込むよう import します。
+    起動時に使わない重いモジュール (cv2, numpy, requests など) の読み込みを後回しにできます。
+
+    Args:
+        name (str): モジュール名。
+
+    Raises:
+        ModuleNotFoundError: モジュールが見つからない。
+
+    Returns:
+        object: モジュール。読み込み済みならそのまま返します。
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
 if __name__ == '__main__':
 
     # 簡易的なユニットテスト。
@@ -55,3 +126,18 @@ if __name__ == '__main__':
         [49, 50, 51, 52, 53, 54, 55, 56],
         [57, 58, 59, 0, 0, 0, 0, 0]]
     assert actual == expected
+
+    actual = list(chunked((i for i in range(5)), 2))
+    expected = [[0, 1], [2, 3], [4]]
+    assert actual == expected
+
+    # 属性を参照するまでは読み込みません。
+    assert lazy_import('sys') is sys
+    module = lazy_import('colorsys')
+    assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+
+    actual = convert_list_2d([1, 2, 3, 4, 5], 0, 2, 3)
+    expected = [
+        [1, 2, 3],
+        [4, 5, 0]]
+    assert actual == expected